@@ -15,24 +15,355 @@
 #          11. Download file
 #          12. Delete File
 #          13. File exists
+#          14. Share pooled S3 clients across the operations
+#          15. Stream object listings page by page, optionally listing
+#              sub-prefixes in parallel
+#          16. Delete folders with concurrent DeleteObjects batches
+#          17. Check files with HEAD & folders with a one key probe, behind
+#              a metadata cache the writes of this module invalidate
+#          18. Tune multipart transfers & report their bytes/s & parts retried
 # Auth: Shreenidhi Bharadwaj modified Husein Adenwala
 # Date: 1/15/2022
 # ALL RIGHTS RESERVED | DO NOT DISTRIBUTE
 #************************************************/
 import os
+import time
 import boto3
+import queue
 import logging
+import threading
+from collections import OrderedDict
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from argparse import ArgumentParser
 from argparse import RawTextHelpFormatter
 
+# Connections kept open per S3 client, shared by the threads of a transfer
+MAX_POOL_CONNECTIONS = 50
+
+# Keep idle connections alive at the TCP level between calls
+TCP_KEEPALIVE = True
+
+# Keys per ListObjectsV2 page, 1000 is the most S3 returns
+PAGE_SIZE = 1000
+
+# Delimiter splitting a prefix into the sub-prefixes listed in parallel
+DELIMITER = '/'
+
+# Keys per DeleteObjects request, 1000 is the most S3 accepts
+DELETE_BATCH = 1000
+
+# DeleteObjects requests run concurrently while the listing goes on
+DELETE_WORKERS = 8
+
+# Seconds an existence check is answered from the metadata cache, 0 to not cache
+CACHE_TTL = 60
+
+# Files & folders remembered by the metadata cache, least recently used go first
+CACHE_SIZE = 10000
+
+MB = 1024 * 1024
+
+# Files from this size up are transferred in parts, boto3's default
+MULTIPART_THRESHOLD = 8 * MB
+
+# Size of each part, S3 takes parts of 5 MB & up
+MULTIPART_CHUNKSIZE = 8 * MB
+
+# Parts transferred concurrently, keep it within MAX_POOL_CONNECTIONS
+MAX_CONCURRENCY = 10
+
+# Seconds between the progress reports of a transfer
+PROGRESS_INTERVAL = 5
+
+# Sessions by profile & S3 clients by (region, profile), created on first use
+_sessions = {}
+_clients = {}
+_client_lock = threading.Lock()
+_client_config = Config(max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=TCP_KEEPALIVE)
+
+
+class MetadataCache(object):
+    """Existence & metadata of files & folders, remembered for a while
+
+    Entries expire after ttl seconds & the least recently used are dropped
+    beyond size entries, for files & folders each. Files not found are
+    remembered too (as None), so repeated checks of a missing key cost no
+    request either. Changes made through this module invalidate the
+    entries they affect, changes made by other clients are seen once the
+    entries expire.
+
+    :param ttl: seconds an entry is kept, 0 to not cache
+    :param size: most files & most folders kept
+    """
+
+    def __init__(self, ttl=CACHE_TTL, size=CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self.objects = OrderedDict()
+        self.folders = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, entries, key):
+        with self.lock:
+            entry = entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+            entries.pop(key, None)
+            self.misses += 1
+            return False, None
+
+    def _put(self, entries, key, value):
+        if self.ttl <= 0 or self.size <= 0:
+            return
+
+        with self.lock:
+            entries[key] = (time.monotonic() + self.ttl, value)
+            entries.move_to_end(key)
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+
+    def get_object(self, bucket_name, key):
+        """(found in cache, metadata dict or None if the file does not exist)"""
+        return self._get(self.objects, (bucket_name, key))
+
+    def put_object(self, bucket_name, key, metadata):
+        self._put(self.objects, (bucket_name, key), metadata)
+
+    def get_folder(self, bucket_name, prefix):
+        """(found in cache, True if a key starts with the prefix)"""
+        return self._get(self.folders, (bucket_name, prefix))
+
+    def put_folder(self, bucket_name, prefix, exists):
+        self._put(self.folders, (bucket_name, prefix), exists)
+
+    def invalidate(self, bucket_name, key=None, prefix=None):
+        """Forget what a change may have made stale
+
+        :param bucket_name: AWS S3 bucket changed
+        :param key: file written or deleted, the folders holding it are forgotten too
+        :param prefix: folder deleted, every entry under it & above it is forgotten
+        """
+
+        with self.lock:
+            if key is not None:
+                self.objects.pop((bucket_name, key), None)
+                stale = [f for f in self.folders if f[0] == bucket_name and key.startswith(f[1])]
+            elif prefix is not None:
+                for o in [o for o in self.objects if o[0] == bucket_name and o[1].startswith(prefix)]:
+                    del self.objects[o]
+                stale = [f for f in self.folders if f[0] == bucket_name and (f[1].startswith(prefix) or prefix.startswith(f[1]))]
+            else:
+                for o in [o for o in self.objects if o[0] == bucket_name]:
+                    del self.objects[o]
+                stale = [f for f in self.folders if f[0] == bucket_name]
+
+            for f in stale:
+                del self.folders[f]
+
+    def clear(self):
+        with self.lock:
+            self.objects.clear()
+            self.folders.clear()
+
+
+_cache = MetadataCache()
+
+
+def configure_cache(ttl=CACHE_TTL, size=CACHE_SIZE):
+    """Set the TTL & size of the metadata cache, forgetting what it holds
+
+    :param ttl: seconds an existence check is answered from the cache, 0 to not cache
+    :param size: most files & most folders kept
+    """
+
+    global _cache
+    _cache = MetadataCache(ttl, size)
+
+
+def clear_cache():
+    """Forget the cached existence & metadata, e.g. after other clients changed the bucket"""
+
+    _cache.clear()
+
+
+def transfer_config(multipart_threshold=MULTIPART_THRESHOLD, multipart_chunksize=MULTIPART_CHUNKSIZE,
+                    max_concurrency=MAX_CONCURRENCY, use_threads=True):
+    """Settings of a multipart transfer
+
+    :param multipart_threshold: bytes from which a file is sent or fetched in parts
+    :param multipart_chunksize: bytes per part
+    :param max_concurrency: parts transferred concurrently, each on its own
+                            pooled connection, see configure_clients
+    :param use_threads: False to transfer the parts one by one in the calling thread
+    :return: boto3 TransferConfig
+    """
+
+    return TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_chunksize,
+                          max_concurrency=max_concurrency, use_threads=use_threads)
+
+
+class TransferProgress(object):
+    """Progress callback of an upload or download
+
+    boto3 calls it from the transfer threads with the bytes of each read or
+    write. A download part fetched again after its stream broke is rewound
+    with a negative count. Requests botocore retried are not seen in the
+    counts, the clients report their RetryAttempts here while the transfer
+    runs. Both are counted as parts retried.
+
+    :param name: file or key reported
+    :param size: bytes of the whole transfer if known
+    :param interval: seconds between reports, None to only keep the counts
+    :param report: function given each report line
+    """
+
+    def __init__(self, name, size=None, interval=PROGRESS_INTERVAL, report=logging.info):
+        self.name = name
+        self.size = size
+        self.interval = interval
+        self.report = report
+        self.bytes = 0
+        self.retried = 0
+        self.lock = threading.Lock()
+        self.st_time = time.perf_counter()
+        self.last = self.st_time
+
+    def __call__(self, bytes_amount):
+        now = time.perf_counter()
+        with self.lock:
+            self.bytes += bytes_amount
+            self.retried += bytes_amount < 0
+
+            # Reported under the lock so the lines of the transfer threads do not mix
+            if self.interval is not None and now - self.last >= self.interval:
+                self.last = now
+                self.report(self._format())
+
+    def retry(self, count=1):
+        with self.lock:
+            self.retried += count
+
+    def _summary(self):
+        seconds = time.perf_counter() - self.st_time
+        return {'bytes': self.bytes, 'seconds': seconds, 'bytes_per_s': self.bytes / max(seconds, 1e-9),
+                'parts_retried': self.retried}
+
+    def summary(self):
+        """dict with the bytes, seconds, bytes_per_s & parts_retried so far"""
+
+        with self.lock:
+            return self._summary()
+
+    def format(self):
+        """Report line of the transfer so far"""
+
+        with self.lock:
+            return self._format()
+
+    def _format(self):
+        summary = self._summary()
+        total = ' of {0:,.1f}'.format(self.size / MB) if self.size else ''
+
+        return '{0}: {1:,.1f}{2} MB in {3:.1f}s, {4:,.1f} MB/s, {5} parts retried'.format(
+            self.name, summary['bytes'] / MB, total, summary['seconds'], summary['bytes_per_s'] / MB, summary['parts_retried'])
+
+
+# TransferProgress of the transfers running, by (bucket, key)
+_transfers = {}
+
+
+def _note_object(params, context, **kwargs):
+    # Remember the object of a call so its retries can be told apart
+    context['awsapi_object'] = (params.get('Bucket'), params.get('Key'))
+
+
+def _count_retries(parsed, context, **kwargs):
+    progress = _transfers.get(context.get('awsapi_object'))
+    attempts = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if progress is not None and attempts:
+        progress.retry(attempts)
+
+
+def configure_clients(max_pool_connections=MAX_POOL_CONNECTIONS, tcp_keepalive=TCP_KEEPALIVE, **config):
+    """Set the connection settings of the S3 clients
+
+    Clients already created are dropped, the next call of each operation
+    creates one with the new settings.
+
+    :param max_pool_connections: connections kept open per client
+    :param tcp_keepalive: keep idle connections alive at the TCP level
+    :param config: other botocore Config options, e.g. retries={'max_attempts': 5}
+    """
+
+    global _client_config
+
+    with _client_lock:
+        _client_config = Config(max_pool_connections=max_pool_connections, tcp_keepalive=tcp_keepalive, **config)
+        _clients.clear()
+
+
+def clear_clients():
+    """Drop the cached S3 clients, e.g. after the credentials changed"""
+
+    with _client_lock:
+        _clients.clear()
+
+
+def get_session(profile=None):
+    """boto3 session of a profile, created once & shared
+
+    :param profile: AWS profile name, None for the default credentials chain
+    :return: boto3.Session
+    """
+
+    with _client_lock:
+        if profile not in _sessions:
+            _sessions[profile] = boto3.Session(profile_name=profile)
+
+        return _sessions[profile]
+
+
+def get_client(region=None, profile=None):
+    """S3 client of a region & profile, created once & shared
+
+    boto3 clients are thread safe, so every operation & thread reuses the
+    same client & its pool of keep-alive connections instead of creating a
+    client, a pool & a TLS connection per call. Sessions are not thread
+    safe, clients are created from them under a lock.
+
+    :param region: AWS region, None for the region of the profile
+    :param profile: AWS profile name, None for the default credentials chain
+    :return: S3 client
+    """
+
+    session = get_session(profile)
+
+    with _client_lock:
+        key = (region, profile)
+        if key not in _clients:
+            client = session.client('s3', region_name=region, config=_client_config)
+            client.meta.events.register('before-parameter-build.s3', _note_object)
+            client.meta.events.register('after-call.s3', _count_retries)
+            _clients[key] = client
+
+        return _clients[key]
+
+
 def list_buckets():
     """Connect to S3 and query all buckets
 
     :return: list of buckets
     """
 
-    s3 = boto3.client('s3')
+    s3 = get_client()
 
     # Call S3 to list current buckets
     response = s3.list_buckets()
@@ -56,15 +387,15 @@ def create_bucket(bucket_name, region=None):
 
     try:
         if region is None:
-            session = boto3.Session(profile_name='default')
+            session = get_session('default')
             region = session.region_name
             location = {'LocationConstraint': region}
-            s3_client = session.client('s3')
+            s3_client = get_client(profile='default')
             s3_client.create_bucket(Bucket=bucket_name,
                                     CreateBucketConfiguration=location)
             logging.info('Created bucket {0} in the S3 default region ({1})'.format(bucket_name, region))
         else:
-            s3 = boto3.client('s3', region_name=region)
+            s3 = get_client(region)
             location = {'LocationConstraint': region}
             s3.create_bucket(Bucket=bucket_name,
                              CreateBucketConfiguration=location)
@@ -86,7 +417,7 @@ def delete_bucket(bucket_name):
     :return: True if the referenced bucket was deleted, otherwise False
     """
 
-    s3 = boto3.client('s3')
+    s3 = get_client()
     try:
         s3.delete_bucket(Bucket=bucket_name)
         logging.info('Bucket {0} deleted successfully'.format(bucket_name))
@@ -106,7 +437,7 @@ def bucket_exists(bucket_name):
     :return: True if the referenced bucket_name exists, otherwise False
     """
 
-    s3 = boto3.client('s3')
+    s3 = get_client()
     try:
         response = s3.head_bucket(Bucket=bucket_name)
         logging.info('{0} exists and you have permission to access it.'.format(bucket_name))
@@ -119,11 +450,156 @@ def bucket_exists(bucket_name):
     return True
 
 
-def list_objects(bucket_name, object_name=None):
+def head_object(bucket_name, key):
+    """Metadata of a file, from the cache or a HEAD request
+
+    :param bucket_name: AWS S3 bucket
+    :param key: exact key of the file
+    :return: dict with the ContentLength, ETag & LastModified of the file,
+             None if there is no such file. Other errors raise ClientError
+    """
+
+    found, metadata = _cache.get_object(bucket_name, key)
+    if found:
+        return metadata
+
+    try:
+        response = get_client().head_object(Bucket=bucket_name, Key=key)
+        metadata = {'ContentLength': response.get('ContentLength'), 'ETag': response.get('ETag'),
+                    'LastModified': response.get('LastModified')}
+
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+            raise
+        metadata = None
+
+    _cache.put_object(bucket_name, key, metadata)
+
+    return metadata
+
+
+def prefix_exists(bucket_name, prefix):
+    """Whether any key starts with prefix, from the cache or a one key listing
+
+    :param bucket_name: AWS S3 bucket
+    :param prefix: AWS S3 directory or key prefix
+    :return: True if a key starts with the prefix. Errors raise ClientError
+    """
+
+    found, exists = _cache.get_folder(bucket_name, prefix)
+    if found:
+        return exists
+
+    response = get_client().list_objects_v2(Bucket=bucket_name, Prefix=prefix, MaxKeys=1)
+    exists = response.get('KeyCount', 0) > 0
+
+    _cache.put_folder(bucket_name, prefix, exists)
+
+    return exists
+
+
+def _list_pages(s3, bucket_name, prefix, page_size, delimiter=None):
+    # ListObjectsV2 pages of a prefix, the paginator follows the continuation tokens
+    kwargs = {'Bucket': bucket_name, 'Prefix': prefix, 'PaginationConfig': {'PageSize': page_size}}
+    if delimiter:
+        kwargs['Delimiter'] = delimiter
+
+    return s3.get_paginator('list_objects_v2').paginate(**kwargs)
+
+
+def _list_parallel(s3, bucket_name, prefixes, page_size, parallel):
+    # Pages of the sub-prefixes are listed by a pool of threads & handed over
+    # through a bounded queue, so a slow consumer holds back the listing
+    # instead of piling pages up in memory
+    pages = queue.Queue(maxsize=2 * parallel)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_prefix(prefix):
+        try:
+            for page in _list_pages(s3, bucket_name, prefix, page_size):
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+        put(done)
+
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='s3-list') as pool:
+        try:
+            for prefix in prefixes:
+                pool.submit(list_prefix, prefix)
+
+            remaining = len(prefixes)
+            while remaining:
+                page = pages.get()
+                if page is done:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    for obj in page.get('Contents', []):
+                        yield obj
+        finally:
+            stop.set()
+
+
+def iter_objects(bucket_name, object_name=None, page_size=PAGE_SIZE, parallel=0, delimiter=DELIMITER):
+    """Stream the files starting with given object_name from an S3 bucket
+
+    Objects are yielded as the ListObjectsV2 pages arrive, so any number of
+    keys is listed in constant memory. With parallel the prefix is first
+    split on the delimiter, the files directly under it are yielded & its
+    sub-prefixes (e.g. the daily YYYYMMDD/ directories) are listed
+    concurrently, their objects arrive in no particular order.
+    ClientError is raised to the caller.
+
+    :param bucket_name: AWS S3 bucket
+    :param object_name: AWS S3 directory or key prefix. If not specified then empty string
+    :param page_size: keys asked for per request, at most 1000
+    :param parallel: threads listing the sub-prefixes, 0 to list the prefix in one sequence
+    :param delimiter: delimiter splitting the prefix into sub-prefixes
+    :return: generator of dicts with the Key, Size, LastModified & ETag of each object
+    """
+
+    if object_name is None:
+        object_name = ''
+
+    s3 = get_client()
+
+    if not parallel:
+        for page in _list_pages(s3, bucket_name, object_name, page_size):
+            for obj in page.get('Contents', []):
+                yield obj
+        return
+
+    prefixes = []
+    for page in _list_pages(s3, bucket_name, object_name, page_size, delimiter):
+        for obj in page.get('Contents', []):
+            yield obj
+        prefixes += [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+
+    for obj in _list_parallel(s3, bucket_name, prefixes, page_size, parallel):
+        yield obj
+
+
+def list_objects(bucket_name, object_name=None, parallel=0):
     """List all directories & files starting with given object_name from an S3 bucket
 
+    Every page of the listing is read, see iter_objects to process the
+    keys as they arrive instead of holding them in a list.
+
     :param bucket_name: AWS S3 bucket
     :param object_name: AWS S3 directory. If not specified then empty string
+    :param parallel: threads listing the sub-prefixes, 0 to list in one sequence
     :return: List of all the directories & files under given object_name(directory)
     """
 
@@ -131,17 +607,12 @@ def list_objects(bucket_name, object_name=None):
     if object_name is None:
         object_name = ''
 
-    s3 = boto3.client('s3')
     try:
-        results = s3.list_objects(Bucket=bucket_name, Prefix=object_name)
-        try:
-            for i in results['Contents']:
-                objects.append(i['Key'])
+        objects = [obj['Key'] for obj in iter_objects(bucket_name, object_name, parallel=parallel)]
+        if objects:
             logging.info('Listing objects under {0} found in {1}'.format(object_name, bucket_name))
-
-        except:
+        else:
             logging.info('No objects found under {0} found in {1}'.format(object_name, bucket_name))
-            pass
 
     except ClientError as e:
         logging.error(e)
@@ -161,7 +632,7 @@ def create_folder(bucket_name, folder_name, object_name=None):
     :return: True if the referenced directory is created, otherwise False
     """
 
-    s3 = boto3.client('s3')
+    s3 = get_client()
     try:
         if object_name:
             object_name = object_name + folder_name + '/'
@@ -169,6 +640,7 @@ def create_folder(bucket_name, folder_name, object_name=None):
             object_name = folder_name + '/'
 
         s3.put_object(Bucket=bucket_name, Key=object_name)
+        _cache.invalidate(bucket_name, object_name)
         logging.info('Added {0} to {1}'.format(object_name, bucket_name))
 
     except Exception as e:
@@ -178,31 +650,124 @@ def create_folder(bucket_name, folder_name, object_name=None):
     return True
 
 
-def delete_folder(bucket_name, object_name):
+def _delete_batch(s3, bucket_name, keys):
+    # One DeleteObjects request. Quiet mode only answers with the keys that failed
+    try:
+        response = s3.delete_objects(Bucket=bucket_name, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+        errors = response.get('Errors', [])
+
+    except ClientError as e:
+        error = e.response.get('Error', {})
+        errors = [{'Key': k, 'Code': error.get('Code'), 'Message': error.get('Message')} for k in keys]
+
+    return len(keys) - len(errors), errors
+
+
+def delete_objects(bucket_name, keys, batch_size=DELETE_BATCH, workers=DELETE_WORKERS):
+    """Delete keys from an S3 bucket with DeleteObjects batches
+
+    The keys may be a generator, e.g. of an iter_objects listing: batches
+    are sent by a pool of threads while the next keys are read, with at
+    most two batches per thread waiting so memory stays bounded. A batch
+    refused as a whole counts every one of its keys as failed.
+
+    :param bucket_name: AWS S3 bucket
+    :param keys: iterable of the keys to delete
+    :param batch_size: keys per DeleteObjects request, at most 1000
+    :param workers: DeleteObjects requests run concurrently
+    :return: dict with deleted, requests, seconds & errors, a list of dicts
+             with the Key, Code & Message of each key not deleted
+    """
+
+    stats = {'deleted': 0, 'requests': 0, 'seconds': 0.0, 'errors': []}
+    st_time = time.perf_counter()
+    s3 = get_client()
+
+    def collect(done):
+        for future in done:
+            deleted, errors = future.result()
+            stats['deleted'] += deleted
+            stats['errors'] += errors
+
+    def send(batch):
+        # The keys are forgotten by the cache whether the delete worked or not
+        try:
+            return _delete_batch(s3, bucket_name, batch)
+        finally:
+            for key in batch:
+                _cache.invalidate(bucket_name, key)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='s3-delete') as pool:
+        pending = set()
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) < batch_size:
+                continue
+
+            pending.add(pool.submit(send, batch))
+            stats['requests'] += 1
+            batch = []
+
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        if batch:
+            pending.add(pool.submit(send, batch))
+            stats['requests'] += 1
+
+        collect(wait(pending)[0])
+
+    stats['seconds'] = time.perf_counter() - st_time
+
+    return stats
+
+
+def delete_prefix(bucket_name, prefix, batch_size=DELETE_BATCH, workers=DELETE_WORKERS):
+    """Delete every object under a prefix, listing & deleting at the same time
+
+    :param bucket_name: AWS S3 bucket
+    :param prefix: AWS S3 directory or key prefix
+    :param batch_size: keys per DeleteObjects request, at most 1000
+    :param workers: DeleteObjects requests run concurrently
+    :return: dict returned by delete_objects
+    """
+
+    keys = (obj['Key'] for obj in iter_objects(bucket_name, prefix))
+
+    try:
+        return delete_objects(bucket_name, keys, batch_size, workers)
+    finally:
+        _cache.invalidate(bucket_name, prefix=prefix)
+
+
+def delete_folder(bucket_name, object_name, workers=DELETE_WORKERS):
     """Delete a directory from an S3 bucket
 
+    Keys that could not be deleted are logged one by one.
+
     :param bucket_name: AWS S3 bucket
     :param object_name: AWS S3 directory
+    :param workers: DeleteObjects requests run concurrently
     :return: True if the referenced directory was deleted, otherwise False
     """
 
-    objects = []
     if object_name[-1]!='/':
         object_name += '/'
 
-    s3 = boto3.client('s3')
     try:
-        results = s3.list_objects(Bucket=bucket_name, Prefix=object_name)
-        try:
-            for i in results['Contents']:
-                objects.append(i['Key'])
-        except:
-            pass
+        stats = delete_prefix(bucket_name, object_name, workers=workers)
 
-        for obj in objects:
-            s3.delete_object(Bucket=bucket_name, Key=obj)
+        for error in stats['errors']:
+            logging.error('Issue deleting {0} from {1}: {2} {3}'.format(error['Key'], bucket_name, error.get('Code'), error.get('Message')))
 
-        logging.info('{0} was deleted from {1}'.format(object_name, bucket_name))
+        if stats['errors']:
+            logging.error('{0} of {1} objects under {2} were not deleted from {3}'.format(
+                len(stats['errors']), stats['deleted'] + len(stats['errors']), object_name, bucket_name))
+            return False
+
+        logging.info('{0} was deleted from {1}, {2} objects in {3} requests'.format(object_name, bucket_name, stats['deleted'], stats['requests']))
 
     except ClientError as e:
         logging.error(e)
@@ -220,7 +785,6 @@ def folder_exists(bucket_name, object_name=None):
     :return: True if the referenced directory was found, otherwise False
     """
 
-    objects = []
     flag_found = False
 
     if object_name is None:
@@ -228,16 +792,8 @@ def folder_exists(bucket_name, object_name=None):
         return flag_found
 
     else:
-        s3 = boto3.client('s3')
         try:
-            results = s3.list_objects(Bucket=bucket_name, Prefix=object_name)
-            try:
-                for i in results['Contents']:
-                    objects.append(i['Key'])
-            except:
-                pass
-
-            if objects !=[]:
+            if prefix_exists(bucket_name, object_name):
                 flag_found = True
                 logging.info('{0} found in {1}'.format(object_name, bucket_name))
             else:
@@ -249,13 +805,16 @@ def folder_exists(bucket_name, object_name=None):
     return flag_found
 
 
-def upload_file(bucket_name, dir, file_name, object_name=None):
+def upload_file(bucket_name, dir, file_name, object_name=None, config=None, progress=None):
     """Upload a file to an S3 bucket
 
     :param bucket_name: Bucket to upload to
     :param dir: Local directory from where to file to read for upload
     :param file_name: File to upload
     :param object_name: AWS S3 directory name. If not specified then same as file_name
+    :param config: TransferConfig of the upload, see transfer_config. If not specified then the defaults
+    :param progress: TransferProgress or other callback given the bytes sent.
+                     If not specified then the progress is logged at INFO level
     :return: True if file was uploaded, else False
     """
 
@@ -267,15 +826,27 @@ def upload_file(bucket_name, dir, file_name, object_name=None):
 
     file_name = dir + file_name
 
-    s3_client = boto3.client('s3')
+    if progress is None:
+        progress = TransferProgress(object_name, os.path.getsize(file_name) if os.path.exists(file_name) else None)
+
+    if isinstance(progress, TransferProgress):
+        _transfers[(bucket_name, object_name)] = progress
+
+    s3_client = get_client()
     try:
-        response = s3_client.upload_file(file_name, bucket_name, object_name)
+        response = s3_client.upload_file(file_name, bucket_name, object_name, Config=config or transfer_config(), Callback=progress)
         logging.info('File {0} uploaded successfully'.format(file_name))
+        if isinstance(progress, TransferProgress):
+            logging.info(progress.format())
 
     except ClientError as e:
         logging.error(e)
         return False
 
+    finally:
+        _transfers.pop((bucket_name, object_name), None)
+        _cache.invalidate(bucket_name, object_name)
+
     return True
 
 
@@ -292,7 +863,7 @@ def upload_csv(bucket_name, key, body):
     """
 
 
-    s3_client = boto3.client('s3')
+    s3_client = get_client()
     try:
         response = s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
         logging.info('File {0} uploaded successfully'.format(key))
@@ -301,18 +872,24 @@ def upload_csv(bucket_name, key, body):
         logging.error(e)
         return False
 
+    finally:
+        _cache.invalidate(bucket_name, key)
+
     return True
 
 
 
 
-def download_file(bucket_name, dir, file_name, object_name=None):
+def download_file(bucket_name, dir, file_name, object_name=None, config=None, progress=None):
     """Download a file from an S3 bucket
 
     :param bucket_name: Bucket to upload to
     :param dir: Local directory to save the file
     :param file_name: File to download
     :param object_name: AWS S3 directory name. If not specified then same as file_name
+    :param config: TransferConfig of the download, see transfer_config. If not specified then the defaults
+    :param progress: TransferProgress or other callback given the bytes received.
+                     If not specified then the progress is logged at INFO level
     :return: True if file was downloaded, else False
     """
 
@@ -328,10 +905,18 @@ def download_file(bucket_name, dir, file_name, object_name=None):
 
         file_name = dir + file_name
 
-    s3 = boto3.resource('s3')
+    if progress is None:
+        progress = TransferProgress(object_name)
+
+    if isinstance(progress, TransferProgress):
+        _transfers[(bucket_name, object_name)] = progress
+
+    s3 = get_client()
     try:
-        s3.Bucket(bucket_name).download_file(object_name, file_name)
+        s3.download_file(bucket_name, object_name, file_name, Config=config or transfer_config(), Callback=progress)
         logging.info('Successfully downloaded {0} from {1}'.format(object_name, bucket_name))
+        if isinstance(progress, TransferProgress):
+            logging.info(progress.format())
 
     except ClientError as e:
         if e.response['Error']['Code'] == "404":
@@ -340,38 +925,39 @@ def download_file(bucket_name, dir, file_name, object_name=None):
             logging.error(e)
         return False
 
+    finally:
+        _transfers.pop((bucket_name, object_name), None)
+
     return True
 
 
 def delete_file(bucket_name, file_name, object_name=None):
     """Delete an file from an S3 bucket
 
+    S3 is strongly consistent, a delete that succeeds is not checked with
+    another request. The file is remembered as gone by the metadata cache.
+
     :param bucket_name: AWS S3 Bucket
     :param file_name: File to be deleted
     :param object_name: AWS S3 directory name. If not specified then same as file_name
     :return: True if the referenced object was deleted, otherwise False
     """
 
-    orig_file_name = file_name
-    orig_object_name = object_name
-
     # If S3 object_name was not specified, use file_name
     if object_name:
         object_name += file_name
     else:
         object_name = file_name
 
-    s3 = boto3.client('s3')
+    s3 = get_client()
     try:
         s3.delete_object(Bucket=bucket_name, Key=object_name)
-
-        if file_exists(bucket_name, orig_file_name, orig_object_name):
-            logging.error('Issue deleting {0} from {1}'.format(object_name, bucket_name))
-            return False
-        else:
-            logging.info('{0} was deleted from {1}'.format(object_name, bucket_name))
+        _cache.invalidate(bucket_name, object_name)
+        _cache.put_object(bucket_name, object_name, None)
+        logging.info('{0} was deleted from {1}'.format(object_name, bucket_name))
 
     except ClientError as e:
+        _cache.invalidate(bucket_name, object_name)
         logging.error(e)
         return False
 
@@ -381,13 +967,15 @@ def delete_file(bucket_name, file_name, object_name=None):
 def file_exists(bucket_name, file_name, object_name=None):
     """Search for a file in an S3 bucket
 
+    The exact key is looked up with HEAD, so a.csv is not found because of
+    a.csv.bak. Answers are cached, see MetadataCache.
+
     :param bucket_name: AWS S3 Bucket
     :param file_name: File to be searched
     :param object_name: AWS S3 directory name. If not specified then same as file_name
-    :return: True if the referenced object was deleted, otherwise False
+    :return: True if the referenced object was found, otherwise False
     """
 
-    objects = []
     flag_found = False
 
     # If S3 object_name was not specified, use file_name
@@ -396,16 +984,8 @@ def file_exists(bucket_name, file_name, object_name=None):
     else:
         object_name = file_name
 
-    s3 = boto3.client('s3')
     try:
-        results = s3.list_objects(Bucket=bucket_name, Prefix=object_name)
-        try:
-            for i in results['Contents']:
-                objects.append(i['Key'])
-        except:
-            pass
-
-        if objects !=[]:
+        if head_object(bucket_name, object_name) is not None:
             flag_found = True
             logging.info('{0} found in {1}'.format(object_name, bucket_name))
         else:
@@ -427,6 +1007,10 @@ def main():
     parser.add_argument('-f', '--file_name', dest='file_name', help='File name\n\n', required=False, default=None)
     parser.add_argument('-r', '--region', dest='region', help='AWS bucket region to be provided for bucket creation\n\n', required=False, default=None)
     parser.add_argument('-rd', '--remote_dir', dest='remote_dir', help='AWS directory to be created\n\n', required=False, default=None)
+    parser.add_argument('-pl', '--parallel', dest='parallel', type=int, help='Threads listing the sub-directories of -o OBJECT_NAME concurrently with -oo list, 0 to list in one sequence\n\n', required=False, default=0)
+    parser.add_argument('-mt', '--multipart_threshold', dest='multipart_threshold', type=float, help='File size in MB from which uploads & downloads are done in parts\n\n', required=False, default=MULTIPART_THRESHOLD / MB)
+    parser.add_argument('-cs', '--chunk_size', dest='chunk_size', type=float, help='Part size in MB of multipart uploads & downloads, 5 MB & up\n\n', required=False, default=MULTIPART_CHUNKSIZE / MB)
+    parser.add_argument('-mc', '--max_concurrency', dest='max_concurrency', type=int, help='Parts uploaded or downloaded concurrently\n\n', required=False, default=MAX_CONCURRENCY)
     parser.add_argument('-l', '--log_level', dest='log_lvl', choices=['NOTSET', 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help='Logging level to create logs\n\n', default='WARNING')
 
     group = parser.add_mutually_exclusive_group(required=True)
@@ -442,6 +1026,8 @@ def main():
     file_name        = args.file_name
     region           = args.region
     remote_dir       = args.remote_dir
+    parallel         = args.parallel
+    config           = transfer_config(int(args.multipart_threshold * MB), int(args.chunk_size * MB), args.max_concurrency)
     bucket_operation = args.bucket_operation
     object_operation = args.object_operation
     file_operation   = args.file_operation
@@ -479,6 +1065,10 @@ def main():
     elif file_operation in ['delete', 'exists'] and (not(bucket_name) or not(file_name)):
         parser.error('-b BUCKET_NAME -f FILE_NAME are mandatory & -o OBJECT_NAME  is optional with -fo {delete,exists}')
 
+    # One pooled connection per part in flight
+    if args.max_concurrency > MAX_POOL_CONNECTIONS:
+        configure_clients(max_pool_connections=args.max_concurrency)
+
     # Add '/' to directory strings if not already present at the end
     if object_name and object_name[-1]!='/':
         object_name += '/'
@@ -515,13 +1105,20 @@ def main():
 
     if object_operation == 'list':
 
-        objects = list_objects(bucket_name, object_name)
+        # Keys are printed as the pages arrive
+        count = 0
+        try:
+            for obj in iter_objects(bucket_name, object_name, parallel=parallel):
+                if not count:
+                    print('\n\nObject List: \n')
+                print(obj['Key'])
+                count += 1
+
+        except ClientError as e:
+            logging.error(e)
 
-        if objects != []:
-            print('\n\nObject List: \n')
-            for obj in objects:
-                print(obj)
-            print('\n\n')
+        if count:
+            print('\n{0} objects\n\n'.format(count))
         else:
             print_stmt = 'No objects found'
 
@@ -548,14 +1145,18 @@ def main():
 
     if file_operation == 'upload':
 
-        if upload_file(bucket_name, dir, file_name, object_name):
+        progress = TransferProgress(file_name, os.path.getsize(dir + file_name) if os.path.exists(dir + file_name) else None, report=print)
+        if upload_file(bucket_name, dir, file_name, object_name, config, progress):
+            print(progress.format())
             print_stmt = 'upload_file operation successful'
         else:
             print_stmt = 'upload_file operation not successful'
 
     if file_operation == 'download':
 
-        if download_file(bucket_name, dir, file_name, object_name):
+        progress = TransferProgress(file_name, report=print)
+        if download_file(bucket_name, dir, file_name, object_name, config, progress):
+            print(progress.format())
             print_stmt = 'download_file operation successful'
         else:
             print_stmt = 'download_file operation not successful'
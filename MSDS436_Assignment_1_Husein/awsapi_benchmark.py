@@ -0,0 +1,682 @@
+#***********************************************
+# File: awsapi_benchmark.py
+# Desc: Offline benchmark of the awsapi S3 operations
+# Purpose: Perform following operation:
+#          1. Serve a local, in-memory S3 stand-in with optional latency
+#          2. Point the awsapi clients at it
+#          3. Time the operations with a new client per call against the
+#             pooled clients of awsapi
+#          4. Time the listing of a large daily object_name/YYYYMMDD/ layout,
+#             in one sequence & across the days in parallel
+#          5. Time folder deletes one key at a time against concurrent
+#             DeleteObjects batches
+#          6. Count the requests of repeated existence checks by prefix
+#             listing, HEAD & the metadata cache
+#          7. Sweep the multipart threshold, part size & concurrency of
+#             uploads & downloads, with parts failing at a given rate
+#************************************************/
+
+# pip3 install --user pandas
+
+import os
+import time
+import uuid
+import random
+import tempfile
+import bisect
+import hashlib
+import threading
+import xml.etree.ElementTree as ET
+import numpy as np
+import pandas as pd
+from xml.sax.saxutils import escape
+from urllib.parse import urlsplit, unquote, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from argparse import RawTextHelpFormatter
+import awsapi
+
+XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+def _xml(tag, children):
+    # children is a list of (tag, text or list) pairs
+    body = ''
+    for child, value in children:
+        body += _xml(child, value) if isinstance(value, list) else '<{0}>{1}</{0}>'.format(child, escape(str(value)))
+
+    return '<{0}>{1}</{0}>'.format(tag, body)
+
+
+class _StubS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body=b'', headers=None):
+        if isinstance(body, str):
+            body = ('<?xml version="1.0" encoding="UTF-8"?>' + body).encode('utf-8')
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.server.stub.throttle(len(body))
+            self.wfile.write(body)
+
+    def _error(self, code, error):
+        self._send(code, _xml('Error', [('Code', error), ('Message', error)]))
+
+    def _route(self):
+        # Path style addressing: /bucket/key
+        self.server.stub.count(self.command)
+        if self.server.stub.latency:
+            time.sleep(self.server.stub.latency)
+
+        url = urlsplit(self.path)
+        parts = unquote(url.path).lstrip('/').split('/', 1)
+        query = dict([(k, v[0]) for k, v in parse_qs(url.query, keep_blank_values=True).items()])
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.stub.throttle(len(body))
+
+        return parts[0], parts[1] if len(parts) > 1 else '', query, body
+
+    def do_GET(self):
+        bucket, key, query, body = self._route()
+        stub = self.server.stub
+
+        if not bucket:
+            buckets = [('Bucket', [('Name', b), ('CreationDate', '2022-01-01T00:00:00.000Z')]) for b in sorted(stub.buckets)]
+            return self._send(200, _xml('ListAllMyBucketsResult', [('Owner', [('ID', 'stub')]), ('Buckets', buckets)]))
+
+        if bucket not in stub.buckets:
+            return self._error(404, 'NoSuchBucket')
+
+        if not key:
+            return self._send(200, stub.list_xml(bucket, query))
+
+        obj = stub.buckets[bucket].get(key)
+        if obj is None:
+            return self._error(404, 'NoSuchKey')
+
+        code, headers = 200, {'ETag': stub.object_etag(bucket, key), 'Last-Modified': 'Sat, 01 Jan 2022 00:00:00 GMT'}
+        rng = self.headers.get('Range')
+        if rng:
+            start, end = rng.split('=')[1].split('-')
+            end = min(int(end) if end else len(obj) - 1, len(obj) - 1)
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, end, len(obj))
+            code, obj = 206, obj[int(start):end + 1]
+
+        if stub.failing():
+            # Cut the body short & drop the connection, as a reset mid-download
+            self.send_response(code)
+            self.send_header('Content-Length', str(len(obj)))
+            self.end_headers()
+            self.wfile.write(obj[:len(obj) // 2])
+            self.close_connection = True
+            return
+
+        self._send(code, obj, headers)
+
+    def do_HEAD(self):
+        bucket, key, query, body = self._route()
+        stub = self.server.stub
+
+        if bucket not in stub.buckets:
+            return self._send(404)
+        if not key:
+            return self._send(200)
+
+        obj = stub.buckets[bucket].get(key)
+        if obj is None:
+            return self._send(404)
+
+        # HEAD answers carry the size of the object, _send writes no body for them
+        self._send(200, obj, {'ETag': stub.object_etag(bucket, key), 'Last-Modified': 'Sat, 01 Jan 2022 00:00:00 GMT'})
+
+    def do_PUT(self):
+        bucket, key, query, body = self._route()
+        stub = self.server.stub
+
+        if not key:
+            stub.buckets.setdefault(bucket, {})
+            return self._send(200)
+        if bucket not in stub.buckets:
+            return self._error(404, 'NoSuchBucket')
+        if stub.failing():
+            return self._error(500, 'InternalError')
+
+        if 'uploadId' in query:
+            if query['uploadId'] not in stub.uploads:
+                return self._error(404, 'NoSuchUpload')
+            stub.uploads[query['uploadId']][int(query['partNumber'])] = body
+        else:
+            stub.put(bucket, key, body)
+        self._send(200, headers={'ETag': stub.etag(body)})
+
+    def do_DELETE(self):
+        bucket, key, query, body = self._route()
+        stub = self.server.stub
+
+        if bucket not in stub.buckets:
+            return self._error(404, 'NoSuchBucket')
+        if not key:
+            if stub.buckets[bucket]:
+                return self._error(409, 'BucketNotEmpty')
+            del stub.buckets[bucket]
+            return self._send(204)
+        if 'uploadId' in query:
+            stub.uploads.pop(query['uploadId'], None)
+            return self._send(204)
+
+        stub.remove(bucket, [key])
+        time.sleep(stub.key_latency)
+        self._send(204)
+
+
+    def do_POST(self):
+        bucket, key, query, body = self._route()
+        stub = self.server.stub
+
+        if bucket not in stub.buckets:
+            return self._error(404, 'NoSuchBucket')
+
+        # Multipart uploads: create, then complete with the parts in order
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            stub.uploads[upload_id] = {}
+            return self._send(200, _xml('InitiateMultipartUploadResult', [('Bucket', bucket), ('Key', key), ('UploadId', upload_id)]))
+
+        if 'uploadId' in query:
+            parts = stub.uploads.pop(query['uploadId'], None)
+            if parts is None:
+                return self._error(404, 'NoSuchUpload')
+            root = ET.fromstring(body)
+            numbers = [int(e.text) for e in root.iter() if e.tag.endswith('PartNumber')]
+            data = b''.join([parts[n] for n in numbers])
+            etag = '"{0}-{1}"'.format(hashlib.md5(b''.join([hashlib.md5(parts[n]).digest() for n in numbers])).hexdigest(), len(numbers))
+            stub.put(bucket, key, data, etag)
+            return self._send(200, _xml('CompleteMultipartUploadResult', [('Bucket', bucket), ('Key', key), ('ETag', etag)]))
+
+        if 'delete' not in query:
+            return self._error(501, 'NotImplemented')
+
+        # DeleteObjects, keys listed in fail_keys are answered with AccessDenied
+        root = ET.fromstring(body)
+        ns = {'s3': XMLNS} if root.tag.startswith('{') else {}
+        find = (lambda e, tag: e.findall('s3:' + tag, ns)) if ns else (lambda e, tag: e.findall(tag))
+        keys = [find(obj, 'Key')[0].text for obj in find(root, 'Object')]
+        quiet = [q.text for q in find(root, 'Quiet')] == ['true']
+
+        failed = [k for k in keys if k in stub.fail_keys]
+        stub.remove(bucket, [k for k in keys if k not in stub.fail_keys])
+        time.sleep(stub.key_latency * len(keys))
+
+        children = [] if quiet else [('Deleted', [('Key', k)]) for k in keys if k not in stub.fail_keys]
+        children += [('Error', [('Key', k), ('Code', 'AccessDenied'), ('Message', 'Access Denied')]) for k in failed]
+        self._send(200, _xml('DeleteResult', children))
+
+
+class StubS3(object):
+    """In-memory S3 stand-in serving the calls made by awsapi
+
+    Buckets, objects, ranged gets, multipart uploads, DeleteObjects & both
+    versions of ListObjects are supported with path style addressing. Every request can be delayed to
+    mimic the round trip to AWS. The keys of a bucket are kept sorted
+    between writes, so pages are listed in constant time whatever the
+    bucket holds.
+
+    :param latency: milliseconds added to every request
+    :param key_latency: milliseconds spent per key deleted, S3 takes longer
+                        to answer a DeleteObjects of many keys
+    :param bandwidth: MB/s of each connection, 0 for no limit. S3 serves a
+                      single connection at a fraction of what the network
+                      carries, parts in parallel add up
+    :param fail_rate: share of object & part uploads answered with a 500 &
+                      of downloads cut short, to exercise the retries
+    :param port: port to listen on, 0 for any free port
+    """
+
+    def __init__(self, latency=0.0, key_latency=0.0, bandwidth=0.0, fail_rate=0.0, port=0):
+        self.latency = latency / 1000.0
+        self.key_latency = key_latency / 1000.0
+        self.buckets = {}
+        self.requests = {}
+        self.sorted = {}
+        self.etags = {}
+        self.fail_keys = set()
+        self.bandwidth = bandwidth * awsapi.MB
+        self.fail_rate = fail_rate
+        self.uploads = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), _StubS3Handler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def throttle(self, nbytes):
+        if self.bandwidth and nbytes:
+            time.sleep(nbytes / self.bandwidth)
+
+    def failing(self):
+        return self.fail_rate > 0 and random.random() < self.fail_rate
+
+    def etag(self, body):
+        return '"{0}"'.format(hashlib.md5(body).hexdigest())
+
+    def put(self, bucket, key, body, etag=None):
+        etag = etag or self.etag(body)
+        with self.lock:
+            self.buckets[bucket][key] = body
+            self.etags[(bucket, key)] = etag
+            self.sorted.pop(bucket, None)
+
+    def remove(self, bucket, keys):
+        with self.lock:
+            for key in keys:
+                self.buckets[bucket].pop(key, None)
+                self.etags.pop((bucket, key), None)
+            self.sorted.pop(bucket, None)
+
+    def object_etag(self, bucket, key):
+        # Kept from the write, so large objects are not hashed on every read
+        with self.lock:
+            if (bucket, key) not in self.etags:
+                self.etags[(bucket, key)] = self.etag(self.buckets[bucket].get(key, b''))
+            return self.etags[(bucket, key)]
+
+    def sorted_keys(self, bucket):
+        with self.lock:
+            if bucket not in self.sorted:
+                self.sorted[bucket] = sorted(self.buckets[bucket])
+            return self.sorted[bucket]
+
+    def list_xml(self, bucket, query):
+        # ListObjects (v1 marker) & ListObjectsV2 (continuation token) over the sorted keys
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter', '')
+        max_keys = int(query.get('max-keys', 1000))
+        v2 = query.get('list-type') == '2'
+        after = query.get('continuation-token') or query.get('start-after', '') if v2 else query.get('marker', '')
+
+        keys = self.sorted_keys(bucket)
+        start = max(bisect.bisect_left(keys, prefix), bisect.bisect_right(keys, after))
+
+        contents, prefixes, last, truncated = [], [], None, False
+        for k in (keys[i] for i in range(start, len(keys))):
+            if not k.startswith(prefix):
+                break
+
+            common = None
+            if delimiter and delimiter in k[len(prefix):]:
+                common = prefix + k[len(prefix):].split(delimiter)[0] + delimiter
+                if prefixes and prefixes[-1] == common:
+                    last = k
+                    continue
+
+            if len(contents) + len(prefixes) >= max_keys:
+                truncated = True
+                break
+
+            if common:
+                prefixes.append(common)
+            else:
+                obj = self.buckets[bucket].get(k, b'')
+                contents.append(('Contents', [('Key', k), ('LastModified', '2022-01-01T00:00:00.000Z'), ('ETag', self.object_etag(bucket, k)),
+                                              ('Size', len(obj)), ('StorageClass', 'STANDARD')]))
+            last = k
+
+        children = [('Name', bucket), ('Prefix', prefix), ('MaxKeys', max_keys), ('IsTruncated', str(truncated).lower())]
+        if delimiter:
+            children.append(('Delimiter', delimiter))
+        if v2:
+            children.append(('KeyCount', len(contents) + len(prefixes)))
+            if truncated:
+                children.append(('NextContinuationToken', last))
+        elif truncated:
+            children.append(('NextMarker', last))
+
+        children += contents + [('CommonPrefixes', [('Prefix', p)]) for p in prefixes]
+
+        return _xml('ListBucketResult', children).replace('<ListBucketResult>', '<ListBucketResult xmlns="{0}">'.format(XMLNS), 1)
+
+    def environ(self):
+        """Environment pointing boto3 at the stand-in with dummy credentials"""
+
+        return {'AWS_ENDPOINT_URL_S3': self.url,
+                'AWS_ACCESS_KEY_ID': 'stub',
+                'AWS_SECRET_ACCESS_KEY': 'stub',
+                'AWS_DEFAULT_REGION': 'us-east-1',
+                'AWS_REQUEST_CHECKSUM_CALCULATION': 'when_required'}
+
+
+def use_stub(stub):
+    """Send the awsapi calls of this process to a StubS3"""
+
+    os.environ.update(stub.environ())
+    for var in ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE'):
+        os.environ.pop(var, None)
+
+    awsapi._sessions.clear()
+    awsapi.clear_clients()
+
+
+def percentiles(seconds):
+    ms = np.array(seconds) * 1000.0
+    return {'mean ms': ms.mean(), 'p50 ms': np.percentile(ms, 50), 'p95 ms': np.percentile(ms, 95)}
+
+
+def bench_calls(bucket, calls, fresh, threads=1):
+    """Time awsapi operations
+
+    :param bucket: bucket of the stand-in holding the objects
+    :param calls: number of calls of each operation
+    :param fresh: drop the cached clients before every call, as when each
+                  operation created its own client
+    :param threads: threads calling the operations concurrently
+    :return: dataframe with the latency of each operation
+    """
+
+    ops = [('bucket_exists', lambda i: awsapi.bucket_exists(bucket)),
+           ('file_exists', lambda i: awsapi.file_exists(bucket, 'data/file{0}.csv'.format(i % 10))),
+           ('upload_csv', lambda i: awsapi.upload_csv(bucket, 'data/file{0}.csv'.format(i % 10), 'a,b\n1,2\n')),
+           ('list_objects', lambda i: awsapi.list_objects(bucket, 'data/'))]
+
+    def timed(op, i):
+        st_time = time.perf_counter()
+        if fresh:
+            awsapi.clear_clients()
+        op(i)
+        return time.perf_counter() - st_time
+
+    # Every call goes to the stand-in, see bench_exists for the metadata cache
+    awsapi.configure_cache(ttl=0)
+
+    rows = []
+    for name, op in ops:
+        op(0)
+        st_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            seconds = list(pool.map(lambda i: timed(op, i), range(calls)))
+        wall = time.perf_counter() - st_time
+
+        row = {'clients': 'new per call' if fresh else 'pooled', 'operation': name, 'threads': threads}
+        row.update(percentiles(seconds))
+        row['calls/s'] = calls / wall
+        rows.append(row)
+
+    awsapi.configure_cache()
+
+    return pd.DataFrame(rows)
+
+
+def populate(stub, bucket, prefix, keys, days):
+    """Fill the stand-in with empty objects spread over daily directories
+
+    :return: list of the keys written
+    """
+
+    names = ['{0}{1:%Y%m%d}/file{2:07d}.csv'.format(prefix, pd.Timestamp('2022-01-01') + pd.Timedelta(days=i % days), i)
+             for i in range(keys)]
+    with stub.lock:
+        stub.buckets[bucket].update(dict.fromkeys(names, b''))
+        stub.sorted.pop(bucket, None)
+
+    return names
+
+
+def bench_listing(stub, bucket, prefix, parallels):
+    """Time the listing of every key under a prefix
+
+    The single ListObjects call the helpers used to make is timed first, to
+    show how much of the prefix it missed.
+
+    :param parallels: threads of the parallel listings, 0 for one sequence
+    :return: dataframe with keys listed, requests & keys/s of each listing
+    """
+
+    s3 = awsapi.get_client()
+    listings = [('single list_objects call', lambda: [o['Key'] for o in s3.list_objects(Bucket=bucket, Prefix=prefix).get('Contents', [])])]
+    for parallel in parallels:
+        listings.append(('iter_objects parallel={0}'.format(parallel),
+                         lambda parallel=parallel: [o['Key'] for o in awsapi.iter_objects(bucket, prefix, parallel=parallel)]))
+
+    rows = []
+    for name, listing in listings:
+        before = sum(stub.requests.values())
+        st_time = time.perf_counter()
+        keys = listing()
+        seconds = time.perf_counter() - st_time
+
+        rows.append({'listing': name, 'keys': len(keys), 'unique': len(set(keys)),
+                     'requests': sum(stub.requests.values()) - before, 'seconds': seconds, 'keys/s': len(keys) / seconds})
+
+    return pd.DataFrame(rows)
+
+
+def bench_delete(stub, bucket, keys, days, workers):
+    """Time the delete of a folder, refilled before each run
+
+    :param workers: DeleteObjects requests run concurrently, one run per
+                    value, 0 for the delete_object loop the helpers used to run
+    :return: dataframe with keys deleted, requests & keys/s of each run
+    """
+
+    s3 = awsapi.get_client()
+
+    def one_by_one():
+        deleted = 0
+        for obj in awsapi.iter_objects(bucket, 'old/'):
+            s3.delete_object(Bucket=bucket, Key=obj['Key'])
+            deleted += 1
+        return {'deleted': deleted, 'errors': []}
+
+    runs = []
+    for n in workers:
+        if n:
+            runs.append(('delete_prefix workers={0}'.format(n), lambda n=n: awsapi.delete_prefix(bucket, 'old/', workers=n)))
+        else:
+            runs.append(('delete_object per key', one_by_one))
+
+    rows = []
+    for name, run in runs:
+        populate(stub, bucket, 'old/', keys, days)
+        before = sum(stub.requests.values())
+        st_time = time.perf_counter()
+        stats = run()
+        seconds = time.perf_counter() - st_time
+
+        requests = sum(stub.requests.values()) - before
+
+        rows.append({'delete': name, 'deleted': stats['deleted'], 'failed': len(stats['errors']),
+                     'left': len(awsapi.list_objects(bucket, 'old/')),
+                     'requests': requests, 'seconds': seconds, 'keys/s': stats['deleted'] / seconds})
+
+    return pd.DataFrame(rows)
+
+
+def bench_exists(stub, bucket, checks, files):
+    """Time repeated file & folder existence checks
+
+    The prefix listing the helpers used to run is timed first, then the
+    HEAD & one key probes without & with the metadata cache. Half the
+    files checked do not exist, only a .bak copy of them does.
+
+    :param checks: existence checks of each kind
+    :param files: distinct files checked, half of them present
+    :return: dataframe with requests & time per check, and the wrong answers
+    """
+
+    for i in range(files):
+        stub.put(bucket, 'exists/{0:04d}/file{1}.csv'.format(i % 10, i) + ('' if i % 2 == 0 else '.bak'), b'a,b\n1,2\n')
+
+    s3 = awsapi.get_client()
+
+    def listed(prefix):
+        return 'Contents' in s3.list_objects(Bucket=bucket, Prefix=prefix)
+
+    file_checks = [('exists/{0:04d}/'.format(i % 10), 'file{0}.csv'.format(i), i % 2 == 0) for i in range(files)]
+    ways = [('list_objects by prefix', 0, lambda f: listed(f[0] + f[1]), lambda d: listed(d)),
+            ('head_object, no cache', 0, lambda f: awsapi.file_exists(bucket, f[1], f[0]), lambda d: awsapi.folder_exists(bucket, d)),
+            ('head_object, cached', awsapi.CACHE_TTL, lambda f: awsapi.file_exists(bucket, f[1], f[0]), lambda d: awsapi.folder_exists(bucket, d))]
+
+    rows = []
+    for name, ttl, file_check, folder_check in ways:
+        awsapi.configure_cache(ttl=ttl)
+        for kind, check, answers in (('file', file_check, [(f, f[2]) for f in file_checks]),
+                                     ('folder', folder_check, [('exists/{0:04d}/'.format(i % 20), i % 20 < 10) for i in range(20)])):
+            before = sum(stub.requests.values())
+            wrong = 0
+            st_time = time.perf_counter()
+            for i in range(checks):
+                item, expected = answers[i % len(answers)]
+                wrong += check(item) != expected
+            seconds = time.perf_counter() - st_time
+
+            rows.append({'check': name, 'kind': kind, 'checks': checks, 'wrong': wrong,
+                         'requests/check': (sum(stub.requests.values()) - before) / checks, 'us/check': seconds / checks * 1e6})
+
+    awsapi.configure_cache()
+
+    return pd.DataFrame(rows)
+
+
+def bench_transfer(bucket, size_mb, thresholds, chunk_sizes, concurrencies):
+    """Upload & download a file with every combination of the transfer settings
+
+    :param size_mb: size of the file transferred in MB
+    :param thresholds: multipart thresholds in MB
+    :param chunk_sizes: part sizes in MB
+    :param concurrencies: parts transferred concurrently
+    :return: dataframe with the MB/s & parts retried of each transfer
+    """
+
+    tmp = tempfile.mkdtemp()
+    data = os.urandom(size_mb * awsapi.MB)
+    with open(os.path.join(tmp, 'upload.bin'), 'wb') as f:
+        f.write(data)
+
+    rows = []
+    for threshold in thresholds:
+        # Below the threshold the file goes in one request, the parts do not matter
+        for chunk_size in chunk_sizes if threshold < size_mb else chunk_sizes[:1]:
+            for concurrency in concurrencies if threshold < size_mb else concurrencies[:1]:
+                awsapi.configure_clients(max_pool_connections=max(awsapi.MAX_POOL_CONNECTIONS, concurrency))
+                config = awsapi.transfer_config(int(threshold * awsapi.MB), int(chunk_size * awsapi.MB), concurrency)
+
+                for direction in ('upload', 'download'):
+                    progress = awsapi.TransferProgress('transfer', size_mb * awsapi.MB, interval=None)
+                    if direction == 'upload':
+                        ok = awsapi.upload_file(bucket, tmp + '/', 'upload.bin', 'transfer/', config, progress)
+                    else:
+                        ok = awsapi.download_file(bucket, tmp + '/download/', 'upload.bin', 'transfer/', config, progress)
+                        if ok:
+                            with open(os.path.join(tmp, 'download', 'upload.bin'), 'rb') as f:
+                                ok = f.read() == data
+
+                    summary = progress.summary()
+                    rows.append({'direction': direction, 'threshold MB': threshold,
+                                 'part MB': chunk_size if threshold < size_mb else '-',
+                                 'concurrency': concurrency if threshold < size_mb else '-',
+                                 'ok': ok, 'MB/s': summary['bytes_per_s'] / awsapi.MB, 'seconds': summary['seconds'],
+                                 'parts retried': summary['parts_retried']})
+
+    awsapi.configure_clients()
+
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = ArgumentParser(formatter_class=RawTextHelpFormatter, prog='awsapi_benchmark.py', description='Benchmarks the awsapi S3 operations against a local S3 stand-in. \n ')
+
+    parser.add_argument('-s', '--suite', dest='suite', nargs='+', choices=['clients', 'listing', 'delete', 'exists', 'transfer'], default=['clients', 'listing', 'delete', 'exists', 'transfer'], help='Benchmarks to run')
+    parser.add_argument('-n', '--calls', dest='calls', type=int, default=200, help='Calls of each operation')
+    parser.add_argument('-t', '--threads', dest='threads', type=int, nargs='+', default=[1, 8], help='Threads calling the operations, one run per value')
+    parser.add_argument('-sl', '--stub_latency', dest='stub_latency', type=float, default=0.0, help='Milliseconds added to every request of the stand-in')
+    parser.add_argument('-k', '--keys', dest='keys', type=int, default=100000, help='Keys listed by the listing benchmark')
+    parser.add_argument('-dy', '--days', dest='days', type=int, default=60, help='Daily directories the keys are spread over')
+    parser.add_argument('-pl', '--parallel', dest='parallel', type=int, nargs='+', default=[0, 4, 16], help='Threads of the parallel listings, 0 to list in one sequence')
+    parser.add_argument('-dk', '--delete_keys', dest='delete_keys', type=int, default=5000, help='Keys deleted by the delete benchmark')
+    parser.add_argument('-dw', '--delete_workers', dest='delete_workers', type=int, nargs='+', default=[0, 1, 8], help='Concurrent DeleteObjects requests, one run per value, 0 for one delete_object per key')
+    parser.add_argument('-ec', '--exists_checks', dest='exists_checks', type=int, default=2000, help='Existence checks of each kind')
+    parser.add_argument('-ef', '--exists_files', dest='exists_files', type=int, default=200, help='Distinct files the existence checks go over')
+    parser.add_argument('-ts', '--transfer_size', dest='transfer_size', type=int, default=64, help='MB of the file uploaded & downloaded by the transfer benchmark')
+    parser.add_argument('-mt', '--thresholds', dest='thresholds', type=float, nargs='+', default=[1024, 8], help='Multipart thresholds in MB, one run per value')
+    parser.add_argument('-cs', '--chunk_sizes', dest='chunk_sizes', type=float, nargs='+', default=[5, 8, 16], help='Part sizes in MB, one run per value')
+    parser.add_argument('-mc', '--max_concurrency', dest='max_concurrency', type=int, nargs='+', default=[1, 4, 10], help='Parts transferred concurrently, one run per value')
+    parser.add_argument('-bw', '--bandwidth', dest='bandwidth', type=float, default=0.0, help='MB/s of each connection of the stand-in, 0 for no limit')
+    parser.add_argument('-fr', '--fail_rate', dest='fail_rate', type=float, default=0.0, help='Share of uploads answered with a 500 & of downloads cut short by the stand-in')
+    parser.add_argument('-kl', '--key_latency', dest='key_latency', type=float, default=0.0, help='Milliseconds the stand-in spends per key deleted')
+    parser.add_argument('-mp', '--max_pool', dest='max_pool', type=int, default=awsapi.MAX_POOL_CONNECTIONS, help='max_pool_connections of the pooled clients')
+
+    args = parser.parse_args()
+
+    stub = StubS3(args.stub_latency, args.key_latency, args.bandwidth).start()
+    use_stub(stub)
+    awsapi.configure_clients(max_pool_connections=args.max_pool)
+
+    bucket = 'awsapi-benchmark'
+    awsapi.create_bucket(bucket, 'us-east-1')
+
+    pd.set_option('display.width', 200)
+    float_format = lambda v: '{0:,.2f}'.format(v)
+
+    if 'clients' in args.suite:
+        results = []
+        for threads in args.threads:
+            for fresh in (True, False):
+                results.append(bench_calls(bucket, args.calls, fresh, threads))
+
+        report = pd.concat(results, ignore_index=True)
+        print('\nS3 operations over {0} calls, stand-in latency {1:.0f} ms\n'.format(args.calls, args.stub_latency))
+        print(report.to_string(index=False, float_format=float_format))
+
+    if 'listing' in args.suite:
+        populate(stub, bucket, 'tweets/', args.keys, args.days)
+        report = bench_listing(stub, bucket, 'tweets/', args.parallel)
+        print('\nListing {0:,} keys over {1} daily directories, stand-in latency {2:.0f} ms\n'.format(args.keys, args.days, args.stub_latency))
+        print(report.to_string(index=False, float_format=float_format))
+
+    if 'delete' in args.suite:
+        report = bench_delete(stub, bucket, args.delete_keys, args.days, args.delete_workers)
+        print('\nDeleting {0:,} keys, stand-in latency {1:.0f} ms + {2:.2f} ms per key\n'.format(args.delete_keys, args.stub_latency, args.key_latency))
+        print(report.to_string(index=False, float_format=float_format))
+
+    if 'exists' in args.suite:
+        report = bench_exists(stub, bucket, args.exists_checks, args.exists_files)
+        print('\n{0:,} existence checks over {1} files, stand-in latency {2:.0f} ms\n'.format(args.exists_checks, args.exists_files, args.stub_latency))
+        print(report.to_string(index=False, float_format=float_format))
+
+    if 'transfer' in args.suite:
+        stub.fail_rate = args.fail_rate
+        report = bench_transfer(bucket, args.transfer_size, args.thresholds, args.chunk_sizes, args.max_concurrency)
+        stub.fail_rate = 0.0
+        print('\nTransfers of {0} MB, stand-in latency {1:.0f} ms, {2} per connection, {3:.0%} of requests failing\n'.format(
+            args.transfer_size, args.stub_latency, '{0:.0f} MB/s'.format(args.bandwidth) if args.bandwidth else 'no limit', args.fail_rate))
+        print(report.to_string(index=False, float_format=float_format))
+
+    print('\n{0} requests served by the stand-in'.format(sum(stub.requests.values())))
+
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
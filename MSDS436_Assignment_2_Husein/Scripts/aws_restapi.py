@@ -8,7 +8,7 @@
 #          4. Bucket exists
 #          5. List Objects
 #          6. Create folder
-#          7. Delete folder
+#          7. Delete folder, with the concurrent DeleteObjects batches of awsapi
 #          8. Folder exists
 #          9. Upload file
 #          10. Download file
@@ -26,6 +26,7 @@ from argparse import ArgumentParser
 from argparse import RawTextHelpFormatter
 from flask import Flask, request, jsonify
 from flask_restful import Resource, Api
+import awsapi
 
 app = Flask(__name__)
 
@@ -319,24 +320,19 @@ def delete_folder():
         response = jsonify({"status" : 'folder name must be provided for deletion'})
         response.status_code = 400
     else:
-        objects = []
-        s3 = boto3.client('s3')
         try:
             if object_name[-1]!='/':
                 object_name += '/'
 
-            results = s3.list_objects(Bucket=bucket_name, Prefix=object_name)
-            try:
-                for i in results['Contents']:
-                    objects.append(i['Key'])
-            except:
-                pass
+            # Pages of keys are deleted with DeleteObjects batches while the listing goes on
+            stats = awsapi.delete_prefix(bucket_name, object_name)
 
-            if objects !=[]:
-                for obj in objects:
-                    s3.delete_object(Bucket=bucket_name, Key=obj)
-
-                response = jsonify({"bucket_name": bucket_name, "object_name" : object_name, "status" : 'folder deletion successful'})
+            if stats['errors']:
+                failed = [{"key": e['Key'], "code": e.get('Code'), "message": e.get('Message')} for e in stats['errors']]
+                response = jsonify({"bucket_name": bucket_name, "object_name" : object_name, "status" : 'folder deletion partially failed', "deleted": stats['deleted'], "failed": failed})
+                response.status_code = 400
+            elif stats['deleted']:
+                response = jsonify({"bucket_name": bucket_name, "object_name" : object_name, "status" : 'folder deletion successful', "deleted": stats['deleted']})
                 response.status_code = 200
             else:
                 response = jsonify({"bucket_name": bucket_name, "object_name" : object_name, "status" : 'folder does not exists'})
@@ -0,0 +1,248 @@
+#***********************************************
+# File: brfss_async.py
+# Desc: asyncio bulk sender for the BRFSS respondents
+# Purpose: Perform following operation:
+#          1. Post _bulk bodies over a pooled keep-alive session that reuses
+#             the host, credentials & AWS4Auth signing of the ES client
+#          2. Keep a bounded number of bulk requests in flight, the producer
+#             waits for a free slot before building the next request
+#          3. Halve the requests in flight on 429 rejections & grow them back
+#             one at a time as requests are accepted
+#          4. Retry rejected documents with backoff
+#************************************************/
+
+import json
+import time
+import asyncio
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import helpers
+import brfss_indexer
+
+# Seconds to wait for a bulk request
+TIMEOUT = 60
+
+
+class AdaptiveLimit(object):
+    """Number of bulk requests allowed in flight
+
+    Additive increase, multiplicative decrease: the limit is halved when a
+    request is rejected with 429 & grows by one after a limit's worth of
+    accepted requests, so it settles just under what the domain sustains.
+
+    :param maximum: upper bound of the limit, where it starts
+    :param minimum: lower bound of the limit
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = maximum
+        self.lowest = maximum
+        self.in_flight = 0
+        self.accepted = 0
+        # Created by bind on the loop that runs the sender, before Python 3.10 a
+        # Condition is tied to the current loop when it is created
+        self.cond = None
+
+    def bind(self):
+        """Create the condition on the running event loop, once"""
+
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        """Wait for a free slot & take it"""
+
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, rejected=False):
+        """Free a slot & adapt the limit to how the request went"""
+
+        async with self.cond:
+            self.in_flight -= 1
+
+            if rejected:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.lowest = min(self.lowest, self.limit)
+                self.accepted = 0
+            else:
+                self.accepted += 1
+                if self.accepted >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self.accepted = 0
+
+            self.cond.notify_all()
+
+
+class AsyncBulkSender(object):
+    """Send bulk actions from an asyncio event loop
+
+    Takes the place of brfss_indexer.bulk_index with the same options &
+    result. The _bulk bodies are built from the JSON string sources
+    without re-serializing them & posted with a requests session sharing
+    the host, credentials & AWS4Auth signer of the Elasticsearch client.
+    The session keeps one keep-alive connection per request in flight, the
+    blocking posts run on a thread pool of the same size while the event
+    loop schedules them. The limit on requests in flight is kept from one
+    batch to the next.
+
+    :param es: Elasticsearch client of the load
+    :param max_in_flight: maximum number of concurrent bulk requests
+    :param min_in_flight: requests in flight the limit never goes below
+    :param timeout: seconds to wait for a bulk request
+    """
+
+    def __init__(self, es, max_in_flight=brfss_indexer.MAX_IN_FLIGHT, min_in_flight=1, timeout=TIMEOUT):
+        conn = es.transport.get_connection()
+        self.url = conn.host + conn.url_prefix + '/_bulk'
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        client_session = getattr(conn, 'session', None)
+        if client_session is not None:
+            self.session.auth = client_session.auth
+            self.session.verify = client_session.verify
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.loop = asyncio.new_event_loop()
+        self.pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='es-bulk')
+        self.limit = AdaptiveLimit(max_in_flight, min_in_flight)
+
+    def close(self):
+        """Close the connections, threads & event loop"""
+
+        self.pool.shutdown()
+        self.session.close()
+        self.loop.close()
+
+    def _post(self, body):
+        resp = self.session.post(self.url, data=body.encode('utf-8'), timeout=self.timeout,
+                                 headers={'Content-Type': 'application/x-ndjson'})
+        if resp.status_code == 429:
+            return None
+
+        resp.raise_for_status()
+        return resp.json()['items']
+
+    async def _send(self, lines, stats, max_retries, initial_backoff, max_backoff):
+        # lines holds (id, action line, data line) per document. The slot of the
+        # first attempt was taken by the producer, retries wait for one of their own
+        todo = lines
+        for attempt in range(max_retries + 1):
+            if attempt:
+                await self.limit.acquire()
+
+            body = ''.join([action + '\n' + data + '\n' for doc_id, action, data in todo])
+            try:
+                items = await self.loop.run_in_executor(self.pool, self._post, body)
+            except BaseException:
+                await self.limit.release()
+                raise
+
+            # A rejected request is re-sent whole, documents are indexed by id so that is safe
+            if items is None:
+                items = [{'index': {'_id': doc_id, 'status': 429}} for doc_id, action, data in todo]
+
+            rejected = set()
+            for info in items:
+                item = list(info.values())[0]
+                if item.get('status') == 429 and attempt < max_retries:
+                    rejected.add(str(item['_id']))
+                elif item.get('status', 500) >= 300:
+                    stats['errors'].append(info)
+                else:
+                    stats['unchanged'] += item.get('result') == 'noop'
+
+            await self.limit.release(bool(rejected))
+            if not rejected:
+                return
+
+            stats['retries'] += len(rejected)
+            await asyncio.sleep(min(max_backoff, initial_backoff * 2 ** attempt))
+            todo = [line for line in todo if str(line[0]) in rejected]
+
+    def _chunks(self, actions, chunk_size, max_chunk_bytes, upsert, stats):
+        expand = brfss_indexer.upsert_action if upsert else helpers.expand_action
+
+        chunk, size = [], 0
+        for action in actions:
+            meta, data = expand(action)
+            line = (action['_id'], json.dumps(meta), data if isinstance(data, str) else json.dumps(data))
+            nbytes = len(line[1].encode('utf-8')) + len(line[2].encode('utf-8')) + 2
+
+            if chunk and (len(chunk) >= chunk_size or size + nbytes > max_chunk_bytes):
+                yield chunk
+                chunk, size = [], 0
+
+            chunk.append(line)
+            size += nbytes
+            stats['docs'] += 1
+            stats['bytes'] += nbytes
+
+        if chunk:
+            yield chunk
+
+    async def _run(self, actions, stats, chunk_size, max_chunk_bytes, upsert, max_retries, initial_backoff, max_backoff):
+        self.limit.bind()
+        tasks = set()
+        try:
+            for chunk in self._chunks(actions, chunk_size, max_chunk_bytes, upsert, stats):
+                # Backpressure: the next request is only built once a slot is free
+                await self.limit.acquire()
+                tasks.add(asyncio.ensure_future(self._send(chunk, stats, max_retries, initial_backoff, max_backoff)))
+
+                done = set([t for t in tasks if t.done()])
+                for task in done:
+                    task.result()
+                tasks -= done
+
+            await asyncio.gather(*tasks)
+
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def bulk_index(self, actions,
+                   chunk_size=brfss_indexer.CHUNK_SIZE,
+                   max_chunk_bytes=brfss_indexer.MAX_CHUNK_BYTES,
+                   max_in_flight=None,
+                   max_retries=brfss_indexer.MAX_RETRIES,
+                   initial_backoff=brfss_indexer.INITIAL_BACKOFF,
+                   max_backoff=brfss_indexer.MAX_BACKOFF,
+                   upsert=False,
+                   raise_on_error=True):
+        """Index actions into Elasticsearch, see brfss_indexer.bulk_index
+
+        max_in_flight is set when the sender is created & adapted from there
+        on, it is accepted here for the same options as bulk_index.
+
+        :return: dict with docs, failed, bytes, retries, unchanged, seconds & errors of the run
+        """
+
+        stats = {'docs': 0, 'failed': 0, 'bytes': 0, 'retries': 0, 'unchanged': 0, 'seconds': 0.0, 'errors': []}
+        st_time = time.perf_counter()
+
+        self.loop.run_until_complete(self._run(actions, stats, chunk_size, max_chunk_bytes, upsert,
+                                               max_retries, initial_backoff, max_backoff))
+
+        stats['failed'] = len(stats['errors'])
+        stats['docs'] -= stats['failed']
+        stats['seconds'] = time.perf_counter() - st_time
+
+        if raise_on_error and stats['errors']:
+            raise helpers.BulkIndexError('{0} document(s) failed to index.'.format(stats['failed']), stats['errors'])
+
+        return stats
+
+    def report(self):
+        """Format the requests in flight the sender settled on"""
+
+        return 'Bulk requests in flight: limit {0} of {1}, lowest {2}'.format(
+            self.limit.limit, self.limit.maximum, self.limit.lowest)
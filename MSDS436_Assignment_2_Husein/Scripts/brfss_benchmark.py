@@ -0,0 +1,761 @@
+#***********************************************
+# File: brfss_benchmark.py
+# Desc: Benchmarks for the BRFSS processing pipeline
+# Purpose: Perform following operation:
+#          1. Read a sample of records from the LLCP ASCII file
+#          2. Time the per-column map decoder against brfss_decoder
+#          3. Report rows/s for each decoder
+#          4. Compare the per-batch fixed cost with & without a shared decoding context
+#          5. Time the iterrows document loop against the vectorized serializer
+#          6. Report the per-column memory of a batch before & after compact dtypes
+#          7. Generate synthetic LLCP records from the column layout of the variable list
+#          8. Stand in for the AWS ES domain with a local stub HTTP server
+#          9. Report rows/s & latency of the decode, transform, serialize & index
+#             stages across batch sizes
+#         10. Stand in for the CDC download server with a local stub serving
+#             ETag, Last-Modified & Range requests
+#         11. Check & time full, resumed, parallel & cached downloads of brfss_download
+#************************************************/
+
+import io
+import os
+import re
+import time
+import json
+import socket
+import filecmp
+import tempfile
+import threading
+import requests
+import numpy as np
+import pandas as pd
+from zipfile import ZipFile as zp, ZIP_DEFLATED
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from argparse import ArgumentParser
+from argparse import RawTextHelpFormatter
+from elasticsearch import Elasticsearch
+import brfss_decoder
+import brfss_download
+import brfss_indexer
+import brfss_profile
+import brfss_survey
+
+
+def numeric_vars(codebook=brfss_decoder.CODEBOOK):
+    """Variables decoded as integers according to the codebook"""
+
+    cb = brfss_decoder.load_codebook(codebook)
+
+    return [name for name, spec in cb['variables'].items() if spec['type'] in ('int', 'lookup')]
+
+
+def legacy_decode(lines, var, numeric):
+    """Per-column map decoder as originally used in file_to_es
+
+    :param lines: list of records as strings
+    :param var: dataframe read from mapping_variable_list.csv
+    :param numeric: variable names to be converted to integers
+    :return: dataframe with one column per kept variable
+    """
+
+    t = pd.DataFrame({'Var': lines})
+    varKeep = var[var['Keep'] == 'Yes']
+
+    for i, row in varKeep.iterrows():
+        st = row['Starting Column'] - 1
+        en = st + row['Field Length']
+        t[row['Variable Name']] = t['Var'].map(lambda x: x[st:en])
+
+    t1 = t.copy(deep=True)
+    for name in numeric:
+        if name in t1:
+            t1[name] = t1[name].map(lambda x: int(x) if not str.isspace(x) else None)
+
+    del(t1['Var'])
+
+    return t1
+
+
+def read_sample(fn, rows):
+    """Read the first rows records of an LLCP ASCII file
+
+    :param fn: LLCP ASCII file
+    :param rows: number of records to read
+    :return: list of records as strings
+    """
+
+    lines = []
+    with open(fn, encoding='iso-8859-1') as f:
+        for line in f:
+            lines.append(line.rstrip('\r\n'))
+            if len(lines) >= rows:
+                break
+
+    return lines
+
+
+def time_it(fcn, repeat):
+    """Best wall time of repeat calls to fcn
+
+    :return: (seconds, result of the last call)
+    """
+
+    best = None
+    for i in range(repeat):
+        st = time.perf_counter()
+        result = fcn()
+        el = time.perf_counter() - st
+        best = el if best is None else min(best, el)
+
+    return best, result
+
+
+def bench_decode(lines, var, repeat=3):
+    """Compare the per-column map decoder with the vectorized decoder
+
+    :param lines: list of records as strings
+    :param var: dataframe read from mapping_variable_list.csv
+    :param repeat: number of timed runs for each decoder
+    :return: dict of rows/s for each decoder
+    """
+
+    layout = brfss_decoder.variable_layout(var)
+    numeric = numeric_vars()
+
+    legacy_sec, legacy = time_it(lambda: legacy_decode(lines, var, numeric), repeat)
+    vector_sec, vector = time_it(lambda: brfss_decoder.decode_records(lines, layout, numeric), repeat)
+
+    # Blank code strings are now nulls, everything else must match
+    legacy = legacy.mask(legacy.apply(lambda col: col.map(lambda x: isinstance(x, str) and str.isspace(x))))
+    pd.testing.assert_frame_equal(legacy, vector, check_dtype=False)
+
+    return {'rows': len(lines),
+            'per_column_map': len(lines) / legacy_sec,
+            'vectorized': len(lines) / vector_sec}
+
+
+def bench_context(dir, batches=98, repeat=3):
+    """Per-batch fixed cost of re-reading the mapping files vs a shared context
+
+    :param dir: Local directory holding the mapping files
+    :param batches: number of batches in a load (98 for a full year of 5000 record batches)
+    :param repeat: number of timed runs
+    :return: dict of seconds per batch for each approach
+    """
+
+    build_sec, ctx = time_it(lambda: brfss_decoder.load_context(dir), repeat)
+
+    return {'batches': batches,
+            'reloaded': build_sec,
+            'shared': build_sec / batches}
+
+
+def legacy_sources(t1):
+    """iterrows document loop as originally used in file_to_es
+
+    :param t1: transformed dataframe, one row per respondent
+    :return: list of JSON strings in row order
+    """
+
+    sources = []
+    for subj_id, subject in t1.fillna('').iterrows():
+        thisResp = subject.to_dict()
+        thisResp['Coordinates'] = [thisResp['Longitude'], thisResp['Latitude']]
+        sources.append(json.dumps(thisResp))
+
+    return sources
+
+
+def transform(ctx, t1, compact=True):
+    """Apply the transforms of process_brfss_data.transform_batch to a decoded batch
+
+    :param compact: compact dtypes, else the object & float64 columns of the
+                    original transforms
+    """
+
+    if compact:
+        t1['Latitude'], t1['Longitude'] = ctx.coordinates(t1['_STATE'])
+    else:
+        t1['Latitude'] = t1['_STATE'].replace(ctx.latitude)
+        t1['Longitude'] = t1['_STATE'].replace(ctx.longitude)
+
+    dates = brfss_decoder.iso_dates(t1['IDATE'])[0]
+    t1['IDATE'] = dates if compact else np.asarray(dates, dtype=object)
+
+    t1.rename(columns=ctx.columns, inplace=True)
+
+    return t1
+
+
+def sample_batch(dir, lines, compact=True):
+    """Decode a sample into a batch shaped like the one process_brfss_data indexes
+
+    :param compact: compact dtypes, else the object & float64 columns of the
+                    original transforms
+    """
+
+    ctx = brfss_decoder.load_context(dir)
+
+    return transform(ctx, ctx.plan.decode(lines, ctx.layout, ctx.chunk_rows, compact), compact)
+
+
+def bench_serialize(before, after, repeat=3):
+    """Compare the iterrows document loop with the vectorized serializer
+
+    :param before: transformed dataframe with the original object & float64 columns
+    :param after: the same batch with compact dtypes
+    :param repeat: number of timed runs for each serializer
+    :return: dict of rows/s for each serializer & MB of JSON produced
+    """
+
+    legacy_sec, legacy = time_it(lambda: legacy_sources(before), repeat)
+    vector_sec, vector = time_it(lambda: brfss_indexer.respondent_sources(before), repeat)
+    compact_sec, compact = time_it(lambda: brfss_indexer.respondent_sources(after), repeat)
+
+    # Blanks are now nulls instead of empty strings, everything else must match
+    for old, new in zip(legacy, compact):
+        old, new = json.loads(old), json.loads(new)
+        assert old == dict([(k, '' if v is None else v) for k, v in new.items() if k != 'Coordinates']
+                           + [('Coordinates', new['Coordinates'] or ['', ''])])
+
+    return {'rows': len(after),
+            'mb': sum([len(s) for s in compact]) / 1e6,
+            'iterrows': len(after) / legacy_sec,
+            'vectorized': len(after) / vector_sec,
+            'compact': len(after) / compact_sec}
+
+
+def column_memory(before, after):
+    """Per-column memory of a batch before & after compact dtypes
+
+    :param before: transformed dataframe with the original object & float64 columns
+    :param after: the same batch with compact dtypes
+    :return: dataframe of dtype & bytes before & after for each column,
+             largest saving first
+    """
+
+    report = pd.DataFrame({'dtype_before': before.dtypes.astype(str),
+                           'before': before.memory_usage(index=False, deep=True),
+                           'dtype_after': after.dtypes.astype(str),
+                           'after': after.memory_usage(index=False, deep=True)})
+    report['ratio'] = report['before'] / report['after']
+
+    return report.loc[(report['before'] - report['after']).sort_values(ascending=False).index]
+
+
+def synthetic_records(dir, rows, blank_rate=0.1, seed=0, codebook=brfss_decoder.CODEBOOK):
+    """Generate fixed-width LLCP records from the column layout of the variable list
+
+    Records are as wide as the variable list. Kept variables hold values
+    the pipeline accepts: codes from the codebook choices, ids of the state
+    & activity tables, interview dates of 2013 with the matching month &
+    day, and random integers elsewhere. Every record gets a unique SEQNO
+    (year * 10**6 + row), so _STATE & SEQNO give it a stable id. blank_rate
+    of the answers are blank, the id variables & IDATE never are.
+
+    :param dir: Local directory holding the mapping files
+    :param rows: number of records
+    :param blank_rate: share of blank answers
+    :param seed: random seed, the same seed gives the same records
+    :param codebook: codebook JSON file
+    :return: list of records as bytes
+    """
+
+    rng = np.random.default_rng(seed)
+    var = pd.read_csv(dir+'mapping_variable_list.csv')
+    layout = brfss_decoder.variable_layout(var)
+    ids = brfss_decoder.variable_layout(var, brfss_survey.ID_VARIABLES)
+    cb = brfss_decoder.load_codebook(codebook)
+
+    tables = {'state': pd.read_csv(dir+'mapping_state.csv')['ID'].values,
+              'activity': pd.read_csv(dir+'mapping_activity.csv', encoding='iso-8859-1')['ID'].values}
+
+    dates = pd.Timestamp('2013-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D')
+    derived = {'IDATE': dates.strftime('%m%d%Y'), 'IMONTH': dates.month, 'IDAY': dates.day, 'FMONTH': dates.month,
+               'SEQNO': brfss_survey.SURVEY_YEAR * 10 ** 6 + np.arange(rows, dtype=np.int64)}
+    answered = set(brfss_survey.ID_VARIABLES) | {'IDATE'}
+
+    # The id variables are written whether they are kept or not
+    fields = list(zip(layout.names, layout.starts, layout.lengths))
+    fields += [f for f in zip(ids.names, ids.starts, ids.lengths) if f[0] not in set(layout.names)]
+
+    width = int((var['Starting Column'] + var['Field Length'] - 1).max())
+    mat = np.full((rows, width), brfss_decoder.SPACE, dtype=np.uint8)
+
+    for name, st, ln in fields:
+        spec = cb['variables'].get(name, {})
+        choices = spec.get('choices', {})
+        if isinstance(choices, str):
+            choices = cb['choices'][choices]
+        codes = [k for k in choices if len(k) == ln]
+
+        if name in derived:
+            values = np.asarray(derived[name])
+        elif spec.get('type') == 'lookup':
+            values = rng.choice(tables[spec['table']], rows)
+        elif codes:
+            values = rng.choice(codes, rows)
+        else:
+            values = rng.integers(0, 10 ** min(ln, 18), rows)
+
+        text = np.char.zfill(values.astype(str), ln)
+        field = np.array(text, dtype='S{0}'.format(ln)).view(np.uint8).reshape(rows, ln)
+
+        # The respondent ids & interview date are always answered
+        if name not in answered:
+            field[rng.random(rows) < blank_rate] = brfss_decoder.SPACE
+
+        mat[:, st:st + ln] = field
+
+    return mat.view('S{0}'.format(width)).ravel().tolist()
+
+
+def write_records(fn, records, member='LLCP2013.ASC'):
+    """Write records as an LLCP ASCII file, or as a ZIP holding one if fn ends with .zip"""
+
+    data = b'\r\n'.join(records) + b'\r\n'
+
+    if fn.lower().endswith('.zip'):
+        with zp(fn, 'w', ZIP_DEFLATED) as zip:
+            zip.writestr(member, data)
+    else:
+        with open(fn, 'wb') as f:
+            f.write(data)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # Answers the requests sent by process_brfss_data, see StubElasticsearch
+    stub = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_HEAD(self):
+        # No index exists, so a load always creates it
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        index = self.path.strip('/').split('/')[0]
+
+        if '_settings' in self.path:
+            return self._send(200, {index: {'settings': {'index': {'number_of_replicas': '1', 'refresh_interval': '1s'}}}})
+        if '_segments' in self.path:
+            return self._send(200, {'indices': {index: {'shards': {}}}})
+
+        self._send(200, {'version': {'number': '7.10.2'}, 'tagline': 'You Know, for Search'})
+
+    def do_PUT(self):
+        self._body()
+        self._send(200, {'acknowledged': True})
+
+    def do_DELETE(self):
+        self._send(200, {'acknowledged': True})
+
+    def do_POST(self):
+        body = self._body()
+        if '_bulk' not in self.path:
+            return self._send(200, {'acknowledged': True})
+
+        time.sleep(self.stub.latency)
+
+        # Only the action lines are parsed, documents are counted & dropped
+        items = []
+        for line in body.splitlines()[::2]:
+            op, meta = next(iter(json.loads(line).items()))
+            if self.stub.rng.random() < self.stub.reject:
+                items.append({op: {'_id': meta.get('_id'), 'status': 429,
+                                   'error': {'type': 'es_rejected_execution_exception'}}})
+            else:
+                items.append({op: {'_id': meta.get('_id'), 'status': 201, 'result': 'created'}})
+
+        rejected = sum([1 for i in items if list(i.values())[0]['status'] == 429])
+        with self.stub.lock:
+            self.stub.requests += 1
+            self.stub.bytes += len(body)
+            self.stub.docs += len(items) - rejected
+            self.stub.rejected += rejected
+
+        self._send(200, {'took': 1, 'errors': rejected > 0, 'items': items})
+
+
+class StubElasticsearch(object):
+    """Local HTTP server standing in for the AWS ES domain
+
+    Answers index creation, mappings, settings & bulk requests. Bulk
+    documents are acknowledged & counted without being stored.
+
+    :param latency: seconds added to every bulk request
+    :param reject: share of bulk items rejected with 429, to exercise the retries
+    :param port: port to listen on, 0 for any free port
+    :param seed: random seed of the rejections
+    """
+
+    def __init__(self, latency=0.0, reject=0.0, port=0, seed=0):
+        self.latency = latency
+        self.reject = reject
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.requests = self.docs = self.bytes = self.rejected = 0
+
+        handler = type('Handler', (_StubHandler,), {'stub': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self):
+        """Elasticsearch client connected to the stub"""
+
+        return Elasticsearch(hosts=[{'host': '127.0.0.1', 'port': self.port}])
+
+
+# Stages timed by bench_stages, in pipeline order
+STAGES = ['decode', 'transform', 'serialize', 'index']
+
+
+def bench_stages(dir, records, batch_sizes, es, bulk_opts=None):
+    """Time each pipeline stage on every batch of records, for several batch sizes
+
+    :param dir: Local directory holding the mapping files
+    :param records: list of records as bytes, e.g. from synthetic_records
+    :param batch_sizes: list of records per batch
+    :param es: Elasticsearch client, e.g. StubElasticsearch.client()
+    :param bulk_opts: options passed to brfss_indexer.bulk_index
+    :return: dataframe of rows/s & batch latency (mean, p50, p95 in ms) per batch size & stage
+    """
+
+    ctx = brfss_decoder.load_context(dir)
+    rows = []
+
+    for size in batch_sizes:
+        timing = dict([(stage, []) for stage in STAGES])
+
+        for st in range(0, len(records), size):
+            lines = records[st:st + size]
+            batch = {}
+
+            with brfss_profile.stage('decode', batch):
+                t1 = ctx.decode(lines)
+            with brfss_profile.stage('transform', batch):
+                transform(ctx, t1)
+            with brfss_profile.stage('serialize', batch):
+                sources = brfss_indexer.respondent_sources(t1)
+
+            actions = [{'_index': 'brfss', '_type': 'respondent', '_id': st + i + 1, '_source': source}
+                       for i, source in enumerate(sources)]
+            with brfss_profile.stage('index', batch):
+                brfss_indexer.bulk_index(es, actions, **(bulk_opts or {}))
+
+            for stage in STAGES:
+                timing[stage].append(batch[stage])
+
+        for stage in STAGES + ['total']:
+            sec = np.sum([timing[s] for s in STAGES], axis=0) if stage == 'total' else np.array(timing[stage])
+            rows.append({'batch_size': size, 'stage': stage,
+                         'rows/s': len(records) / sec.sum(),
+                         'mean ms': sec.mean() * 1000,
+                         'p50 ms': np.percentile(sec, 50) * 1000,
+                         'p95 ms': np.percentile(sec, 95) * 1000})
+
+    return pd.DataFrame(rows)
+
+
+class _CdcHandler(BaseHTTPRequestHandler):
+    # Serves the file of StubCDC, whatever the path asked for
+    stub = None
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, code, length, extra=()):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', self.stub.etag)
+        self.send_header('Last-Modified', self.stub.last_modified)
+        self.send_header('Accept-Ranges', 'bytes')
+        for k, v in extra:
+            self.send_header(k, v)
+        self.end_headers()
+
+    def _range(self):
+        # (start, end) asked for, None for the whole file. If-Range turns the
+        # request into a plain GET when the file changed since the validator
+        rng = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if rng is None or (if_range is not None and if_range not in (self.stub.etag, self.stub.last_modified)):
+            return None
+
+        m = re.match(r'bytes=(\d+)-(\d*)$', rng.strip())
+        if m is None:
+            return None
+
+        start = int(m.group(1))
+        end = min(int(m.group(2)), self.stub.size - 1) if m.group(2) else self.stub.size - 1
+
+        return start, end
+
+    def do_HEAD(self):
+        self._headers(200, self.stub.size)
+
+    def do_GET(self):
+        rng = self._range()
+        if rng is None:
+            start, end = 0, self.stub.size - 1
+            self._headers(200, self.stub.size)
+        elif rng[0] > rng[1]:
+            return self._headers(416, 0, [('Content-Range', 'bytes */{0}'.format(self.stub.size))])
+        else:
+            start, end = rng
+            self._headers(206, end - start + 1, [('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, self.stub.size))])
+
+        with self.stub.lock:
+            self.stub.requests += 1
+            self.stub.ranges += rng is not None
+            fail_after, self.stub.fail_after = self.stub.fail_after, None
+
+        # Stream the bytes asked for, or only fail_after of them before dropping the connection
+        todo = end - start + 1 if fail_after is None else min(fail_after, end - start + 1)
+        with open(self.stub.path, 'rb') as f:
+            f.seek(start)
+            while todo > 0:
+                chunk = f.read(min(todo, 1024 * 1024))
+                self.wfile.write(chunk)
+                todo -= len(chunk)
+                with self.stub.lock:
+                    self.stub.bytes += len(chunk)
+
+        if fail_after is not None:
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+
+
+class StubCDC(object):
+    """Local HTTP server standing in for the CDC download server
+
+    Serves one file with an ETag & Last-Modified taken from its size &
+    modification time, honours Range & If-Range, and counts the GET
+    requests, the range requests & the bytes sent.
+
+    :param path: file served for every URL
+    :param port: port to listen on, 0 for any free port
+    """
+
+    def __init__(self, path, port=0):
+        st = os.stat(path)
+        self.path = path
+        self.size = st.st_size
+        self.etag = '"{0:x}-{1:x}"'.format(st.st_size, st.st_mtime_ns)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.lock = threading.Lock()
+        self.requests = self.ranges = self.bytes = 0
+        # Bytes sent before the next GET drops its connection, None to send it whole
+        self.fail_after = None
+
+        handler = type('Handler', (_CdcHandler,), {'stub': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self):
+        return 'http://127.0.0.1:{0}/{1}'.format(self.port, os.path.basename(self.path))
+
+    def counts(self):
+        with self.lock:
+            return {'requests': self.requests, 'ranges': self.ranges, 'bytes': self.bytes}
+
+
+def bench_download(src, work, parts=4):
+    """Check & time brfss_download in the four cases it handles
+
+    src is served by a StubCDC & downloaded into work: in full, resumed
+    from the .part left by a connection dropped half way, in parallel byte
+    ranges, then again with the cached file still up to date.
+
+    :param src: file to download, e.g. an LLCP ZIP written by write_records
+    :param work: directory the file is downloaded to
+    :param parts: byte ranges fetched in parallel
+    :return: dataframe with the requests, bytes sent & resumed, seconds & MB/s of each case
+    :raises IOError: when a case gets the wrong bytes or does not take its path
+    """
+
+    stub = StubCDC(src).start()
+    fn = os.path.join(work, os.path.basename(src))
+    rows = []
+
+    def clear():
+        for name in (fn, fn + '.part', fn + '.meta'):
+            if os.path.exists(name):
+                os.remove(name)
+
+    def run(case, expect, **kwargs):
+        before = stub.counts()
+        stats = brfss_download.download(stub.url(), fn, **kwargs)
+        sent = dict([(k, v - before[k]) for k, v in stub.counts().items()])
+
+        if not filecmp.cmp(src, fn, shallow=False):
+            raise IOError('{0} download of {1} does not match the file served'.format(case, src))
+        if not expect(stats, sent):
+            raise IOError('{0} download of {1} took another path: {2}, {3}'.format(case, src, stats, sent))
+
+        rows.append({'case': case, 'requests': sent['requests'], 'ranges': sent['ranges'],
+                     'MB sent': sent['bytes'] / 1e6, 'MB resumed': stats['resumed'] / 1e6,
+                     'seconds': stats['seconds'], 'MB/s': sent['bytes'] / max(stats['seconds'], 1e-9) / 1e6})
+
+    try:
+        clear()
+        run('full', lambda stats, sent: sent['requests'] == 1 and not sent['ranges'] and sent['bytes'] == stub.size)
+
+        # The first attempt is cut half way & not retried, leaving its .part behind
+        clear()
+        stub.fail_after = stub.size // 2
+        try:
+            brfss_download.download(stub.url(), fn, chunk_size=64 * 1024, retries=0)
+            raise IOError('Download of {0} was not interrupted'.format(src))
+        except (requests.RequestException, IOError):
+            pass
+        run('resume', lambda stats, sent: 0 < stats['resumed'] and sent['ranges'] == 1
+                                          and sent['bytes'] == stub.size - stats['resumed'])
+
+        clear()
+        ranges = len(brfss_download.byte_ranges(stub.size, parts))
+        run('parallel', lambda stats, sent: sent['ranges'] == ranges and sent['bytes'] == stub.size, parts=parts)
+
+        run('cached', lambda stats, sent: stats['cached'] and sent['requests'] == 0, parts=parts)
+
+    finally:
+        stub.stop()
+
+    return pd.DataFrame(rows)
+
+
+def main():
+
+    parser = ArgumentParser(formatter_class=RawTextHelpFormatter, prog='brfss_benchmark.py', description='Benchmarks the BRFSS processing stages offline, with synthetic records & a stub ES endpoint. \n ')
+
+    parser.add_argument('-d', '--dir', dest='dir', help='Local directory holding the mapping files', required=True)
+    parser.add_argument('-f', '--file_name', dest='file_name', help='LLCP ASCII data file. If not specified then synthetic records are used')
+    parser.add_argument('-n', '--rows', dest='rows', type=int, default=5000, help='Number of records to decode')
+    parser.add_argument('-g', '--generate', dest='generate', help='Write the synthetic records to this file (.ASC, or .ZIP for process_brfss_data.py) & exit')
+    parser.add_argument('-st', '--stages', dest='stages', action='store_true', help='Time the decode, transform, serialize & index stages against a stub ES server')
+    parser.add_argument('-bs', '--batch_sizes', dest='batch_sizes', default='1000,5000,10000', help='Comma separated batch sizes timed with --stages')
+    parser.add_argument('-sl', '--stub_latency', dest='stub_latency', type=float, default=0.0, help='Milliseconds added to every bulk request by the stub ES server')
+    parser.add_argument('-sr', '--stub_reject', dest='stub_reject', type=float, default=0.0, help='Share of documents the stub ES server rejects with 429')
+    parser.add_argument('-dl', '--download', dest='download', action='store_true', help='Check & time full, resumed, parallel & cached downloads from a stub CDC server')
+    parser.add_argument('-dp', '--download_parts', dest='download_parts', type=int, default=4, help='Byte ranges fetched in parallel with --download')
+    parser.add_argument('-co', '--columns', dest='columns', type=int, default=10, help='Columns listed in the memory report')
+    parser.add_argument('-rp', '--repeat', dest='repeat', type=int, default=3, help='Timed runs per decoder')
+
+    args = parser.parse_args()
+
+    dir = args.dir
+    if dir[-1]!='/':
+        dir += '/'
+
+    var = pd.read_csv(dir+'mapping_variable_list.csv')
+
+    if args.file_name:
+        lines = read_sample(args.file_name, args.rows)
+        records = [line.encode('iso-8859-1') for line in lines]
+    else:
+        records = synthetic_records(dir, args.rows)
+        lines = [record.decode('iso-8859-1') for record in records]
+
+    if args.generate:
+        write_records(args.generate, records)
+        print('Wrote {0} records to {1}'.format(len(records), args.generate))
+        return
+
+    if args.stages:
+        stub = StubElasticsearch(latency=args.stub_latency / 1000, reject=args.stub_reject).start()
+        sizes = [int(size) for size in args.batch_sizes.split(',')]
+
+        try:
+            result = bench_stages(dir, records, sizes, stub.client())
+        finally:
+            stub.stop()
+
+        print('\nStages over {0} rows, {1} bulk requests, {2} documents rejected & retried'.format(len(records), stub.requests, stub.rejected))
+        print(result.to_string(index=False, float_format='{0:,.1f}'.format) + '\n')
+        return
+
+    if args.download:
+        with tempfile.TemporaryDirectory() as work:
+            # The ZIP of the synthetic records is served, or the data file given with -f
+            src = args.file_name
+            if not src:
+                src = os.path.join(work, 'LLCP2013ASC.ZIP')
+                write_records(src, records)
+            os.mkdir(os.path.join(work, 'download'))
+            size = os.path.getsize(src)
+            result = bench_download(src, os.path.join(work, 'download'), args.download_parts)
+
+        print('\nDownloads of {0} ({1:.1f} MB), all checked against the file served'.format(os.path.basename(src), size / 1e6))
+        print(result.to_string(index=False, float_format='{0:,.2f}'.format) + '\n')
+        return
+
+    result = bench_decode(lines, var, args.repeat)
+
+    print('\nDecoded {0} rows'.format(result['rows']))
+    print('  per-column map : {0:12,.0f} rows/s'.format(result['per_column_map']))
+    print('  vectorized     : {0:12,.0f} rows/s'.format(result['vectorized']))
+    print('  speedup        : {0:12.1f}x\n'.format(result['vectorized'] / result['per_column_map']))
+
+    result = bench_context(dir)
+
+    print('Fixed cost per batch over {0} batches'.format(result['batches']))
+    print('  mapping files re-read : {0:10.3f} ms'.format(result['reloaded'] * 1000))
+    print('  shared context        : {0:10.3f} ms\n'.format(result['shared'] * 1000))
+
+    before = sample_batch(dir, lines, compact=False)
+    after = sample_batch(dir, lines)
+
+    report = column_memory(before, after)
+
+    print('Batch memory of {0} rows'.format(len(after)))
+    print('  object & float64      : {0:10.2f} MB'.format(report['before'].sum() / 1e6))
+    print('  compact dtypes        : {0:10.2f} MB'.format(report['after'].sum() / 1e6))
+    print('  reduction             : {0:10.1f}x\n'.format(report['before'].sum() / report['after'].sum()))
+    print(report.head(args.columns).to_string() + '\n')
+
+    result = bench_serialize(before, after, args.repeat)
+
+    print('Serialized {0} rows ({1:.1f} MB of JSON)'.format(result['rows'], result['mb']))
+    print('  iterrows & json.dumps : {0:12,.0f} rows/s'.format(result['iterrows']))
+    print('  vectorized            : {0:12,.0f} rows/s'.format(result['vectorized']))
+    print('  vectorized, compact   : {0:12,.0f} rows/s'.format(result['compact']))
+    print('  speedup               : {0:12.1f}x\n'.format(result['compact'] / result['iterrows']))
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,530 @@
+#***********************************************
+# File: brfss_decoder.py
+# Desc: Fixed-width decoder for the BRFSS LLCP ASCII data file
+# Purpose: Perform following operation:
+#          1. Read the column layout from mapping_variable_list.csv
+#          2. Slice every kept field of a batch of records in one pass
+#          3. Convert blank fields to nulls & numeric fields to integers
+#          4. Compile the codebook into a vectorized transformation plan
+#          5. Build the decoding context shared by every batch of a load
+#          6. Normalize interview dates, parsing each distinct value once
+#          7. Keep decoded batches compact: categorical answers, nullable
+#             small integers & float32 measures
+#          8. Decode the stable document ids of a survey year
+#************************************************/
+
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from functools import lru_cache
+import brfss_survey
+
+# Codebook of the 2013 survey: type, implied decimals & code labels of the
+# kept variables. See codebook_brfss_2013.json
+CODEBOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codebook_brfss_2013.json')
+
+# Records packed at a time by pack_records. Only the kept bytes of a batch
+# are held in full, so the full width records never take more than
+# DECODE_CHUNK * record width bytes
+DECODE_CHUNK = 1000
+
+SPACE = ord(' ')
+ZERO = ord('0')
+
+
+class FixedWidthLayout(object):
+    """Column layout of the kept BRFSS variables
+
+    :param names: variable names in file order
+    :param starts: zero based starting column of each variable
+    :param lengths: field length of each variable
+    """
+
+    def __init__(self, names, starts, lengths):
+        self.names = list(names)
+        self.starts = [int(s) for s in starts]
+        self.lengths = [int(l) for l in lengths]
+
+        # Record width needed to hold every kept field
+        self.width = max([s + l for s, l in zip(self.starts, self.lengths)] or [0])
+
+        # Byte positions of all kept fields packed next to each other, and the
+        # offset of each field inside that packed block
+        self.columns = np.concatenate([np.arange(s, s + l) for s, l in zip(self.starts, self.lengths)] or [np.arange(0)])
+        self.offsets = list(np.cumsum([0] + self.lengths[:-1]))
+
+
+def variable_layout(var, names=None):
+    """Build the layout of the kept variables from the variable list
+
+    :param var: dataframe read from mapping_variable_list.csv
+    :param names: variables to lay out instead of the kept ones
+    :return: FixedWidthLayout of the variables coded with Keep = Yes, or of names
+    """
+
+    if names is None:
+        varKeep = var[var['Keep'] == 'Yes']
+    else:
+        varKeep = var[var['Variable Name'].isin(names)]
+        missing = set(names) - set(varKeep['Variable Name'])
+        if missing:
+            raise ValueError('{0} missing from the variable list'.format(', '.join(sorted(missing))))
+
+    return FixedWidthLayout(varKeep['Variable Name'],
+                            varKeep['Starting Column'] - 1,
+                            varKeep['Field Length'])
+
+
+def load_layout(dir, fn='mapping_variable_list.csv'):
+    """Read the layout of the kept variables from the variable list
+
+    :param dir: Local directory holding the mapping files
+    :param fn: Variable list file name
+    :return: FixedWidthLayout of the variables coded with Keep = Yes
+    """
+
+    return variable_layout(pd.read_csv(dir+fn))
+
+
+def records_to_array(lines, width):
+    """Pack a batch of records into an (n, width) byte matrix
+
+    Short records are padded with blanks and longer ones are truncated.
+
+    :param lines: list of records as bytes or iso-8859-1 strings
+    :param width: number of columns to keep
+    :return: numpy uint8 array of shape (len(lines), width)
+    """
+
+    if lines and isinstance(lines[0], str):
+        lines = [line.encode('iso-8859-1') for line in lines]
+
+    raw = np.array(lines, dtype='S{0}'.format(max(width, 1)))
+    mat = raw.view(np.uint8).reshape(len(lines), max(width, 1))[:, :width]
+
+    # numpy pads short records with NUL bytes
+    mat[mat == 0] = SPACE
+
+    return mat
+
+
+def pack_records(lines, layout, chunk_rows=DECODE_CHUNK):
+    """Gather the kept fields of a batch of records into one byte matrix
+
+    :param lines: list of records as bytes or iso-8859-1 strings
+    :param layout: FixedWidthLayout of the kept variables
+    :param chunk_rows: number of records packed at a time, None for all at once
+    :return: numpy uint8 array of shape (len(lines), total kept field length)
+    """
+
+    chunk_rows = chunk_rows or max(len(lines), 1)
+    packed = np.empty((len(lines), len(layout.columns)), dtype=np.uint8)
+
+    for st in range(0, len(lines), chunk_rows):
+        mat = records_to_array(lines[st:st + chunk_rows], layout.width)
+        packed[st:st + len(mat)] = mat[:, layout.columns]
+
+    return packed
+
+
+def int_dtype(length):
+    """Smallest nullable integer dtype holding a field of length digits"""
+
+    for digits, dtype in ((2, pd.Int8Dtype()), (4, pd.Int16Dtype()), (9, pd.Int32Dtype())):
+        if length <= digits:
+            return dtype
+
+    return pd.Int64Dtype()
+
+
+def _categorical(codes, values):
+    # values holds the value of each code & codes is -1 for blanks. Codes
+    # sharing a value (e.g. two codes with the same label) share a category
+    remap, categories = pd.factorize(np.array(values, dtype=object))
+
+    return pd.Categorical.from_codes(np.append(remap, -1)[codes], categories=categories)
+
+
+def _to_int(name, block, blank, compact=False):
+    digits = block.astype(np.int64) - ZERO
+    is_digit = (digits >= 0) & (digits <= 9)
+
+    if (~(is_digit | (block == SPACE))).any():
+        raise ValueError('Non numeric value found in {0}'.format(name))
+
+    # Surrounding blanks are skipped the same way int(' 7') does
+    value = np.zeros(len(block), dtype=np.int64)
+    for j in range(block.shape[1]):
+        value = np.where(is_digit[:, j], value * 10 + digits[:, j], value)
+
+    if compact:
+        return pd.arrays.IntegerArray(value.astype(int_dtype(block.shape[1]).numpy_dtype), blank.copy())
+
+    if blank.any():
+        value = value.astype(np.float64)
+        value[blank] = np.nan
+
+    return value
+
+
+def _to_str(block, blank, choices=None, compact=False):
+    codes = np.ascontiguousarray(block).view('S{0}'.format(block.shape[1])).ravel()
+
+    # Coded answers only take a handful of values - decode & label each
+    # distinct code once and broadcast it back over the column
+    uniq, inverse = np.unique(codes, return_inverse=True)
+    labels = [u.decode('iso-8859-1') for u in uniq]
+    if choices:
+        labels = [choices.get(u, u) for u in labels]
+    inverse = inverse.ravel()
+
+    if compact:
+        inverse[blank] = -1
+        return _categorical(inverse, labels)
+
+    labels = np.array(labels + [None], dtype=object)
+    inverse[blank] = len(uniq)
+
+    return labels[inverse]
+
+
+def decode_records(lines, layout, numeric=(), labels=None, chunk_rows=DECODE_CHUNK, compact=False):
+    """Decode a batch of fixed-width records into a dataframe
+
+    All kept fields are gathered from the raw bytes with one fancy-index
+    pass per chunk of records; numeric variables come back as int64
+    (float64 with NaN when a blank is present, as the per-column int map
+    produced) and the rest as code strings, or their labels, with None for
+    blanks. A compact frame holds nullable integers sized to the field
+    length & categoricals instead.
+
+    :param lines: list of records as bytes or iso-8859-1 strings
+    :param layout: FixedWidthLayout of the kept variables
+    :param numeric: variable names to be converted to integers
+    :param labels: dict of variable name to {code: label}. Unknown codes are kept
+    :param chunk_rows: number of records packed at a time, see pack_records
+    :param compact: decode to nullable small integers & categoricals
+    :return: dataframe with one column per kept variable
+    """
+
+    packed = pack_records(lines, layout, chunk_rows)
+    numeric = set(numeric)
+    labels = labels or {}
+
+    columns = {}
+    for name, off, ln in zip(layout.names, layout.offsets, layout.lengths):
+        block = packed[:, off:off + ln]
+        blank = (block == SPACE).all(axis=1)
+
+        if name in numeric:
+            columns[name] = _to_int(name, block, blank, compact)
+        else:
+            columns[name] = _to_str(block, blank, labels.get(name), compact)
+
+    return pd.DataFrame(columns)
+
+
+# Invalid interview dates found in the survey & the date used instead
+DATE_FIXES = {'02292014': '02282014',
+              '09312014': '09302014'}
+
+
+@lru_cache(maxsize=4096)
+def parse_date(text):
+    """Convert an interview date to iso format
+
+    The known invalid dates are replaced first, then the date is read as
+    mmddyyyy and, failing that, as ddmmyyyy.
+
+    :param text: interview date string
+    :return: (iso date or None, True if the date needed correction)
+    """
+
+    if not text:
+        return None, False
+
+    if text in DATE_FIXES:
+        return datetime.isoformat(datetime.strptime(DATE_FIXES[text], '%m%d%Y')), True
+
+    for fmt in (['%m%d%Y','%d%m%Y']):
+        try:
+            return datetime.isoformat(datetime.strptime(text, fmt)), fmt != '%m%d%Y'
+        except ValueError:
+            pass
+
+    raise ValueError('Invalid interview date {0}'.format(text))
+
+
+def iso_dates(values):
+    """Convert a column of interview dates to iso format
+
+    A survey year only has a few hundred distinct dates, so each distinct
+    value is parsed once and the result is broadcast over the column.
+
+    :param values: array or series of date strings, None for blanks
+    :return: (categorical of iso dates, number of values that needed correction)
+    """
+
+    codes, uniq = pd.factorize(np.asarray(values, dtype=object))
+    parsed = [parse_date(u) for u in uniq]
+
+    # factorize codes blanks as -1, the last entry below
+    fixed = np.array([p[1] for p in parsed] + [False])
+
+    return _categorical(codes, [p[0] for p in parsed]), int(fixed[codes].sum())
+
+
+def load_codebook(fn=CODEBOOK):
+    """Read a codebook file
+
+    :param fn: codebook JSON file
+    :return: dict with the shared choices & the variables
+    """
+
+    with open(fn, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _lookup(values, table):
+    uniq, inverse = np.unique(values, return_inverse=True)
+    mapped = np.array([table.get(u, u) for u in uniq.tolist()], dtype=object)
+
+    return mapped[inverse.ravel()]
+
+
+def _lookup_categorical(values, table):
+    codes, uniq = pd.factorize(values)
+
+    return _categorical(codes, [table.get(u, u) for u in uniq.tolist()])
+
+
+class TransformPlan(object):
+    """Vectorized transformation of the kept variables
+
+    Built by compile_plan. Code labels are applied by the decoder to the
+    distinct codes only, lookups are applied to the distinct codes the same
+    way and implied decimals are one division per column.
+
+    The decoded frame is compact by default: coded answers & lookups are
+    categoricals, integers are nullable & sized to their field and scaled
+    measures are float32.
+
+    :param numeric: variables decoded as integers
+    :param labels: dict of variable name to {code: label}
+    :param lookups: dict of variable name to {integer code: value}
+    :param divisors: dict of variable name to the divisor of its implied decimals
+    """
+
+    def __init__(self, numeric, labels, lookups, divisors):
+        self.numeric = list(numeric)
+        self.labels = dict(labels)
+        self.lookups = dict(lookups)
+        self.divisors = dict(divisors)
+
+    def decode(self, lines, layout, chunk_rows=DECODE_CHUNK, compact=True):
+        """Decode & transform a batch of records
+
+        :param lines: list of records as bytes or iso-8859-1 strings
+        :param layout: FixedWidthLayout of the kept variables
+        :param chunk_rows: number of records packed at a time, see pack_records
+        :param compact: compact dtypes, else object & float64 columns
+        :return: transformed dataframe with one column per kept variable
+        """
+
+        t1 = decode_records(lines, layout, self.numeric, self.labels, chunk_rows, compact)
+
+        for name, table in self.lookups.items():
+            if name in t1:
+                if compact:
+                    t1[name] = _lookup_categorical(t1[name].values, table)
+                else:
+                    t1[name] = _lookup(t1[name].values, table)
+
+        for name, divisor in self.divisors.items():
+            if name in t1:
+                if compact:
+                    t1[name] = (t1[name].to_numpy(dtype=np.float64, na_value=np.nan) / divisor).astype(np.float32)
+                else:
+                    t1[name] = t1[name] / divisor
+
+        return t1
+
+
+def compile_plan(codebook, tables=None):
+    """Compile a codebook into a TransformPlan
+
+    Variable types:
+        int    - integer, optional 'decimals' gives the implied decimal places
+        code   - coded answer, 'choices' is a {code: label} dict or the name
+                 of a shared entry under the codebook choices
+        lookup - integer code mapped through the reference table 'table'
+
+    :param codebook: dict read with load_codebook
+    :param tables: dict of reference tables used by lookup variables
+    :return: TransformPlan
+    """
+
+    tables = tables or {}
+    numeric, labels, lookups, divisors = [], {}, {}, {}
+
+    for name, spec in codebook['variables'].items():
+        kind = spec['type']
+
+        if kind == 'int':
+            numeric.append(name)
+            if spec.get('decimals'):
+                divisors[name] = 10 ** spec['decimals']
+
+        elif kind == 'code':
+            choices = spec['choices']
+            if isinstance(choices, str):
+                choices = codebook['choices'][choices]
+            labels[name] = choices
+
+        elif kind == 'lookup':
+            numeric.append(name)
+            if spec['table'] not in tables:
+                raise ValueError('Lookup table {0} for {1} was not provided'.format(spec['table'], name))
+            lookups[name] = tables[spec['table']]
+
+        else:
+            raise ValueError('Unknown type {0} for {1} in codebook'.format(kind, name))
+
+    return TransformPlan(numeric, labels, lookups, divisors)
+
+
+def column_names(var, names):
+    """Map variable names to the descriptive field names used in Elasticsearch
+
+    :param var: dataframe read from mapping_variable_list.csv
+    :param names: column names of a decoded batch
+    :return: dict of column name to field name
+    """
+
+    # Map variable names to more descriptive names
+    varDict = var[['Variable Name', 'DESC']].to_dict('split')
+    varDict = dict(varDict['data'])
+
+    columns = {}
+    for name in names:
+        x = varDict.get(name, name)
+
+        # Replace space / special characters with underscore
+        x = re.sub(' ', '_', x)
+        x = re.sub(r'\(|\-|\/|\|\>|\)|\#', '', x)
+        x = re.sub(r'\>', 'GT', x)
+        columns[name] = x
+
+    return columns
+
+
+class DecodingContext(object):
+    """Reference data shared by every batch of a load
+
+    Built once by load_context so the mapping files are not re-read and
+    the lookups are not rebuilt for every batch.
+
+    :param layout: FixedWidthLayout of the kept variables
+    :param plan: TransformPlan compiled from the codebook
+    :param latitude: dict of state name to average latitude
+    :param longitude: dict of state name to average longitude
+    :param columns: dict of column name to Elasticsearch field name
+    :param chunk_rows: number of records packed at a time, see pack_records
+    :param year: survey year, None to number the documents by their position in the load
+    :param id_layout: FixedWidthLayout of the variables identifying a respondent
+    """
+
+    def __init__(self, layout, plan, latitude, longitude, columns, chunk_rows=DECODE_CHUNK, year=None, id_layout=None):
+        self.layout = layout
+        self.plan = plan
+        self.latitude = latitude
+        self.longitude = longitude
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.year = year
+        self.id_layout = id_layout
+
+    def decode(self, lines):
+        """Decode & transform a batch of records, see TransformPlan.decode"""
+
+        return self.plan.decode(lines, self.layout, self.chunk_rows)
+
+    def doc_ids(self, lines, count=1):
+        """Document ids of a batch of records
+
+        Without a survey year the records are numbered from count. With one
+        the ids are stable, see brfss_survey.respondent_ids.
+
+        :param lines: batch of records as bytes or iso-8859-1 strings
+        :param count: position in the load of the first record of the batch
+        :return: int64 array of ids
+        """
+
+        if self.year is None:
+            return np.arange(count, count + len(lines), dtype=np.int64)
+
+        keys = decode_records(lines, self.id_layout, numeric=self.id_layout.names, chunk_rows=self.chunk_rows, compact=True)
+        if keys.isna().any().any():
+            raise ValueError('Records without {0} have no stable id'.format(' or '.join(self.id_layout.names)))
+
+        return brfss_survey.respondent_ids(self.year, *[keys[name].to_numpy(dtype=np.int64) for name in brfss_survey.ID_VARIABLES])
+
+    def coordinates(self, states):
+        """Average coordinates of the states of a batch
+
+        :param states: state names, as decoded through the state lookup
+        :return: (latitude, longitude) float32 arrays, NaN when the state is blank or unknown
+        """
+
+        codes, uniq = pd.factorize(states)
+        lat = np.array([self.latitude.get(u, np.nan) for u in uniq] + [np.nan], dtype=np.float32)
+        lon = np.array([self.longitude.get(u, np.nan) for u in uniq] + [np.nan], dtype=np.float32)
+
+        return lat[codes], lon[codes]
+
+
+def load_context(dir, codebook=CODEBOOK, year=None):
+    """Read the mapping files & codebook into a DecodingContext
+
+    :param dir: Local directory holding the mapping files
+    :param codebook: codebook JSON file
+    :param year: survey year, read its variable list (see brfss_survey.mapping_file) & give
+                 the documents stable ids. None numbers them by position
+    :return: DecodingContext
+    """
+
+    # Each row in BRFSS data file correspondents to a respondent. The response to 321 questions is coded in
+    # a single 2365 character long numeric string. The mapping_variable_list.csv file contains a maps the column number
+    # to fields. For example, column 18-19 is a 2-digit code for the interview month
+    if year is None:
+        var = pd.read_csv(dir+'mapping_variable_list.csv')
+    else:
+        var = pd.read_csv(brfss_survey.mapping_file(dir, 'mapping_variable_list.csv', year))
+
+    # We will only be looking at a subset of the columns in this analysis - these columns have been coded with a
+    # Keep = Yes value in the variable list.
+    layout = variable_layout(var)
+
+    # id to state map & avg coordinates for state
+    st = pd.read_csv(dir+'mapping_state.csv')
+    st1 = st[['ID', 'State']].set_index('ID').to_dict('dict')['State']
+    lat = st.set_index('State')[['Latitude']].to_dict()['Latitude']
+    lon = st.set_index('State')[['Longitude']].to_dict()['Longitude']
+
+    # Map activity code to activity names
+    act = pd.read_csv(dir+'mapping_activity.csv', encoding='iso-8859-1')
+    act['Activity'] = act['Activity'].map(lambda x: re.sub(r'\s*$','', x))
+    act1 = act.set_index('ID').to_dict()['Activity']
+
+    # The codebook file lists the type, implied decimal places and code labels of each variable.
+    plan = compile_plan(load_codebook(codebook), {'state': st1, 'activity': act1})
+
+    columns = column_names(var, layout.names + ['Latitude', 'Longitude'])
+
+    # The state & sequence number identify a respondent, whether kept or not
+    id_layout = None if year is None else variable_layout(var, brfss_survey.ID_VARIABLES)
+
+    return DecodingContext(layout, plan, lat, lon, columns, year=year, id_layout=id_layout)
@@ -0,0 +1,252 @@
+#***********************************************
+# File: brfss_download.py
+# Desc: Download of the BRFSS data file
+# Purpose: Perform following operation:
+#          1. Stream the data file to disk in chunks
+#          2. Resume a partial download with HTTP Range requests
+#          3. Optionally fetch byte ranges of the file in parallel
+#          4. Skip the download when the cached file still matches the
+#             ETag / Last-Modified of the remote file
+#          5. Report the download throughput
+#************************************************/
+
+import os
+import json
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Bytes written to disk at a time
+CHUNK_SIZE = 1024 * 1024
+
+# Attempts to resume an interrupted download within a run
+RETRIES = 3
+
+# Seconds to wait for the server to connect & to send data
+TIMEOUT = 60
+
+
+def _meta_fn(fn):
+    return fn + '.meta'
+
+
+def read_meta(fn):
+    """Validators & progress recorded for a downloaded file, {} if none"""
+
+    try:
+        with open(_meta_fn(fn)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(fn, meta):
+    # Replace the file in one step so an interrupted run never leaves half a record
+    with open(_meta_fn(fn) + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(_meta_fn(fn) + '.tmp', _meta_fn(fn))
+
+
+def remote_info(url, timeout=TIMEOUT):
+    """Validators, size & range support of a remote file
+
+    :param url: file URL
+    :param timeout: seconds to wait for the server
+    :return: dict with url, etag, last_modified, size (None if unknown) & ranges
+    """
+
+    resp = requests.head(url, allow_redirects=True, timeout=timeout)
+    resp.raise_for_status()
+
+    h = resp.headers
+    return {'url': url,
+            'etag': h.get('ETag'),
+            'last_modified': h.get('Last-Modified'),
+            'size': int(h['Content-Length']) if 'Content-Length' in h else None,
+            'ranges': h.get('Accept-Ranges', '').lower() == 'bytes'}
+
+
+def same_version(meta, info):
+    """True if meta was recorded for the remote file described by info
+
+    A file without ETag or Last-Modified is never considered the same.
+    """
+
+    if not (info['etag'] or info['last_modified']):
+        return False
+
+    return all([meta.get(k) == info[k] for k in ('url', 'etag', 'last_modified', 'size')])
+
+
+def _validator(info):
+    return info['etag'] or info['last_modified']
+
+
+def _write_body(resp, f, chunk_size):
+    # Write a streamed response body & check that none of it went missing
+    written = 0
+    for chunk in resp.iter_content(chunk_size):
+        f.write(chunk)
+        written += len(chunk)
+
+    expected = resp.headers.get('Content-Length')
+    if expected is not None and written < int(expected):
+        raise IOError('Connection closed after {0} of {1} bytes'.format(written, expected))
+
+
+def _sequential(info, part, chunk_size, timeout):
+    # Continue from the end of the partial file. If-Range makes the server send
+    # the whole file instead of a range when the file changed in the meantime
+    offset = os.path.getsize(part) if os.path.exists(part) and info['ranges'] else 0
+    if info['size'] is not None and offset >= info['size']:
+        return offset
+
+    headers = {}
+    if offset:
+        headers = {'Range': 'bytes={0}-'.format(offset), 'If-Range': _validator(info)}
+
+    with requests.get(info['url'], headers=headers, stream=True, timeout=timeout) as resp:
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            offset = 0
+
+        with open(part, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            _write_body(resp, f, chunk_size)
+
+    return offset
+
+
+def _get_range(info, part, start, end, chunk_size, timeout):
+    headers = {'Range': 'bytes={0}-{1}'.format(start, end), 'If-Range': _validator(info)}
+
+    with requests.get(info['url'], headers=headers, stream=True, timeout=timeout) as resp:
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            raise IOError('Server did not return bytes {0}-{1} of {2}'.format(start, end, info['url']))
+
+        with open(part, 'r+b') as f:
+            f.seek(start)
+            _write_body(resp, f, chunk_size)
+
+    return start
+
+
+def byte_ranges(size, parts):
+    """Split size bytes into parts inclusive (start, end) ranges"""
+
+    step = -(-size // parts)
+
+    return [(st, min(st + step, size) - 1) for st in range(0, size, step)]
+
+
+def _parallel(info, fn, part, meta, parts, chunk_size, timeout):
+    # The partial file is allocated at full size & every range written in
+    # place. Completed ranges are recorded in the meta file so a resumed
+    # download only fetches the others
+    if not os.path.exists(part):
+        with open(part, 'wb') as f:
+            f.truncate(info['size'])
+
+    todo = [r for r in byte_ranges(info['size'], parts) if r[0] not in meta['done']]
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=parts) as pool:
+        futures = [pool.submit(_get_range, info, part, st, en, chunk_size, timeout) for st, en in todo]
+        for future in as_completed(futures):
+            try:
+                meta['done'].append(future.result())
+                _write_meta(fn, meta)
+            except (requests.RequestException, IOError) as e:
+                errors.append(e)
+
+    # Ranges that made it are kept even when others failed
+    if errors:
+        raise errors[0]
+
+
+def download(url, fn, parts=1, chunk_size=CHUNK_SIZE, retries=RETRIES, timeout=TIMEOUT):
+    """Download a file, resuming or skipping work done by earlier runs
+
+    The file is written to fn + '.part' and renamed to fn when complete.
+    The remote ETag, Last-Modified & size are kept in fn + '.meta': a
+    complete file that still matches them is not fetched again, and a
+    partial one is resumed with Range requests. Servers that do not support
+    ranges get the whole file every time.
+
+    :param url: file URL
+    :param fn: local file name
+    :param parts: number of byte ranges fetched in parallel, 1 to stream the file in one request
+    :param chunk_size: bytes written to disk at a time
+    :param retries: attempts to resume an interrupted download within the run
+    :param timeout: seconds to wait for the server
+    :return: dict with file, size, bytes fetched, bytes resumed, cached & seconds
+    """
+
+    st_time = time.perf_counter()
+    info = remote_info(url, timeout)
+    meta = read_meta(fn)
+    part = fn + '.part'
+
+    stats = {'file': fn, 'size': info['size'], 'bytes': 0, 'resumed': 0, 'cached': False, 'seconds': 0.0}
+
+    if meta.get('complete') and same_version(meta, info) and os.path.exists(fn) \
+            and info['size'] in (None, os.path.getsize(fn)):
+        stats['cached'] = True
+        stats['seconds'] = time.perf_counter() - st_time
+        return stats
+
+    parallel = parts > 1 and info['ranges'] and bool(info['size'])
+    mode = parts if parallel else 1
+
+    # A partial file of another version, or fetched another way, is started over
+    if not (info['ranges'] and same_version(meta, info) and meta.get('parts') == mode and os.path.exists(part)):
+        if os.path.exists(part):
+            os.remove(part)
+        meta = dict([(k, info[k]) for k in ('url', 'etag', 'last_modified', 'size')])
+        meta.update({'parts': mode, 'done': [], 'complete': False})
+        _write_meta(fn, meta)
+
+    if parallel:
+        ranges = dict(byte_ranges(info['size'], parts))
+        stats['resumed'] = sum([ranges[st] - st + 1 for st in meta['done']])
+
+    for attempt in range(retries + 1):
+        try:
+            if parallel:
+                _parallel(info, fn, part, meta, parts, chunk_size, timeout)
+            else:
+                offset = _sequential(info, part, chunk_size, timeout)
+                if attempt == 0:
+                    stats['resumed'] = offset
+            break
+
+        except (requests.RequestException, IOError) as e:
+            if attempt == retries:
+                raise
+            print('Download of {0} interrupted ({1}), resuming ...'.format(url, e))
+            time.sleep(min(2 ** attempt, 30))
+
+    os.replace(part, fn)
+    meta['complete'] = True
+    _write_meta(fn, meta)
+
+    stats['bytes'] = os.path.getsize(fn) - stats['resumed']
+    stats['seconds'] = time.perf_counter() - st_time
+
+    return stats
+
+
+def download_report(stats):
+    """Format the result of a download run"""
+
+    if stats['cached']:
+        return '{0} is up to date, download skipped'.format(stats['file'])
+
+    sec = max(stats['seconds'], 1e-9)
+    msg = 'Downloaded {0:.1f} MB in {1:.2f}s ({2:.2f} MB/s)'.format(stats['bytes'] / 1e6, stats['seconds'], stats['bytes'] / sec / 1e6)
+    if stats['resumed']:
+        msg += ', resumed after {0:.1f} MB'.format(stats['resumed'] / 1e6)
+
+    return msg
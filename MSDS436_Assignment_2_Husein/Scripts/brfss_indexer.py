@@ -0,0 +1,413 @@
+#***********************************************
+# File: brfss_indexer.py
+# Desc: Bulk indexing of BRFSS respondents into Elasticsearch
+# Purpose: Perform following operation:
+#          1. Serialize a batch of respondents to JSON in one pass & build the bulk actions
+#          2. Send them with elasticsearch.helpers.streaming_bulk
+#          3. Keep a bounded number of bulk requests in flight
+#          4. Retry rejected documents with backoff, count the retries & report throughput
+#          5. Checkpoint the batches acknowledged by Elasticsearch
+#          6. Bulk-load index settings (no refresh, no replicas) during a load
+#          7. Upsert documents by id, counting the ones Elasticsearch found unchanged
+#************************************************/
+
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from elasticsearch import helpers, TransportError
+
+# Defaults for the bulk requests sent to the AWS ES domain
+CHUNK_SIZE      = 500
+MAX_CHUNK_BYTES = 10 * 1024 * 1024
+MAX_IN_FLIGHT   = 4
+MAX_RETRIES     = 5
+INITIAL_BACKOFF = 2
+MAX_BACKOFF     = 60
+
+
+def _json_values(col):
+    # JSON text of every value of a column, null for blanks. numpy formats
+    # floats with the shortest repr, as json.dumps does
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        codes, uniques = col.cat.codes.values, col.cat.categories
+
+    elif pd.api.types.is_integer_dtype(col.dtype):
+        text = col.to_numpy(dtype=np.int64, na_value=0).astype(str)
+        return np.where(col.isna().values, 'null', text).astype(object)
+
+    elif pd.api.types.is_float_dtype(col.dtype):
+        values = col.values
+        return np.where(np.isnan(values), 'null', values.astype(str)).astype(object)
+
+    else:
+        codes, uniques = pd.factorize(col)
+
+    # Other columns are encoded once per distinct value, code -1 (null) picks the trailing 'null'
+    encoded = [json.dumps(u.item() if isinstance(u, np.generic) else u) for u in uniques]
+
+    return np.array(encoded + ['null'], dtype=object)[codes]
+
+
+def respondent_sources(t1):
+    """Serialize a batch of respondents to JSON documents
+
+    Values are encoded column by column & the documents assembled with one
+    join per row. Blank answers are written as null. Coordinates holds
+    [Longitude, Latitude] for geo queries, null when the state has none.
+
+    :param t1: transformed dataframe, one row per respondent
+    :return: list of JSON strings in row order
+    """
+
+    parts = []
+    for name in t1.columns:
+        parts.append(json.dumps(str(name)) + ': ' + _json_values(t1[name]))
+
+    lon = _json_values(t1['Longitude'])
+    lat = _json_values(t1['Latitude'])
+    coords = '[' + lon + ', ' + lat + ']'
+    parts.append('"Coordinates": ' + np.where((lon == 'null') | (lat == 'null'), 'null', coords).astype(object))
+
+    return ['{' + ', '.join(row) + '}' for row in zip(*parts)]
+
+
+def source_actions(sources, ids, index_name, doc_name):
+    """Yield a bulk index action for every serialized document
+
+    :param sources: JSON documents, see respondent_sources
+    :param ids: document id of each document
+    :param index_name: Elasticsearch index
+    :param doc_name: Elasticsearch document type
+    """
+
+    for subj_id, source in zip(ids, sources):
+        yield {'_index': index_name,
+               '_type': doc_name,
+               '_id': int(subj_id),
+               '_source': source}
+
+
+def _chunks(actions, size):
+    chunk = []
+    for action in actions:
+        chunk.append(action)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upsert_action(action):
+    """Expand an index action into an update that creates the document if missing
+
+    Used as the expand_action_callback of streaming_bulk. Elasticsearch
+    compares the merged document with the stored one & answers noop without
+    writing anything when it is unchanged.
+
+    :param action: bulk index action with a JSON string _source, see source_actions
+    :return: (action, data) pair of the bulk request lines
+    """
+
+    meta = dict([(k, action[k]) for k in ('_index', '_type', '_id') if k in action])
+
+    return {'update': meta}, '{"doc": ' + action['_source'] + ', "doc_as_upsert": true}'
+
+
+def _send_chunk(es, chunk, chunk_size, max_chunk_bytes, max_retries, initial_backoff, max_backoff, upsert=False):
+    errors = []
+    retries = 0
+    unchanged = 0
+    todo = chunk
+    expand = upsert_action if upsert else helpers.expand_action
+
+    # Documents rejected with a 429 are re-sent on their own with exponential
+    # backoff, the same way streaming_bulk retries them, but counted here
+    for attempt in range(max_retries + 1):
+        rejected = []
+
+        try:
+            for ok, info in helpers.streaming_bulk(es, todo,
+                                                   chunk_size=chunk_size,
+                                                   max_chunk_bytes=max_chunk_bytes,
+                                                   max_retries=0,
+                                                   expand_action_callback=expand,
+                                                   raise_on_error=False):
+                item = list(info.values())[0]
+                if ok:
+                    unchanged += item.get('result') == 'noop'
+                elif item.get('status') == 429 and attempt < max_retries:
+                    rejected.append(str(item['_id']))
+                else:
+                    errors.append(info)
+
+        # The whole request was rejected, documents are indexed by id so re-sending all is safe
+        except TransportError as e:
+            if e.status_code != 429 or attempt == max_retries:
+                raise
+            rejected = [str(a['_id']) for a in todo]
+
+        if not rejected:
+            break
+
+        time.sleep(min(max_backoff, initial_backoff * 2 ** attempt))
+        retries += len(rejected)
+        rejected = set(rejected)
+        todo = [a for a in todo if str(a['_id']) in rejected]
+
+    # Bytes of the bulk body of the chunk, action & document lines as the client serializes them
+    dumps = es.transport.serializer.dumps
+    nbytes = 0
+    for meta, data in map(expand, chunk):
+        nbytes += len(dumps(meta).encode('utf-8')) + 1
+        if data is not None:
+            nbytes += len((data if isinstance(data, str) else dumps(data)).encode('utf-8')) + 1
+
+    return len(chunk), nbytes, errors, retries, unchanged
+
+
+def bulk_index(es, actions,
+               chunk_size=CHUNK_SIZE,
+               max_chunk_bytes=MAX_CHUNK_BYTES,
+               max_in_flight=MAX_IN_FLIGHT,
+               max_retries=MAX_RETRIES,
+               initial_backoff=INITIAL_BACKOFF,
+               max_backoff=MAX_BACKOFF,
+               upsert=False,
+               raise_on_error=True):
+    """Index actions into Elasticsearch with bulk requests
+
+    Actions are cut into requests of at most chunk_size documents and
+    max_chunk_bytes bytes, and at most max_in_flight requests are sent
+    concurrently. The producer is not read ahead of the requests in flight.
+
+    :param es: Elasticsearch client
+    :param actions: iterable of bulk actions (see source_actions)
+    :param chunk_size: documents per bulk request
+    :param max_chunk_bytes: bytes per bulk request
+    :param max_in_flight: number of concurrent bulk requests
+    :param max_retries: retries of a document rejected with 429, 0 to disable
+    :param initial_backoff: seconds to wait before the first retry, doubled on every retry
+    :param max_backoff: maximum seconds to wait between retries
+    :param upsert: send the documents as upserts, see upsert_action
+    :param raise_on_error: raise BulkIndexError if documents still failed after the retries
+    :return: dict with docs, failed, bytes (UTF-8 bulk bodies, retries excluded), retries
+             (documents re-sent), unchanged (upserts Elasticsearch skipped), seconds & errors of the run
+    """
+
+    stats = {'docs': 0, 'failed': 0, 'bytes': 0, 'retries': 0, 'unchanged': 0, 'seconds': 0.0, 'errors': []}
+    st_time = time.perf_counter()
+
+    def collect(done):
+        for future in done:
+            docs, nbytes, errors, retries, unchanged = future.result()
+            stats['docs'] += docs - len(errors)
+            stats['failed'] += len(errors)
+            stats['bytes'] += nbytes
+            stats['retries'] += retries
+            stats['unchanged'] += unchanged
+            stats['errors'].extend(errors)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        pending = set()
+        for chunk in _chunks(actions, chunk_size):
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(pool.submit(_send_chunk, es, chunk, chunk_size, max_chunk_bytes,
+                                    max_retries, initial_backoff, max_backoff, upsert))
+
+        collect(wait(pending).done)
+
+    stats['seconds'] = time.perf_counter() - st_time
+
+    if raise_on_error and stats['errors']:
+        raise helpers.BulkIndexError('{0} document(s) failed to index.'.format(stats['failed']), stats['errors'])
+
+    return stats
+
+
+def throughput(stats):
+    """Format the throughput of a bulk_index run
+
+    :param stats: dict returned by bulk_index
+    :return: printable summary
+    """
+
+    sec = max(stats['seconds'], 1e-9)
+
+    msg = 'Indexed {0} docs in {1:.2f}s ({2:,.0f} docs/s, {3:.2f} MB/s), {4} retried, {5} failed'.format(
+        stats['docs'], stats['seconds'], stats['docs'] / sec, stats['bytes'] / sec / 1e6, stats.get('retries', 0), stats['failed'])
+    if stats.get('unchanged'):
+        msg += ', {0} unchanged'.format(stats['unchanged'])
+
+    return msg
+
+
+def failed_ids(stats):
+    """Document ids that failed in a bulk_index run
+
+    :param stats: dict returned by bulk_index
+    :return: sorted list of integer ids
+    """
+
+    ids = []
+    for error in stats['errors']:
+        for op_type, item in error.items():
+            ids.append(int(item['_id']))
+
+    return sorted(ids)
+
+
+class Checkpoint(object):
+    """Record of the batches acknowledged by Elasticsearch
+
+    The checkpoint file holds a header describing the load followed by one
+    JSON line per indexed batch with its id range & the ids that failed.
+    A load started with resume=True skips the complete batches & only
+    re-sends the missing documents of the others.
+
+    :param fn: checkpoint file
+    :param source: name of the data file being loaded
+    :param batch_size: number of records per batch
+    :param resume: keep the batches already recorded in fn
+    """
+
+    def __init__(self, fn, source, batch_size, resume=False):
+        self.fn = fn
+        self.header = {'source': source, 'batch_size': batch_size}
+        self.done = {}
+
+        if resume and os.path.exists(fn):
+            with open(fn) as f:
+                header = json.loads(f.readline())
+                if header != self.header:
+                    raise ValueError('Checkpoint {0} was written for {1}, not {2}'.format(fn, header, self.header))
+
+                for line in f:
+                    batch = json.loads(line)
+                    self.done[batch['start']] = batch['failed']
+        else:
+            with open(fn, 'w') as f:
+                f.write(json.dumps(self.header) + '\n')
+
+    def pending(self, start):
+        """Ids of a batch that still have to be indexed
+
+        :param start: document id of the first record of the batch
+        :return: None if the whole batch is missing, else the list of failed
+                 ids (empty when the batch is complete)
+        """
+
+        return self.done.get(start)
+
+    def record(self, start, end, failed):
+        """Append an acknowledged batch to the checkpoint file
+
+        :param start: document id of the first record of the batch
+        :param end: document id of the last record of the batch
+        :param failed: ids of the batch that were not indexed
+        """
+
+        self.done[start] = list(failed)
+
+        with open(self.fn, 'a') as f:
+            f.write(json.dumps({'start': start, 'end': end, 'failed': list(failed)}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def missing(self):
+        """Number of documents recorded as failed"""
+
+        return sum([len(failed) for failed in self.done.values()])
+
+
+# Index settings switched off while bulk loading
+BULK_LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+
+def segment_count(es, index_name):
+    """Number of Lucene segments of the primary shards of an index"""
+
+    resp = es.indices.segments(index=index_name)
+
+    count = 0
+    for shard in resp['indices'].get(index_name, {}).get('shards', {}).values():
+        for copy in shard:
+            if copy.get('routing', {}).get('primary', True):
+                count += len(copy.get('segments', {}))
+
+    return count
+
+
+@contextmanager
+def bulk_load_mode(es, index_name, force_merge=0):
+    """Switch an index to bulk-load settings for the duration of a load
+
+    Refresh & replicas are turned off before the load. The original
+    settings are put back & the index refreshed afterwards, also when the
+    load raises, so the index is always left searchable. A force-merge is
+    only run after a successful load.
+
+    :param es: Elasticsearch client
+    :param index_name: Elasticsearch index
+    :param force_merge: number of segments to force-merge to, 0 to skip
+    :return: dict report of timings & segment counts, see load_report
+    """
+
+    # Settings not set explicitly are restored to their default with None
+    resp = es.indices.get_settings(index=index_name)
+    current = resp[index_name]['settings']['index']
+    original = dict([(k, current.get(k)) for k in BULK_LOAD_SETTINGS])
+
+    report = {'index': index_name, 'original': original,
+              'segments_before': segment_count(es, index_name)}
+
+    es.indices.put_settings(index=index_name, body={'index': BULK_LOAD_SETTINGS})
+    st_time = time.perf_counter()
+    completed = False
+
+    try:
+        yield report
+        completed = True
+
+    finally:
+        report['load'] = time.perf_counter() - st_time
+
+        st_time = time.perf_counter()
+        es.indices.put_settings(index=index_name, body={'index': original})
+        es.indices.refresh(index=index_name)
+        report['restore'] = time.perf_counter() - st_time
+        report['segments_after'] = segment_count(es, index_name)
+
+        if not completed:
+            print('Load aborted, settings of {0} restored to {1}'.format(index_name, original))
+
+    if force_merge:
+        st_time = time.perf_counter()
+        es.indices.forcemerge(index=index_name, max_num_segments=force_merge, request_timeout=3600)
+        report['force_merge'] = time.perf_counter() - st_time
+        report['segments_merged'] = segment_count(es, index_name)
+
+
+def load_report(report):
+    """Format the report of a bulk_load_mode run"""
+
+    lines = ['Bulk load report for {0}'.format(report['index']),
+             '  load              : {0:10.2f}s'.format(report['load']),
+             '  restore & refresh : {0:10.2f}s'.format(report['restore'])]
+
+    if 'force_merge' in report:
+        lines.append('  force merge       : {0:10.2f}s'.format(report['force_merge']))
+
+    lines.append('  segments          : {0} before, {1} after load'.format(report['segments_before'], report['segments_after']))
+
+    if 'segments_merged' in report:
+        lines.append('                      {0} after force merge'.format(report['segments_merged']))
+
+    return '\n'.join(lines)
@@ -0,0 +1,227 @@
+#***********************************************
+# File: brfss_profile.py
+# Desc: Time & memory of the BRFSS processing stages
+# Purpose: Perform following operation:
+#          1. Time each stage of a batch
+#          2. Record the peak allocation of each stage with tracemalloc
+#          3. Report the peak resident set size of the load
+#          4. Count documents, bytes & retries & total the stage timers of a load
+#          5. Emit the metrics as JSON lines & as a Prometheus text file
+#************************************************/
+
+import os
+import sys
+import json
+import time
+import threading
+import resource
+import tracemalloc
+from contextlib import contextmanager
+
+
+def start_tracing():
+    """Start tracemalloc in the current process, if not already tracing"""
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextmanager
+def stage(name, timing, memory=None):
+    """Time a stage & record its peak allocation
+
+    The allocation is only recorded while tracemalloc is tracing, see
+    start_tracing. It is the peak of the memory traced during the stage
+    above what was traced when the stage started.
+
+    :param name: stage name
+    :param timing: dict of stage name to seconds, updated on exit
+    :param memory: dict of stage name to peak bytes allocated, updated on exit
+    """
+
+    tracing = memory is not None and tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+
+    st_time = time.perf_counter()
+    yield
+    timing[name] = time.perf_counter() - st_time
+
+    if tracing:
+        memory[name] = tracemalloc.get_traced_memory()[1] - base
+
+
+def peak_rss(children=False):
+    """Peak resident set size in bytes
+
+    :param children: peak of the terminated child processes (e.g. decoding
+                     workers) instead of the current process
+    """
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def format_memory(memory):
+    """Format the peak allocation of each stage"""
+
+    return ', '.join(['{0} {1:.1f} MB'.format(k, v / 1e6) for k, v in memory.items()])
+
+
+# Stages of a batch in pipeline order: read the records from the source,
+# slice & decode the fields, transform, keep (Parquet, rollup), serialize to
+# JSON & send to Elasticsearch
+STAGES = ['read', 'slice', 'transform', 'parquet', 'rollup', 'serialize', 'index']
+
+# Counters of a load & their Prometheus help text
+COUNTERS = [('batches', 'Batches indexed'),
+            ('batches_skipped', 'Batches skipped as already indexed'),
+            ('records', 'Records read from the source'),
+            ('docs_indexed', 'Documents acknowledged by Elasticsearch'),
+            ('docs_failed', 'Documents that failed to index after the retries'),
+            ('docs_unchanged', 'Upserted documents Elasticsearch found unchanged'),
+            ('bytes_sent', 'Bytes of documents sent in bulk requests'),
+            ('retries', 'Documents re-sent after a 429 rejection')]
+
+
+class Metrics(object):
+    """Counters & stage timers of a load
+
+    Every batch is emitted as one JSON line with its stage timings & counts.
+    The Prometheus file, if any, is rewritten after every batch with the
+    running totals & the throughput of the last batch, so a textfile
+    collector always reads a complete file.
+
+    :param fn: JSON lines file, '-' for stdout, None to keep the metrics in memory only
+    :param prom_fn: Prometheus text format file, None to skip
+    :param job: value of the job label of the Prometheus metrics
+    """
+
+    def __init__(self, fn=None, prom_fn=None, job='brfss'):
+        self.fn = fn
+        self.prom_fn = prom_fn
+        self.job = job
+        self.counters = dict([(name, 0) for name, help in COUNTERS])
+        self.seconds = dict([(stage, 0.0) for stage in STAGES])
+        self.last_rate = 0.0
+        self.last_batch = 0.0
+        self.st_time = time.time()
+        self.lock = threading.Lock()
+
+        self.out = None
+        if fn == '-':
+            self.out = sys.stdout
+        elif fn:
+            self.out = open(fn, 'a')
+
+    def emit(self, event, **fields):
+        """Write one JSON line for an event"""
+
+        if self.out is None:
+            return
+
+        line = dict([('ts', round(time.time(), 3)), ('event', event)] + sorted(fields.items()))
+        with self.lock:
+            self.out.write(json.dumps(line) + '\n')
+            self.out.flush()
+
+    def batch(self, start, rows, timing, stats=None, memory=None):
+        """Record an indexed batch
+
+        :param start: document id of the first record of the batch
+        :param rows: number of records of the batch
+        :param timing: dict of stage name to seconds
+        :param stats: dict returned by brfss_indexer.bulk_index
+        :param memory: dict of stage name to peak bytes allocated
+        """
+
+        stats = stats or {}
+
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['records'] += rows
+            self.counters['docs_indexed'] += stats.get('docs', 0)
+            self.counters['docs_failed'] += stats.get('failed', 0)
+            self.counters['docs_unchanged'] += stats.get('unchanged', 0)
+            self.counters['bytes_sent'] += stats.get('bytes', 0)
+            self.counters['retries'] += stats.get('retries', 0)
+            for stage, sec in timing.items():
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + sec
+            if timing.get('index'):
+                self.last_rate = stats.get('docs', 0) / timing['index']
+            self.last_batch = time.time()
+
+        self.emit('batch', start=start, rows=rows,
+                  seconds=dict([(k, round(v, 6)) for k, v in timing.items()]),
+                  docs=stats.get('docs', 0), failed=stats.get('failed', 0),
+                  bytes=stats.get('bytes', 0), retries=stats.get('retries', 0),
+                  unchanged=stats.get('unchanged', 0),
+                  docs_per_s=round(self.last_rate, 1), memory=memory or {})
+        self.write_prometheus()
+
+    def skip(self, start, rows):
+        """Record a batch skipped as already indexed"""
+
+        with self.lock:
+            self.counters['batches_skipped'] += 1
+            self.counters['records'] += rows
+
+        self.emit('skip', start=start, rows=rows)
+
+    def summary(self):
+        """Totals of the load as a dict"""
+
+        elapsed = time.time() - self.st_time
+        return dict(list(self.counters.items()) +
+                    [('seconds', dict([(k, round(v, 3)) for k, v in self.seconds.items() if v])),
+                     ('elapsed', round(elapsed, 3)),
+                     ('docs_per_s', round(self.counters['docs_indexed'] / max(elapsed, 1e-9), 1))])
+
+    def close(self):
+        """Emit the totals of the load & close the JSON lines file"""
+
+        self.emit('summary', **self.summary())
+        self.write_prometheus()
+
+        if self.out is not None and self.out is not sys.stdout:
+            self.out.close()
+        self.out = None
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+
+        label = 'job="{0}"'.format(self.job)
+        lines = []
+
+        with self.lock:
+            for name, help in COUNTERS:
+                lines += ['# HELP brfss_{0}_total {1}'.format(name, help),
+                          '# TYPE brfss_{0}_total counter'.format(name),
+                          'brfss_{0}_total{{{1}}} {2}'.format(name, label, self.counters[name])]
+
+            lines += ['# HELP brfss_stage_seconds_total Seconds spent in each stage of the batches',
+                      '# TYPE brfss_stage_seconds_total counter']
+            for stage, sec in self.seconds.items():
+                lines.append('brfss_stage_seconds_total{{{0},stage="{1}"}} {2:.6f}'.format(label, stage, sec))
+
+            lines += ['# HELP brfss_index_docs_per_second Indexing throughput of the last batch',
+                      '# TYPE brfss_index_docs_per_second gauge',
+                      'brfss_index_docs_per_second{{{0}}} {1:.1f}'.format(label, self.last_rate),
+                      '# HELP brfss_last_batch_timestamp_seconds Time the last batch was indexed',
+                      '# TYPE brfss_last_batch_timestamp_seconds gauge',
+                      'brfss_last_batch_timestamp_seconds{{{0}}} {1:.3f}'.format(label, self.last_batch)]
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self):
+        """Rewrite the Prometheus file in one step, if one was given"""
+
+        if not self.prom_fn:
+            return
+
+        with open(self.prom_fn + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.replace(self.prom_fn + '.tmp', self.prom_fn)
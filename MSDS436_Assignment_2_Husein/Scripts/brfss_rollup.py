@@ -0,0 +1,320 @@
+#***********************************************
+# File: brfss_rollup.py
+# Desc: Rollups of the BRFSS respondents for dashboard counts
+# Purpose: Perform following operation:
+#          1. Count respondents & answers by state, age group & sex
+#             while batches are loaded
+#          2. Keep the sums of the key measures for their means
+#          3. Write the rollup to Parquet & to a companion Elasticsearch index,
+#             retrying rejected rows & replacing the rows of earlier loads once all are in
+#          4. Answer counts & means from the rollup instead of the
+#             respondent index
+#************************************************/
+
+# pip3 install --user pyarrow
+
+import time
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser
+from argparse import RawTextHelpFormatter
+import brfss_indexer
+
+# Variables the respondents are grouped by
+DIMENSIONS = ['_STATE', '_AGEG5YR', 'SEX']
+
+# Coded answers counted by value in each group
+ANSWERS = ['GENHLTH', '_BMI5CAT', '_TOTINDA', '_PACAT1', '_PAREC1', '_RFBING5',
+           'EXERANY2', 'QLACTLM2', 'DECIDE', 'DIFFWALK', '_EDUCAG', '_INCOMG']
+
+# Measures summed in each group for their means
+MEASURES = ['_BMI5', 'WTKG3', 'HTM4']
+
+# Variable of the rows counting every respondent of a group
+RESPONDENTS = 'Respondents'
+
+# Group value of respondents with a blank dimension
+BLANK = 'Blank'
+
+# Companion index of the rollups of all the years
+ROLLUP_INDEX = 'brfss-rollup'
+
+# Combine the per-batch rollups after this many batches
+MERGE_EVERY = 50
+
+
+def aggregate(t1, dims, answers, measures):
+    """Rollup of one batch
+
+    Groups & answers are numbered with pd.factorize & every answer or
+    measure is counted with one np.bincount over the group numbers.
+
+    :param t1: transformed dataframe, one row per respondent
+    :param dims: field names the respondents are grouped by
+    :param answers: field names of coded answers counted by value
+    :param measures: field names of measures summed
+    :return: dataframe with the dims, Variable, Value, Count & Sum columns
+    """
+
+    # Number the groups. Blank dimensions are kept as a group of their own
+    keys = pd.DataFrame(dict([(d, t1[d].astype(object).fillna(BLANK).values) for d in dims]))
+    combined = np.zeros(len(t1), dtype=np.int64)
+    for d in dims:
+        codes, uniques = pd.factorize(keys[d])
+        combined = combined * len(uniques) + codes
+    group, combined = pd.factorize(combined)
+    n = len(combined)
+    first = np.unique(group, return_index=True)[1]
+
+    parts = [(np.arange(n), RESPONDENTS, None, np.bincount(group, minlength=n), np.zeros(n))]
+
+    # Blank answers & measures are not counted
+    for name in answers:
+        codes, uniques = pd.factorize(t1[name])
+        found = codes >= 0
+        count = np.bincount(group[found] * len(uniques) + codes[found], minlength=n * len(uniques))
+        hit = np.flatnonzero(count)
+        values = np.array(list(uniques), dtype=object)[hit % len(uniques)] if len(uniques) else None
+        parts.append((hit // max(len(uniques), 1), name, values, count[hit], np.zeros(len(hit))))
+
+    for name in measures:
+        values = t1[name].to_numpy(dtype=np.float64, na_value=np.nan)
+        found = ~np.isnan(values)
+        count = np.bincount(group[found], minlength=n)
+        total = np.bincount(group[found], weights=values[found], minlength=n)
+        hit = np.flatnonzero(count)
+        parts.append((hit, name, None, count[hit], total[hit]))
+
+    groups = np.concatenate([p[0] for p in parts])
+    frame = keys.iloc[first[groups]].reset_index(drop=True)
+    frame['Variable'] = np.concatenate([np.full(len(p[0]), p[1], dtype=object) for p in parts])
+    frame['Value'] = np.concatenate([np.full(len(p[0]), '', dtype=object) if p[2] is None else p[2] for p in parts])
+    frame['Count'] = np.concatenate([p[3] for p in parts]).astype(np.int64)
+    frame['Sum'] = np.concatenate([p[4] for p in parts]).astype(np.float64)
+
+    return frame
+
+
+class Rollup(object):
+    """Rollup of the respondents of a load
+
+    Every batch is aggregated on its own & the small per-batch tables
+    combined as the load goes, so the rollup costs one pass over the data
+    already decoded for indexing.
+
+    :param ctx: DecodingContext of the load, for the field names & survey year
+    :param dims: variables the respondents are grouped by
+    :param answers: coded answers counted by value, those not kept are skipped
+    :param measures: measures summed for their means, those not kept are skipped
+    """
+
+    def __init__(self, ctx, dims=DIMENSIONS, answers=ANSWERS, measures=MEASURES):
+        self.year = ctx.year
+        self.dims = [ctx.columns[v] for v in dims]
+        self.answers = [ctx.columns[v] for v in answers if v in ctx.columns]
+        self.measures = [ctx.columns[v] for v in measures if v in ctx.columns]
+        self.parts = []
+        self.rows = 0
+
+    def add(self, t1):
+        """Add a transformed batch to the rollup"""
+
+        self.parts.append(aggregate(t1, self.dims, self.answers, self.measures))
+        self.rows += len(t1)
+
+        if len(self.parts) >= MERGE_EVERY:
+            self.parts = [self._combine()]
+
+    def _combine(self):
+        keys = self.dims + ['Variable', 'Value']
+        return pd.concat(self.parts, ignore_index=True).groupby(keys, sort=False)[['Count', 'Sum']].sum().reset_index()
+
+    def table(self):
+        """Rollup of the batches added so far
+
+        :return: dataframe with Year, the dims, Variable, Value (None for
+                 respondent & measure rows), Count, Sum & Mean (NaN for
+                 counted rows)
+        """
+
+        table = self._combine().sort_values(self.dims + ['Variable', 'Value'], ignore_index=True)
+        table.insert(0, 'Year', self.year)
+
+        counted = ~table['Variable'].isin(self.measures)
+        table.loc[counted, 'Sum'] = float('nan')
+        table['Mean'] = table['Sum'] / table['Count']
+        table['Value'] = table['Value'].where(table['Value'] != '', None)
+        table['Count'] = table['Count'].astype('int64')
+
+        return table
+
+
+def write_parquet(table, fn):
+    """Write a rollup to a Parquet file"""
+
+    table.to_parquet(fn, index=False)
+
+
+def read_parquet(fn):
+    """Read a rollup written by write_parquet"""
+
+    return pd.read_parquet(fn)
+
+
+def rollup_mapping(table):
+    """Index mapping of a rollup: exact match on the groups, numbers for the counts"""
+
+    properties = dict([(c, {'type': 'keyword'}) for c in table.columns if c not in ('Year', 'Count', 'Sum', 'Mean')])
+    properties.update({'Year': {'type': 'integer'}, 'Loaded': {'type': 'long'}, 'Count': {'type': 'long'},
+                       'Sum': {'type': 'double'}, 'Mean': {'type': 'double'}})
+
+    return {'mappings': {'properties': properties}}
+
+
+def rollup_ids(table):
+    """Document id of every rollup row, a 64-bit hash of its year, group, variable & value"""
+
+    keys = [c for c in table.columns if c not in ('Count', 'Sum', 'Mean', 'Loaded')]
+    hashes = pd.util.hash_pandas_object(table[keys], index=False).values
+
+    return ['{0:016x}'.format(h) for h in hashes]
+
+
+def index_rollup(es, table, index_name=ROLLUP_INDEX, bulk_opts=None):
+    """Replace the rollup of a year in the companion index
+
+    The rows are sent with brfss_indexer.bulk_index, which retries the
+    ones rejected with 429. Every row carries the time of the load in
+    Loaded, and once all of them are indexed the rows of the year left by
+    earlier loads are deleted, so groups gone from the data do not linger.
+    If rows failed, the earlier rows are kept.
+
+    :param es: Elasticsearch client
+    :param table: dataframe returned by Rollup.table
+    :param index_name: companion index
+    :param bulk_opts: options passed to brfss_indexer.bulk_index
+    :return: dict of bulk_index with docs, failed, bytes, retries, seconds & errors, plus
+             deleted (earlier rows removed)
+    """
+
+    if not es.indices.exists(index_name):
+        es.indices.create(index_name, body=rollup_mapping(table))
+
+    loaded = int(time.time() * 1000)
+    sources = table.assign(Loaded=loaded).to_json(orient='records', lines=True).splitlines() if len(table) else []
+
+    actions = [{'_index': index_name, '_id': doc_id, '_source': source} for doc_id, source in zip(rollup_ids(table), sources)]
+    stats = brfss_indexer.bulk_index(es, actions, **dict(bulk_opts or {}, upsert=False, raise_on_error=False))
+    stats['deleted'] = 0
+
+    if len(table) and not stats['failed']:
+        query = {'bool': {'filter': [{'term': {'Year': int(table['Year'].iloc[0])}}],
+                          'must_not': [{'term': {'Loaded': loaded}}]}}
+        stats['deleted'] = es.delete_by_query(index=index_name, body={'query': query}, refresh=True)['deleted']
+    else:
+        es.indices.refresh(index=index_name)
+
+    return stats
+
+
+def _matches(table, variable, value, where):
+    mask = table['Variable'] == (variable or RESPONDENTS)
+    if value is not None:
+        mask &= table['Value'] == value
+    for field, wanted in (where or {}).items():
+        mask &= table[field] == wanted
+
+    return table[mask]
+
+
+def rollup_count(table, variable=None, value=None, where=None, group_by=None):
+    """Count respondents from a rollup
+
+    rollup_count(t, 'General_Health', 'Poor') gives the count of
+    brfss/_count?q=General_Health:Poor.
+
+    :param table: rollup dataframe, see Rollup.table & read_parquet
+    :param variable: field of a coded answer, None to count all respondents
+    :param value: answer counted, None for any answer
+    :param where: dict of field to the value it must have, e.g. {'Sex': 'Female'}
+    :param group_by: field (or list) to break the count down by
+    :return: count, or a Series of counts by group
+    """
+
+    rows = _matches(table, variable, value, where)
+    if group_by:
+        return rows.groupby(group_by)['Count'].sum()
+
+    return int(rows['Count'].sum())
+
+
+def rollup_mean(table, variable, where=None, group_by=None):
+    """Mean of a measure from a rollup
+
+    :param table: rollup dataframe, see Rollup.table & read_parquet
+    :param variable: field of a measure
+    :param where: dict of field to the value it must have
+    :param group_by: field (or list) to break the mean down by
+    :return: mean, or a Series of means by group
+    """
+
+    rows = _matches(table, variable, None, where)
+    if group_by:
+        sums = rows.groupby(group_by)[['Sum', 'Count']].sum()
+        return sums['Sum'] / sums['Count']
+
+    return rows['Sum'].sum() / max(rows['Count'].sum(), 1)
+
+
+def es_rollup_count(es, variable=None, value=None, where=None, index_name=ROLLUP_INDEX):
+    """Count respondents from the companion index, see rollup_count
+
+    :return: (count, mean) where mean is that of a measure variable, else None
+    """
+
+    filters = [{'term': {'Variable': variable or RESPONDENTS}}]
+    if value is not None:
+        filters.append({'term': {'Value': value}})
+    for field, wanted in (where or {}).items():
+        filters.append({'term': {field: wanted}})
+
+    body = {'size': 0, 'query': {'bool': {'filter': filters}},
+            'aggs': {'count': {'sum': {'field': 'Count'}}, 'sum': {'sum': {'field': 'Sum'}}}}
+    aggs = es.search(index=index_name, body=body)['aggregations']
+
+    count = aggs['count']['value']
+    mean = aggs['sum']['value'] / count if aggs['sum']['value'] and count else None
+
+    return int(count), mean
+
+
+def main():
+    parser = ArgumentParser(formatter_class=RawTextHelpFormatter, prog='brfss_rollup.py', description='Answers BRFSS counts & means from a rollup Parquet file written by process_brfss_data.py -ru. \n ')
+
+    parser.add_argument('-f', '--file', dest='file', required=True, help='Rollup Parquet file, e.g. brfss_rollup_2013.parquet')
+    parser.add_argument('-v', '--variable', dest='variable', help='Field of the answer or measure, all respondents if not given')
+    parser.add_argument('-vl', '--value', dest='value', help='Answer to count, any answer if not given')
+    parser.add_argument('-wh', '--where', dest='where', action='append', default=[], help='Filter as field=value, may be repeated')
+    parser.add_argument('-g', '--group_by', dest='group_by', help='Field to break the result down by')
+    parser.add_argument('-mn', '--mean', dest='mean', action='store_true', help='Mean of the measure instead of the count')
+
+    args = parser.parse_args()
+
+    where = dict([w.split('=', 1) for w in args.where])
+    if 'Year' in where:
+        where['Year'] = int(where['Year'])
+
+    st_time = time.perf_counter()
+    table = read_parquet(args.file)
+
+    if args.mean:
+        result = rollup_mean(table, args.variable, where, args.group_by)
+    else:
+        result = rollup_count(table, args.variable, args.value, where, args.group_by)
+
+    print(result.to_string() if isinstance(result, pd.Series) else result)
+    print('\nAnswered from {0} rollup rows in {1:.3f}s'.format(len(table), time.perf_counter() - st_time))
+
+
+if __name__ == '__main__':
+    main()
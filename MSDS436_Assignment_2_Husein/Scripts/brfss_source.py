@@ -0,0 +1,54 @@
+#***********************************************
+# File: brfss_source.py
+# Desc: Readers for the BRFSS LLCP source data
+# Purpose: Perform following operation:
+#          1. Stream records straight out of the LLCP ZIP file
+#          2. Hand them to the decoder in fixed-size batches
+#          3. Read the batches back from split files
+#************************************************/
+
+import io
+from zipfile import ZipFile as zp
+
+# Read buffer used on top of the decompressing ZIP member
+READ_BUFFER = 1024 * 1024
+
+
+def zip_batches(zip_fn, batch_size=5000, member=None):
+    """Yield batches of records from a ZIP member without extracting it
+
+    Records are read as they are decompressed, so the first batch is
+    available long before the whole member has been inflated.
+
+    :param zip_fn: path of the ZIP file
+    :param batch_size: number of records per batch
+    :param member: file inside the ZIP. If not specified then the first one
+    :return: generator of lists of records as bytes, line endings removed
+    """
+
+    with zp(zip_fn) as zip:
+        if member is None:
+            member = zip.namelist()[0]
+
+        with io.BufferedReader(zip.open(member), buffer_size=READ_BUFFER) as f:
+            batch = []
+            for line in f:
+                batch.append(line.rstrip(b'\r\n'))
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+
+            if batch:
+                yield batch
+
+
+def file_batches(files):
+    """Yield the records of split batch files
+
+    :param files: list of (directory, file name) tuples
+    :return: generator of lists of records as strings
+    """
+
+    for dir, fn in files:
+        with open(dir+fn, encoding='iso-8859-1') as f:
+            yield f.read().splitlines()
@@ -0,0 +1,124 @@
+#***********************************************
+# File: brfss_store.py
+# Desc: Parquet store of the transformed BRFSS respondents
+# Purpose: Perform following operation:
+#          1. Write each transformed batch to a Parquet dataset
+#             partitioned by state & interview month
+#          2. Read the dataset back in batches for re-indexing
+#************************************************/
+
+# pip3 install --user pyarrow
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import brfss_decoder
+
+# Column holding the Elasticsearch document id of each respondent
+ID_COLUMN = 'doc_id'
+
+# Arrow integer types read back as pandas nullable integers
+INT_TYPES = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(),
+             pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype()}
+
+
+def arrow_schema(ctx):
+    """Arrow schema of a transformed batch
+
+    Columns keep the compact types of the decoded batch: integers sized to
+    their field with nulls for blanks, so every batch file has the same
+    schema whether or not it had blanks, float32 measures & string answers.
+
+    :param ctx: DecodingContext of the load
+    :return: pyarrow schema, document id first then the batch columns
+    """
+
+    plan = ctx.plan
+    lengths = dict(zip(ctx.layout.names, ctx.layout.lengths))
+    fields = [pa.field(ID_COLUMN, pa.int64())]
+
+    for name, column in ctx.columns.items():
+        if name in plan.divisors or name in ('Latitude', 'Longitude'):
+            typ = pa.float32()
+        elif name in plan.numeric and name not in plan.lookups:
+            typ = pa.from_numpy_dtype(brfss_decoder.int_dtype(lengths[name]).numpy_dtype)
+        else:
+            typ = pa.string()
+
+        fields.append(pa.field(column, typ))
+
+    return pa.schema(fields)
+
+
+def partition_columns(ctx):
+    """Columns the dataset is partitioned by: state & interview month"""
+
+    return [ctx.columns['_STATE'], ctx.columns['IMONTH']]
+
+
+def _as_strings(values):
+    # Lookup columns hold labels, or the raw code when a code has no label
+    return [v if v is None or isinstance(v, str) or v != v else str(v) for v in values]
+
+
+def write_batch(ctx, t1, count, root):
+    """Write a transformed batch to the Parquet dataset
+
+    Files are named after the position of the batch in the load, so writing
+    the same batch again replaces its files.
+
+    :param ctx: DecodingContext of the load
+    :param t1: transformed dataframe indexed by document id
+    :param count: position in the load of the first record of the batch
+    :param root: root directory of the dataset
+    """
+
+    schema = arrow_schema(ctx)
+
+    frame = t1.copy(deep=False)
+    frame.insert(0, ID_COLUMN, frame.index.values)
+
+    # Answers are stored as plain strings, whether categorical or not
+    for field in schema:
+        if field.type == pa.string():
+            frame[field.name] = _as_strings(frame[field.name].astype(object))
+
+    table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+
+    pq.write_to_dataset(table, root,
+                        partition_cols=partition_columns(ctx),
+                        basename_template='batch{0}-{{i}}.parquet'.format(count),
+                        existing_data_behavior='overwrite_or_ignore')
+
+
+def read_batches(ctx, root, batch_size=5000):
+    """Yield the respondents of a Parquet dataset in batches
+
+    :param ctx: DecodingContext of the load
+    :param root: root directory of the dataset
+    :param batch_size: maximum number of respondents per batch
+    :return: generator of dataframes indexed by document id, in the column
+             order & compact types of a transformed batch
+    """
+
+    def to_pandas(table):
+        # Integers back to nullable integers & answers back to categoricals
+        t1 = table.to_pandas(types_mapper=INT_TYPES.get, strings_to_categorical=True)
+        return t1.set_index(t1.pop(ID_COLUMN).astype('int64'))
+
+    schema = arrow_schema(ctx)
+    partitioning = ds.partitioning(pa.schema([schema.field(c) for c in partition_columns(ctx)]), flavor='hive')
+    dataset = ds.dataset(root, schema=schema, format='parquet', partitioning=partitioning)
+
+    # Files of a partition are small, gather their record batches up to batch_size rows
+    pending, rows = [], 0
+    for batch in dataset.to_batches(batch_size=batch_size):
+        pending.append(batch)
+        rows += batch.num_rows
+        if rows >= batch_size:
+            yield to_pandas(pa.Table.from_batches(pending, schema))
+            pending, rows = [], 0
+
+    if rows:
+        yield to_pandas(pa.Table.from_batches(pending, schema))
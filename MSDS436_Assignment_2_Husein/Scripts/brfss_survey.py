@@ -0,0 +1,89 @@
+#***********************************************
+# File: brfss_survey.py
+# Desc: Survey years of the BRFSS data
+# Purpose: Perform following operation:
+#          1. Locate the data file, variable layout, codebook & index
+#             mapping of a survey year
+#          2. Derive stable respondent ids from the year, state & SEQNO
+#          3. Name the index of a year & the alias over all the years
+#************************************************/
+
+import os
+import numpy as np
+
+# Year loaded when none is given, its mapping files may keep their plain names
+SURVEY_YEAR = 2013
+
+# Data file of a survey year on the CDC site
+DATA_URL = 'http://www.cdc.gov/brfss/annual_data/{0}/files/LLCP{0}ASC.ZIP'
+
+# Variables identifying a respondent: SEQNO is numbered within a state
+ID_VARIABLES = ['_STATE', 'SEQNO']
+
+# Alias searching the indices of all the years loaded
+INDEX_ALIAS = 'brfss'
+
+
+def data_url(year):
+    """URL of the LLCP ASCII data file of a survey year"""
+
+    return DATA_URL.format(year)
+
+
+def codebook_file(year):
+    """Codebook JSON file of a survey year, kept next to this script"""
+
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codebook_brfss_{0}.json'.format(year))
+
+
+def mapping_file(dir, fn, year):
+    """Mapping file of a survey year
+
+    The layout & fields change between years, so each year reads its own
+    file, named with the year before the extension (e.g.
+    mapping_variable_list_2014.csv). The default year may use the plain
+    file name.
+
+    :param dir: Local directory holding the mapping files
+    :param fn: plain file name, e.g. mapping_variable_list.csv
+    :param year: survey year
+    :return: path of the file
+    """
+
+    base, ext = os.path.splitext(fn)
+    year_fn = dir + '{0}_{1}{2}'.format(base, year, ext)
+
+    if os.path.exists(year_fn):
+        return year_fn
+    if year == SURVEY_YEAR and os.path.exists(dir + fn):
+        return dir + fn
+
+    raise IOError('No {0} for the {1} survey in {2}'.format(os.path.basename(year_fn), year, dir))
+
+
+def year_index(year, alias=INDEX_ALIAS):
+    """Name of the index holding the respondents of a survey year"""
+
+    return '{0}-{1}'.format(alias, year)
+
+
+def respondent_ids(year, states, seqnos):
+    """Stable document ids of respondents
+
+    The survey year, state code & SEQNO are packed into one integer, e.g.
+    year 2013, state 1 & SEQNO 2013000005 give 2013012013000005. A record
+    gets the same id on every load, whatever batch it falls in.
+
+    :param year: survey year
+    :param states: _STATE code of each respondent
+    :param seqnos: SEQNO of each respondent
+    :return: int64 array of ids
+    """
+
+    states = np.asarray(states, dtype=np.int64)
+    seqnos = np.asarray(seqnos, dtype=np.int64)
+
+    if (states >= 100).any() or (seqnos >= 10 ** 10).any():
+        raise ValueError('_STATE or SEQNO too long to build a respondent id')
+
+    return year * 10 ** 12 + states * 10 ** 10 + seqnos
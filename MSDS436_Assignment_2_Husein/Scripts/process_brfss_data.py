@@ -4,11 +4,14 @@
 # pip3 install --user elasticsearch
 # pip3 install --user requests_aws4auth
 # pip3 install --user argparse
+# pip3 install --user pyarrow
 
 import os
 import re
 import csv
 import json
+import time
+import tracemalloc
 import xport
 import boto3
 import requests
@@ -20,324 +23,264 @@ from datetime import datetime
 from zipfile import ZipFile as zp
 from argparse import ArgumentParser
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from elasticsearch import helpers, Elasticsearch, RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
 import awsapi
+import brfss_async
+import brfss_decoder
+import brfss_download
+import brfss_indexer
+import brfss_profile
+import brfss_rollup
+import brfss_source
+import brfss_store
+import brfss_survey
 
 # Data references:
 # - Data: http://www.cdc.gov/brfss/annual_data/2013/files/LLCP2013ASC.ZIP
 # - Data Codebook: http://www.cdc.gov/brfss/annual_data/2013/pdf/codebook13_llcp.pdf
 # - Variable layout: http://www.cdc.gov/brfss/annual_data/2013/llcp_varlayout_13_onecolumn.html
 
-# Function to convert datetime
-def str_to_iso(text):
-    if text != '':
-        for fmt in (['%m%d%Y','%d%m%Y']):
-            try:
-                return datetime.isoformat(datetime.strptime(text, fmt))
-            except ValueError:
-                if text == '02292014':
-                    return datetime.isoformat(datetime.strptime('02282014', fmt))
-                elif text == '09312014':
-                    return datetime.isoformat(datetime.strptime('09302014', fmt))
-                print(text)
-                pass
-                raise ValueError('Changing date')
-    else:
+def transform_batch(ctx, cdc, count=1, parquet_dir=None):
+    # cdc holds one batch of fixed width records, as strings or bytes. The layout, lookups & field names
+    # come from the decoding context built once in main(). Nothing is copied: the raw records are packed a
+    # chunk at a time & the transforms update the decoded frame in place. The frame is indexed by document
+    # id: stable ids of the survey year, or the position of the records in the load from count
+    timing, memory = {}, {}
 
-        return None
+    # Decode the numeric response into feature. All kept fields are sliced in one pass, blanks become
+    # nulls, numeric fields are converted to integers and coded answers are mapped to their labels.
+    # Refer to the codebook ( http://www.cdc.gov/brfss/annual_data/2013/pdf/codebook13_llcp.pdf) for variable meaning
+    with brfss_profile.stage('slice', timing, memory):
+        t1 = ctx.decode(cdc)
+        t1.index = ctx.doc_ids(cdc, count)
 
+    with brfss_profile.stage('transform', timing, memory):
+        # Grab avg coordinates for state
+        t1['Latitude'], t1['Longitude'] = ctx.coordinates(t1['_STATE'])
 
-def file_to_es(index_name, doc_name, dir, fn, es, count):
-    # Import data and read into a dataframe
+        # Convert interview date into iso format, each distinct date is parsed once
+        dates, fixed = brfss_decoder.iso_dates(t1['IDATE'])
+        t1['IDATE'] = dates
+        if fixed:
+            print('Corrected {0} invalid interview dates'.format(fixed))
 
-    f = open(dir+fn, encoding='iso-8859-1')
-    cdc = f.read().splitlines()
-    f.close()
-    t = pd.DataFrame({'Var': cdc})
+        # Map variable names to more descriptive names
+        t1.rename(columns=ctx.columns, inplace=True)
 
-    # Each row in BRFSS data file correspondents to a respondent. The response to 321 questions is coded in
-    # a single 2365 character long numeric string. The mapping_variable_list.csv file contains a maps the column number
-    # to fields. For example, column 18-19 is a 2-digit code for the interview month
-    var = pd.read_csv(dir+'mapping_variable_list.csv')
+    # Keep the transformed batch, with its nulls, for re-indexing & analytics
+    if parquet_dir:
+        with brfss_profile.stage('parquet', timing, memory):
+            brfss_store.write_batch(ctx, t1, count, parquet_dir)
 
-    # We will only be looking at a subset of the columns in this analysis - these columns have been coded with a
-    # Keep = Yes value in the variable list.
-    varKeep = var[var['Keep'] == 'Yes']
+    return t1, timing, memory
 
-    # Decode the numeric response into feature.
-    for i, row in varKeep.iterrows():
-        st = row['Starting Column'] - 1
-        en = st + row['Field Length']
-        #print(st, en)
-        t[row['Variable Name']] = t['Var'].map(lambda x: x[st:en])
-        #print(row['Variable Name'])
 
-    # Create deep copy of variable
-    t1 = t.copy(deep=True)
+def index_batch(index_name, doc_name, es, t1, count, bulk_opts=None, checkpoint=None, todo=None, timing=None, memory=None, rollup=None):
+    # t1 is indexed by document id & count is the position of the batch in the load. todo lists the ids
+    # still missing from a batch recorded in the checkpoint, None to send the whole batch. es is the
+    # Elasticsearch client, or the AsyncBulkSender of the load
+    timing = {} if timing is None else timing
+    end = count + len(t1) - 1
 
-    # id to state map
-    st = pd.read_csv(dir+'mapping_state.csv')
+    # The whole batch is rolled up, even when only some of its documents are re-sent
+    if rollup is not None:
+        with brfss_profile.stage('rollup', timing, memory):
+            rollup.add(t1)
 
-    # Convert state value from string to int
-    t1['_STATE'] = t1['_STATE'].map(lambda x: int(x))
+    if todo is not None:
+        t1 = t1[t1.index.isin(todo)]
 
-    # Map numeric value of stateto state name
-    st1 = st[['ID', 'State']].set_index('ID').to_dict('dict')['State']
-    t1['_STATE'] = t1['_STATE'].replace(st1)
+    ### Index Data into Elasticsearch
+    print('Indexing Data into Elasticsearch ...')
 
-    # Grab avg coordinates for state
-    lat = st.set_index('State')[['Latitude']].to_dict()['Latitude']
-    lon = st.set_index('State')[['Longitude']].to_dict()['Longitude']
-    t1['Latitude'] = t1['_STATE'].replace(lat)
-    t1['Longitude'] = t1['_STATE'].replace(lon)
+    with brfss_profile.stage('serialize', timing, memory):
+        sources = brfss_indexer.respondent_sources(t1)
 
-    # Convert interview date values into numeric
-    t1['FMONTH'] = t1['FMONTH'].map(lambda x: int(x))
-    t1['IMONTH'] = t1['IMONTH'].map(lambda x: int(x))
-    t1['IDAY'] = t1['IDAY'].map(lambda x: int(x))
-    t1['IDATE'] = t1['IDATE'].map(lambda x: str_to_iso(x))
+    with brfss_profile.stage('index', timing, memory):
+        actions = brfss_indexer.source_actions(sources, t1.index.values, index_name, doc_name)
+        if isinstance(es, brfss_async.AsyncBulkSender):
+            stats = es.bulk_index(actions, raise_on_error=checkpoint is None, **(bulk_opts or {}))
+        else:
+            stats = brfss_indexer.bulk_index(es, actions, raise_on_error=checkpoint is None, **(bulk_opts or {}))
+    print(brfss_indexer.throughput(stats))
 
-    # Alcohol consumption
-    t1['AVEDRNK2'] = t1['AVEDRNK2'].map(lambda x: int(x) if not str.isspace(x) else None) # drinks per occasion
-    t1['DRNK3GE5'] = t1['DRNK3GE5'].map(lambda x: int(x) if not str.isspace(x) else None) # binge days
-    t1['MAXDRNKS'] = t1['MAXDRNKS'].map(lambda x: int(x) if not str.isspace(x) else None) # max drinks per occasion in last 30 days
-    t1['_DRNKDY4'] = t1['_DRNKDY4'].map(lambda x: int(x) if not str.isspace(x) else None) # drinks/day
-    t1['_DRNKMO4'] = t1['_DRNKMO4'].map(lambda x: int(x) if not str.isspace(x) else None) # drinks/month
-    t1['DROCDY3_'] = t1['DROCDY3_'].map(lambda x: int(x) if not str.isspace(x) else None) # drink occasions in last 30 days
+    # Record the acknowledged batch & the ids left to re-send on --resume
+    if checkpoint is not None:
+        checkpoint.record(count, end, brfss_indexer.failed_ids(stats))
 
-    choice = {'1':'No', '2':'Yes', '9': 'Missing'}
-    t1['_RFBING5'] = t1['_RFBING5'].replace(choice) #  binge drinker?
+    return stats
 
-    choice = {'1':'Yes', '2':'No', '7':'Don\'t know' , '9': 'Refused'}
-    t1['DRNKANY5'] = t1['DRNKANY5'].replace(choice) # any drinks in last 30 days?
 
-    # Activity & exercise
-    # Refer to the codebook ( http://www.cdc.gov/brfss/annual_data/2013/pdf/codebook13_llcp.pdf) for variable meaning
+def print_timing(timing, memory=None):
+    print('Batch timing: {0}'.format(', '.join(['{0} {1:.3f}s'.format(k, v) for k, v in timing.items()])))
+    if memory:
+        print('Batch memory: {0}'.format(brfss_profile.format_memory(memory)))
 
-    t1['METVL11_'] = t1['METVL11_'].map(lambda x: int(x) if not str.isspace(x) else None)/10
-    t1['METVL21_'] = t1['METVL21_'].map(lambda x: int(x) if not str.isspace(x) else None)/10
-    t1['MAXVO2_'] = t1['MAXVO2_'].map(lambda x: int(x) if not str.isspace(x) else None) / 100
-    t1['FC60_'] = t1['FC60_'].map(lambda x: int(x) if not str.isspace(x) else None) / 100
-    t1['PADUR1_'] = t1['PADUR1_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['PADUR2_'] = t1['PADUR2_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['PAFREQ1_'] = t1['PAFREQ1_'].map(lambda x: int(x) if not str.isspace(x) else None) / 1000
-    t1['PAFREQ2_'] = t1['PAFREQ2_'].map(lambda x: int(x) if not str.isspace(x) else None) / 1000
-    t1['STRFREQ_'] = t1['STRFREQ_'].map(lambda x: int(x) if not str.isspace(x) else None) / 1000
-    t1['PAMIN11_'] = t1['PAMIN11_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['PAMIN21_'] = t1['PAMIN21_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['PA1MIN_'] = t1['PA1MIN_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['PAVIG11_'] = t1['PAVIG11_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['PAVIG21_'] = t1['PAVIG21_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['PA1VIGM_'] = t1['PA1VIGM_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['EXERHMM1'] = t1['EXERHMM1'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['EXERHMM2'] = t1['EXERHMM2'].map(lambda x: int(x) if not str.isspace(x) else None)
 
-    #t1['EXEROFT1'] = t1['EXEROFT1'].map(lambda x: exerFcn(x))
-    #t1['EXEROFT2'] = t1['EXEROFT2'].map(lambda x: exerFcn(x))
-    #t1['STRENGTH'] = t1['STRENGTH'].map(lambda x: exerFcn(x))
+def report_batch(metrics, start, rows, timing, memory, stats):
+    # Print the batch timings & progress of the load, and emit the batch metrics
+    print_timing(timing, memory)
 
-    choice = {'1':'Yes', '2':'No', '7':'Don\'t know' , '9': 'Refused'}
-    t1['EXERANY2'] = t1['EXERANY2'].replace(choice)
+    if metrics is not None:
+        metrics.batch(start, rows, timing, stats, memory)
+        print('Progress: {0} docs indexed, {1} retried, {2} failed'.format(
+            metrics.counters['docs_indexed'], metrics.counters['retries'], metrics.counters['docs_failed']))
 
-    choice={'1': 'Had exercise in last 30 days',
-            '2': 'No exercise in last 30 days',
-            '9': 'Don’t know/Not sure/Missing'}
 
-    t1['_TOTINDA'] = t1['_TOTINDA'].replace(choice)
+def timed_batches(batches):
+    # Yield each batch of records with the seconds spent reading it from the source
+    batches = iter(batches)
+    while True:
+        st_time = time.perf_counter()
+        cdc = next(batches, None)
+        if cdc is None:
+            return
+        yield cdc, time.perf_counter() - st_time
 
 
-    choice = { '0' : 'Not Moderate / Vigorous or No Activity',
-               '1' : 'Moderate',
-               '2' : 'Vigorous'}
+def pending_ids(checkpoint, count, size, metrics=None):
+    # Ids of a batch to index: None for all of them, [] when the checkpoint has the batch complete
+    todo = checkpoint.pending(count) if checkpoint else None
+    if todo == []:
+        print('Skipping batch of {0} from id {1}, already indexed'.format(size, count))
+        if metrics is not None:
+            metrics.skip(count, size)
 
-    t1['ACTIN11_'] = t1['ACTIN11_'].replace(choice)
-    t1['ACTIN21_'] = t1['ACTIN21_'].replace(choice)
+    return todo
 
 
-    choice = {'1' : 'Highly Active',
-              '2' : 'Active',
-              '3' : 'Insufficiently Active',
-              '4' : 'Inactive',
-              '9' : 'Don’t know' }
+def batch_to_es(index_name, doc_name, ctx, cdc, es, count, bulk_opts=None, checkpoint=None, parquet_dir=None, metrics=None, read_time=0.0, rollup=None):
+    todo = pending_ids(checkpoint, count, len(cdc), metrics)
+    if todo == []:
+        return count + len(cdc)
 
-    t1['_PACAT1'] = t1['_PACAT1'].replace(choice)
+    t1, timing, memory = transform_batch(ctx, cdc, count, parquet_dir)
+    timing = dict([('read', read_time)] + list(timing.items()))
 
-    choice = {'1' : 'Met aerobic recommendations',
-              '2' : 'Did not meet aerobic recommendations',
-              '9' : 'Don’t know' }
+    stats = index_batch(index_name, doc_name, es, t1, count, bulk_opts, checkpoint, todo, timing, memory, rollup)
+    report_batch(metrics, count, len(t1), timing, memory, stats)
 
-    t1['_PAINDX1'] = t1['_PAINDX1'].replace(choice)
+    return count + len(t1)
 
-    choice = {'1' : 'Meet muscle strengthening recommendations',
-              '2' : 'Did not meet muscle strengthening recommendations',
-              '9' : 'Missing'}
 
-    t1['_PASTRNG'] = t1['_PASTRNG'].replace(choice)
+# Decoding context of a worker process, set once by the pool initializer
+_worker_ctx = None
 
-    choice = {'1' : 'Met both guidelines',
-              '2' : 'Met aerobic guidelines only',
-              '3' : 'Met strengthening guidelines only',
-              '4' : 'Did not meet either guideline',
-              '9' : 'Missing' }
-
-    t1['_PAREC1'] = t1['_PAREC1'].replace(choice)
-
-
-    choice = {'1' : 'Met both guidelines',
-              '2' : 'Did not meet both guideline',
-              '9' : 'Missing' }
-
-    #t1['_PASTAE1'] = t1['_PASTAE1'].replace(choice)
-
-    # Map activity code to activity names
-    act = pd.read_csv(dir+'mapping_activity.csv', encoding='iso-8859-1')
-    act['Activity'] = act['Activity'].map(lambda x: re.sub(r'\s*$','', x))
-
-    t1['EXRACT11'] = t1['EXRACT11'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['EXRACT11'] = t1['EXRACT11'].replace(act.set_index('ID').to_dict()['Activity'])
-
-    t1['EXRACT21'] = t1['EXRACT21'].map(lambda x: int(x) if not str.isspace(x) else '')
-    t1['EXRACT21'] = t1['EXRACT21'].replace(act.set_index('ID').to_dict()['Activity'])
-
-    # Height, Weight, Age, BMI
-    t1['_BMI5'] = t1['_BMI5'].map(lambda x: int(x) if not str.isspace(x) else None)/100
-
-    choice={'1': 'Underweight',
-            '2': 'Normal weight',
-            '3': 'Overweight',
-            '4':'Obese'}
-
-    t1['_BMI5CAT'] = t1['_BMI5CAT'].replace(choice)
-
-    # Height & Weight
-    t1['WTKG3'] = t1['WTKG3'].map(lambda x: int(x) if not str.isspace(x) else None)/100
-    t1['HTM4'] = t1['HTM4'].map(lambda x: int(x) if not str.isspace(x) else None)/100
-    t1['HTIN4'] = t1['HTIN4'].map(lambda x: int(x) if not str.isspace(x) else None)
-
-    # Nutrition
-    ## NOTE:  Values include two implied decimal places
-    # Vegetable & Fruit intake per day
-    t1['_FRUTSUM'] = t1['_FRUTSUM'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['_VEGESUM'] = t1['_VEGESUM'].map(lambda x: int(x) if not str.isspace(x) else None)
-
-    # Food intake - times per day
-    t1['FRUTDA1_'] = t1['FRUTDA1_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['VEGEDA1_'] = t1['VEGEDA1_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['GRENDAY_'] = t1['GRENDAY_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['ORNGDAY_'] = t1['ORNGDAY_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['FTJUDA1_'] = t1['FTJUDA1_'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['BEANDAY_'] = t1['BEANDAY_'].map(lambda x: int(x) if not str.isspace(x) else None)
 
-    # Salt intake and advice
-    choice = {'1':'Yes', '2':'No', '7':'Don\'t know' , '9': 'Refused'}
-    t1['WTCHSALT'] = t1['WTCHSALT'].replace(choice)
-    t1['DRADVISE'] = t1['DRADVISE'].replace(choice)
+def _init_worker(ctx, trace_memory=False):
+    global _worker_ctx
+    _worker_ctx = ctx
 
-    # Demographics
-    choice = {'1' : 'Did not graduate High School',
-              '2' : 'Graduated High School',
-              '3' : 'Attended College or Technical School',
-              '4' : 'Graduated from College or Technical School',
-              '9' : 'Don’t know/Not sure/Missing'}
+    if trace_memory:
+        brfss_profile.start_tracing()
 
-    t1['_EDUCAG'] = t1['_EDUCAG'].replace(choice)
 
-    choice = {'1' : 'Male',
-              '2' : 'Female'}
-    t1['SEX'] = t1['SEX'].replace(choice)
+def _transform_task(cdc, count, todo, parquet_dir=None):
+    t1, timing, memory = transform_batch(_worker_ctx, cdc, count, parquet_dir)
+    return count, todo, t1, timing, memory
 
-    choice = {'1' : '< $15000',
-              '2' : '$15,000 - $25,000',
-              '3' : '$25,000 - $35,000',
-              '4' : '$35,000 - $50,000',
-              '5' : '> $50,000',
-              '9' : 'Don’t know/Not sure/Missing'}
 
-    t1['_INCOMG'] = t1['_INCOMG'].replace(choice)
-
-    choice = {'1':'Employed for wages', '2':'Self-employed', '3': 'Unemployed < 1 year', '4': 'Unemployed > 1 year', '5': 'Homemaker', '6' : 'Student', '7': 'Retired' , '8': 'Unable to work', '9': 'Refused'}
-    t1['EMPLOY1'] = t1['EMPLOY1'].replace(choice)
+def parallel_to_es(index_name, doc_name, ctx, batches, es, workers, bulk_opts=None, count=1, checkpoint=None, parquet_dir=None, metrics=None, rollup=None):
+    # Batches are decoded & transformed by a pool of worker processes while the main process indexes the
+    # results as they complete. The first document id of every batch is fixed up front from its line
+    # offset, so the index is the same as a sequential run whatever order the batches finish in.
+    pending = set()
+    read_times = {}
 
-    choice = {'1':'< Kindergarden', '2':'Elementary', '3': 'Some high-school', '4': 'High-school graduate', '5': 'College / tech school', '6' : 'College grade', '9': 'Refused'}
-    t1['EDUCA'] = t1['EDUCA'].replace(choice)
+    def index_done(done):
+        for future in done:
+            start, todo, t1, timing, memory = future.result()
+            timing = dict([('read', read_times.pop(start))] + list(timing.items()))
+            print('Indexing batch of {0} from id {1} ...'.format(len(t1), start))
+            stats = index_batch(index_name, doc_name, es, t1, start, bulk_opts, checkpoint, todo, timing, memory, rollup)
+            report_batch(metrics, start, len(t1), timing, memory, stats)
 
-    choice = {'1':'Married', '2':'Divored', '4': 'Separated', '3': 'Separated',  '5': 'Never Married', '6':'Unmarried couple' , '9': 'Refused'}
-    t1['MARITAL'] = t1['MARITAL'].replace(choice)
-
-    choice = {'1':'Yes', '2':'No', '7':'Don\'t know' , '9': 'Refused'}
-    t1['VETERAN3'] = t1['VETERAN3'].replace(choice)
-
-    # Age
-    choice = {
-    '01' : 'Age 18 to 24',
-        '02' : 'Age 25 to 29',
-        '03' : 'Age 30 to 34',
-        '04' : 'Age 35 to 39',
-        '05': 'Age 40 to 44',
-        '06' : 'Age 45 to 49',
-        '07':  'Age 50 to 54',
-        '08':  'Age 55 to 59',
-        '09': 'Age 60 to 64',
-        '10':  'Age 65 to 69',
-        '11': 'Age 70 to 74',
-        '12': 'Age 75 to 79' ,
-        '13':  'Age 80 or older',
-        '14':  'Don’t know/Refused/Missing'}
-
-    t1['_AGEG5YR'] = t1['_AGEG5YR'].replace(choice)
-
-    # General health
-    choice = {'5':'Poor', '3':'Good', '1':'Excellent', '2':'Very Good', '4':'Fair', '7':'Don\'t know' , '9': 'Refused'}
-    t1['GENHLTH'] = t1['GENHLTH'].replace(choice)
-
-    choice = {'1':'Yes', '2':'No', '7':'Don\'t know' , '9': 'Refused'}
-    t1['QLACTLM2'] = t1['QLACTLM2'].replace(choice)
-    t1['USEEQUIP'] = t1['USEEQUIP'].replace(choice)
-    t1['DECIDE']   = t1['DECIDE'].replace(choice)
-    t1['DIFFWALK'] = t1['DIFFWALK'].replace(choice)
-    t1['DIFFDRES'] = t1['DIFFDRES'].replace(choice)
-    t1['DIFFALON'] = t1['DIFFALON'].replace(choice)
-
-
-    t1['MENTHLTH'] = t1['MENTHLTH'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['POORHLTH'] = t1['POORHLTH'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['SLEPTIM1'] = t1['SLEPTIM1'].map(lambda x: int(x) if not str.isspace(x) else None)
-    t1['PHYSHLTH'] = t1['PHYSHLTH'].map(lambda x: int(x) if not str.isspace(x) else None)
-
-    # Map variable names to more descriptive names
-    varDict = var[['Variable Name', 'DESC']].to_dict('split')
-    varDict = dict(varDict['data'])
-    t1.rename(columns=varDict, inplace=True)
-
-    # Replace space / special characters with underscore
-    t1.rename(columns=lambda x: re.sub(' ', '_', x), inplace=True)
-    t1.rename(columns=lambda x: re.sub(r'\(|\-|\/|\|\>|\)|\#', '', x), inplace=True)
-    t1.rename(columns=lambda x: re.sub(r'\>', 'GT', x), inplace=True)
-
-    # Delete original row
-    del(t1['Var'])
-
-    t1.fillna('', inplace=True)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(ctx, tracemalloc.is_tracing())) as pool:
+        for cdc, read_time in timed_batches(batches):
+            todo = pending_ids(checkpoint, count, len(cdc), metrics)
+            if todo == []:
+                count += len(cdc)
+                continue
 
-    ### Index Data into Elasticsearch
-    print('Indexing Data into Elasticsearch ...')
+            # Keep at most two batches per worker in memory
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                index_done(done)
 
-    for subj_id, subject in t1.iterrows():
-        # if subj_id % 1000 == 0:
-        #     print(subj_id)
-        thisResp = subject.to_dict()
-        thisResp['Coordinates'] = [thisResp['Longitude'], thisResp['Latitude']]
-        thisDoc = json.dumps(thisResp);
-        #pprint.pprint(thisDoc)
+            read_times[count] = read_time
+            pending.add(pool.submit(_transform_task, cdc, count, todo, parquet_dir))
+            count += len(cdc)
 
-        # write to elasticsearch
-        es.index(index=index_name, doc_type=doc_name, id=count, body=thisDoc)
-        count += 1
+        index_done(wait(pending).done)
 
     return count
 
 
+def load_batches(index_name, doc_name, ctx, batches, es, workers, bulk_opts=None, checkpoint=None, parquet_dir=None, metrics=None, rollup=None):
+    if workers > 1:
+        print('Decoding batches with {0} worker processes ...'.format(workers))
+        return parallel_to_es(index_name, doc_name, ctx, batches, es, workers, bulk_opts,
+                              checkpoint=checkpoint, parquet_dir=parquet_dir, metrics=metrics, rollup=rollup)
+
+    count = 1
+    for cdc, read_time in timed_batches(batches):
+        print('Processing batch of {0} ...'.format(len(cdc)))
+        count = batch_to_es(index_name, doc_name, ctx, cdc, es, count, bulk_opts, checkpoint, parquet_dir, metrics, read_time, rollup)
+
+    return count
+
+
+def parquet_to_es(index_name, doc_name, ctx, parquet_dir, es, batch_size, bulk_opts=None, metrics=None, rollup=None):
+    # Re-index a Parquet dataset written by an earlier load. Batches are indexed by document id, so the
+    # documents get the same ids as in the original load
+    count = 0
+    for t1, read_time in timed_batches(brfss_store.read_batches(ctx, parquet_dir, batch_size)):
+        print('Indexing batch of {0} from {1} ...'.format(len(t1), parquet_dir))
+        timing, memory = {'read': read_time}, {}
+        stats = index_batch(index_name, doc_name, es, t1, count + 1, bulk_opts, timing=timing, memory=memory, rollup=rollup)
+        report_batch(metrics, count + 1, len(t1), timing, memory, stats)
+        count += len(t1)
+
+    return count
+
+
+def _timed_upload(bucket_name, dir, zip_fn):
+    st_time = time.perf_counter()
+    ok = awsapi.upload_file(bucket_name, dir, zip_fn, dir)
+    return ok, time.perf_counter() - st_time
+
+
+def start_upload(bucket_name, dir, zip_fn):
+    # Archive the data file to S3 on a background thread. Nothing downstream reads it back from S3, so
+    # extraction & indexing start right away instead of waiting for the upload
+    pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='s3-upload')
+    upload = pool.submit(_timed_upload, bucket_name, dir, zip_fn)
+    pool.shutdown(wait=False)
+
+    return upload
+
+
+def finish_upload(upload):
+    # Join the background upload & report how it went, returns True if the file is on S3
+    if not upload.done():
+        print('Waiting for the S3 upload to complete ...')
+
+    try:
+        ok, sec = upload.result()
+    except Exception as e:
+        print('S3 upload failed: {0}'.format(e))
+        return False
+
+    if not ok:
+        print('S3 upload failed, see the error above')
+        return False
+
+    print('S3 upload completed in {0:.2f}s'.format(sec))
+    return True
+
+
 def main():
 
     st_time = datetime.now()
@@ -348,6 +291,30 @@ def main():
     parser.add_argument('-d', '--dir', dest='dir', help='Local directory for downloading files & uploading to AWS', required=True)
     parser.add_argument('-rh', '--remote_host', dest='remote_host', required=True, help='Host name')
     parser.add_argument('-r', '--region', dest='region', required=True, help='Port')
+    parser.add_argument('-y', '--year', dest='year', type=int, default=brfss_survey.SURVEY_YEAR, help='Survey year, read with its own variable list, codebook & mapping & loaded into its own index')
+    parser.add_argument('-du', '--data_url', dest='data_url', help='URL of the BRFSS data file, by default the LLCP ASCII file of the year')
+    parser.add_argument('-dp', '--download_parts', dest='download_parts', type=int, default=1, help='Byte ranges of the data file downloaded in parallel')
+    parser.add_argument('-s', '--stream', dest='stream', action='store_true', help='Stream batches straight from the ZIP file instead of extracting & splitting it')
+    parser.add_argument('-bs', '--batch_size', dest='batch_size', type=int, default=5000, help='Records per batch')
+    parser.add_argument('-dc', '--decode_chunk', dest='decode_chunk', type=int, default=brfss_decoder.DECODE_CHUNK, help='Records packed at a time while decoding, bounds the memory used for the raw records')
+    parser.add_argument('-tm', '--trace_memory', dest='trace_memory', action='store_true', help='Report the peak allocation of each stage with tracemalloc')
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=1, help='Worker processes decoding batches, 1 to decode in the main process')
+    parser.add_argument('-rs', '--resume', dest='resume', action='store_true', help='Keep the existing index & only send the batches missing from the checkpoint file')
+    parser.add_argument('-ri', '--replace_index', dest='replace_index', action='store_true', help='Delete an index named brfss left by an earlier load so the alias brfss over the indices of the years can take its name')
+    parser.add_argument('-u', '--upsert', dest='upsert', action='store_true', help='Keep the index of the year & upsert the documents by id, unchanged ones are not rewritten')
+    parser.add_argument('-bl', '--bulk_load', dest='bulk_load', action='store_true', help='Turn off refresh & replicas of the index during the load')
+    parser.add_argument('-fm', '--force_merge', dest='force_merge', type=int, default=0, help='Force merge the index to this many segments after a bulk load, 0 to skip')
+    parser.add_argument('-pq', '--parquet', dest='parquet', help='Also write the transformed batches to this Parquet dataset, partitioned by state & interview month')
+    parser.add_argument('-fp', '--from_parquet', dest='from_parquet', help='Index the Parquet dataset written by --parquet instead of downloading & decoding the data file')
+    parser.add_argument('-ru', '--rollup', dest='rollup', action='store_true', help='Also roll up counts & means by state, age group & sex into brfss_rollup_<year>.parquet & index brfss-rollup')
+    parser.add_argument('-m', '--metrics', dest='metrics', help='Append per-batch metrics as JSON lines to this file, - for stdout')
+    parser.add_argument('-pm', '--prometheus', dest='prometheus', help='Keep the metrics of the load in this Prometheus text format file')
+    parser.add_argument('-c', '--codebook', dest='codebook', help='Codebook JSON file with the variable types & code labels, by default the one of the year')
+    parser.add_argument('-cs', '--chunk_size', dest='chunk_size', type=int, default=brfss_indexer.CHUNK_SIZE, help='Documents per bulk request')
+    parser.add_argument('-cb', '--chunk_bytes', dest='chunk_bytes', type=int, default=brfss_indexer.MAX_CHUNK_BYTES, help='Bytes per bulk request')
+    parser.add_argument('-if', '--in_flight', dest='in_flight', type=int, default=brfss_indexer.MAX_IN_FLIGHT, help='Bulk requests in flight')
+    parser.add_argument('-as', '--async_send', dest='async_send', action='store_true', help='Send the bulk requests from an asyncio event loop, halving the requests in flight on 429 rejections')
+    parser.add_argument('-mr', '--max_retries', dest='max_retries', type=int, default=brfss_indexer.MAX_RETRIES, help='Retries of documents rejected by Elasticsearch')
 
     args = parser.parse_args()
 
@@ -356,6 +323,22 @@ def main():
     dir         = args.dir
     remote_host = args.remote_host
     region      = args.region
+    stream      = args.stream
+    year        = args.year
+    codebook    = args.codebook or brfss_survey.codebook_file(year)
+    workers     = args.workers
+    resume      = args.resume
+    upsert      = args.upsert
+    bulk_load   = args.bulk_load
+    force_merge = args.force_merge
+    parquet_dir = args.parquet
+    from_parquet = args.from_parquet
+    trace_memory = args.trace_memory
+    bulk_opts   = {'chunk_size': args.chunk_size,
+                   'max_chunk_bytes': args.chunk_bytes,
+                   'max_in_flight': args.in_flight,
+                   'max_retries': args.max_retries,
+                   'upsert': upsert}
 
     # Add '/' to directory strings if not already present at the end
     if object_name and object_name[-1]!='/':
@@ -368,20 +351,23 @@ def main():
     if not os.path.exists(dir):
         os.makedirs(dir)
 
-    data_file_url = 'http://www.cdc.gov/brfss/annual_data/2013/files/LLCP2013ASC.ZIP'
+    data_file_url = args.data_url or brfss_survey.data_url(year)
     zip_fn = data_file_url.split('/')[-1]
 
-    print('Downloading {0}'.format(data_file_url))
-    response = requests.get(data_file_url)
+    # Re-indexing from Parquet needs neither the data file nor the S3 upload
+    upload = None
+    if not from_parquet:
+        # The file is streamed to disk, resumed if an earlier run was interrupted & skipped if unchanged
+        print('Downloading {0}'.format(data_file_url))
 
-    try:
-        with open(dir+zip_fn, "wb") as f:
-            f.write(response.content)
-    except:
-        print('Issue with file downloading from {0}'.format(data_file_url))
+        try:
+            stats = brfss_download.download(data_file_url, dir+zip_fn, parts=args.download_parts)
+            print(brfss_download.download_report(stats))
+        except (requests.RequestException, IOError) as e:
+            print('Issue with file downloading from {0}: {1}'.format(data_file_url, e))
 
-    print('Uploading file to S3 ...')
-    awsapi.upload_file(bucket_name, dir, zip_fn, dir)
+        print('Uploading file to S3 in the background ...')
+        upload = start_upload(bucket_name, dir, zip_fn)
 
     print('Setting up ES environment ...')
     service = 'es'
@@ -397,53 +383,151 @@ def main():
     )
 
     ### Create and configure Elasticsearch index
-    # Name of index and document type
-    index_name = 'brfss';
+    # Name of index and document type. Each survey year has its own index, searched together through the alias
+    alias = brfss_survey.INDEX_ALIAS
+    index_name = brfss_survey.year_index(year, alias)
     doc_name = 'respondent'
 
-    # Delete donorschoose index if one does exist
-    if es.indices.exists(index_name):
+    # A single index of an earlier load, numbered by position, is replaced by the indices of the years.
+    # It is only deleted when asked for, the documents of other years or sources may live nowhere else
+    if es.indices.exists(alias) and not es.indices.exists_alias(name=alias):
+        if not args.replace_index:
+            if upload is not None:
+                finish_upload(upload)
+            parser.error('index {0} of an earlier load holds the name of alias {0}. Reindex its documents into '
+                         '{1} or delete it, then run again, or pass -ri to have it deleted'.format(alias, index_name))
+
+        print('Deleting index {0}, replaced by alias {0} over the indices of the years'.format(alias))
+        es.indices.delete(alias)
+
+    # Delete the index of the year if one does exist, unless resuming an earlier load or upserting into it
+    if es.indices.exists(index_name) and not (resume or upsert):
         es.indices.delete(index_name)
 
-    # Create donorschoose index
-    es.indices.create(index_name)
+    if not es.indices.exists(index_name):
+        # Create donorschoose index
+        es.indices.create(index_name)
 
-    # Add mapping
-    with open(dir+'mapping_brfss.json') as json_mapping:
-        d = json.load(json_mapping)
+        # Add mapping
+        with open(brfss_survey.mapping_file(dir, 'mapping_brfss.json', year)) as json_mapping:
+            d = json.load(json_mapping)
 
-    es.indices.put_mapping(index=index_name, doc_type=doc_name, body=d, include_type_name=True)
+        es.indices.put_mapping(index=index_name, doc_type=doc_name, body=d, include_type_name=True)
 
-    print('Unzipping the file & splitting them into smaller batches ...')
+    es.indices.put_alias(index=index_name, name=alias)
 
-    zip=zp(dir+zip_fn)
-    fn = zip.namelist()[0]
-    zip.extractall(dir)
+    print('Loading mapping files & codebook ...')
+    ctx_time = time.perf_counter()
+    ctx = brfss_decoder.load_context(dir, codebook, year)
+    ctx.chunk_rows = args.decode_chunk
+    print('Decoding context built in {0:.3f}s'.format(time.perf_counter() - ctx_time))
 
-    files=[]
-    splitLen = 5000
-    count = 0
-    at = 1
-    dest = None
-    f = open(dir+fn, 'r', encoding='iso-8859-1')
-    for line in f:
-        if count % splitLen == 0:
+    splitLen = args.batch_size
+
+    if trace_memory:
+        brfss_profile.start_tracing()
+
+    # Bulk requests go through the client, or through the asyncio sender sharing its connection & signing
+    sender = brfss_async.AsyncBulkSender(es, args.in_flight) if args.async_send else None
+    bulk_es = sender or es
+
+    # Counters & stage timers of the load, emitted after every batch
+    metrics = brfss_profile.Metrics(args.metrics, args.prometheus)
+
+    # Counts for the dashboards, computed from the batches as they are indexed
+    rollup = brfss_rollup.Rollup(ctx) if args.rollup else None
+
+    checkpoint = None
+
+    if from_parquet:
+        print('Reading batches of {0} from Parquet dataset {1} ...'.format(splitLen, from_parquet))
+        load = lambda: parquet_to_es(index_name, doc_name, ctx, from_parquet, bulk_es, splitLen, bulk_opts, metrics, rollup)
+
+    else:
+        # Batches acknowledged by Elasticsearch, kept across runs for --resume
+        checkpoint = brfss_indexer.Checkpoint(dir+index_name+'.checkpoint', zip_fn, splitLen, resume)
+
+        if stream:
+            print('Streaming batches of {0} from {1} ...'.format(splitLen, zip_fn))
+            batches = brfss_source.zip_batches(dir+zip_fn, splitLen)
+
+        else:
+            print('Unzipping the file & splitting them into smaller batches ...')
+
+            zip=zp(dir+zip_fn)
+            fn = zip.namelist()[0]
+            zip.extractall(dir)
+
+            files=[]
+            count = 0
+            at = 1
+            dest = None
+            f = open(dir+fn, 'r', encoding='iso-8859-1')
+            for line in f:
+                if count % splitLen == 0:
+                    if dest: dest.close()
+                    dest = open(dir+fn+str(at), 'w')
+                    files.append((dir,fn+str(at)))
+                    at += 1
+                dest.write(line)
+                count += 1
+            f.close()
             if dest: dest.close()
-            dest = open(dir+fn+str(at), 'w')
-            files.append((dir,fn+str(at)))
-            at += 1
-        dest.write(line)
-        count += 1
-    f.close()
 
-    count = 1
-    for item in files:
-        print('Processing batch of {0} ...'.format(splitLen))
-        count = file_to_es(index_name, doc_name, item[0], item[1], es, count)
+            batches = brfss_source.file_batches(files)
+
+        load = lambda: load_batches(index_name, doc_name, ctx, batches, bulk_es, workers, bulk_opts, checkpoint, parquet_dir, metrics, rollup)
+
+    load_time = time.perf_counter()
+    try:
+        if bulk_load:
+            with brfss_indexer.bulk_load_mode(es, index_name, force_merge) as report:
+                count = load()
+
+            print(brfss_indexer.load_report(report))
+
+        else:
+            count = load()
+
+    # The upload is joined & reported even if the load failed
+    finally:
+        print('\nLoad completed in {0:.2f}s'.format(time.perf_counter() - load_time))
+        metrics.close()
+        if sender is not None:
+            print(sender.report())
+            sender.close()
+        if upload is not None:
+            finish_upload(upload)
+
+    summary = metrics.summary()
+    print('\nDocuments indexed      : {0} ({1} retried, {2} failed, {3} unchanged)'.format(
+        summary['docs_indexed'], summary['retries'], summary['docs_failed'], summary['docs_unchanged']))
+    print('Bytes sent             : {0:.1f} MB'.format(summary['bytes_sent'] / 1e6))
+    print('Stage time             : {0}'.format(', '.join(['{0} {1:.2f}s'.format(k, v) for k, v in summary['seconds'].items()])))
+
+    # Batches skipped by --resume were not decoded, their respondents would be missing from the rollup
+    if rollup is not None and metrics.counters['batches_skipped']:
+        print('\nRollup not written, {0} batches were skipped as already indexed'.format(metrics.counters['batches_skipped']))
+
+    elif rollup is not None:
+        table = rollup.table()
+        rollup_fn = dir + 'brfss_rollup_{0}.parquet'.format(year)
+        brfss_rollup.write_parquet(table, rollup_fn)
+        stats = brfss_rollup.index_rollup(es, table, bulk_opts=bulk_opts)
+        print('\nRolled up {0} respondents into {1} rows, written to {2} & index {3} ({4} docs, {5} retried, {6} failed)'.format(
+            rollup.rows, len(table), rollup_fn, brfss_rollup.ROLLUP_INDEX, stats['docs'], stats['retries'], stats['failed']))
+        if stats['failed']:
+            print('Rollup rows of earlier loads kept in {0}, first error: {1}'.format(brfss_rollup.ROLLUP_INDEX, stats['errors'][0]))
+
+    if checkpoint and checkpoint.missing():
+        print('\n{0} documents failed to index, run again with --resume to re-send them'.format(checkpoint.missing()))
 
     print('\n\nProcessing completed!')
 
-    # file_to_es(dir, fn, es)
+    print('\nPeak RSS               : {0:.1f} MB'.format(brfss_profile.peak_rss() / 1e6))
+    if workers > 1:
+        print('Peak RSS of workers    : {0:.1f} MB'.format(brfss_profile.peak_rss(children=True) / 1e6))
+
     fin_time = datetime.now()
     print('\nTotal execution time   : {0}\n\n'.format(str(fin_time - st_time)))
 